@@ -7,4 +7,4 @@ from msdm.algorithms.entregpolicyiteration import EntropyRegularizedPolicyIterat
 from msdm.algorithms.pointbasedvalueiteration import PointBasedValueIteration
 from msdm.algorithms.qmdp import QMDP
 from msdm.algorithms.fscgradientascent import FSCGradientAscent
-from msdm.algorithms.tdlearning import QLearning, SARSA, ExpectedSARSA, DoubleQLearning
+from msdm.algorithms.tdlearning import QLearning, SARSA, ExpectedSARSA, DoubleQLearning, SARSALambda, WatkinsQLambda, DynaQ
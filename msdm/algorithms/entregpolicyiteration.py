@@ -1,12 +1,12 @@
-from collections import defaultdict
 from types import SimpleNamespace
 from typing import Union
 import torch
 import numpy as np
 import warnings
 from msdm.core.problemclasses.mdp import \
-    TabularMarkovDecisionProcess, TabularPolicy
+    TabularMarkovDecisionProcess, ArrayPolicy
 from msdm.core.algorithmclasses import Plans, PlanningResult
+from msdm.core.utils.arrayviews import ArrayMapping
 
 def clamp_zero(tensor):
     min_val = torch.finfo(tensor.dtype).tiny
@@ -102,10 +102,12 @@ class EntropyRegularizedPolicyIteration(Plans):
         self.policy_prior = policy_prior
 
     def plan_on(self, mdp: TabularMarkovDecisionProcess):
-        ss = mdp.state_list
-        tf = torch.from_numpy(mdp.transition_matrix)
-        rf = torch.from_numpy(mdp.reward_matrix)
-        am = torch.from_numpy(mdp.action_matrix)
+        instrumentation = self.instrumentation
+        with instrumentation.phase("compile", mdp) as model:
+            ss = model.state_list
+            tf = torch.from_numpy(model.transition_matrix)
+            rf = torch.from_numpy(model.reward_matrix)
+            am = torch.from_numpy(model.action_matrix)
 
         iterations = self.iterations
         if iterations is None:
@@ -116,18 +118,28 @@ class EntropyRegularizedPolicyIteration(Plans):
         else:
             policy_prior = self.policy_prior
 
-        pi_res = entropy_regularized_policy_iteration(
-            transition_matrix=tf,
-            reward_matrix=rf,
-            discount_rate=mdp.discount_rate,
-            entropy_weight=self.entropy_weight,
-            n_planning_iters=iterations,
-            policy_prior=policy_prior,
-            initial_policy=None,
-            check_convergence=True,
-            force_nonzero_probabilities=True
+        with instrumentation.phase("solve"):
+            pi_res = entropy_regularized_policy_iteration(
+                transition_matrix=tf,
+                reward_matrix=rf,
+                discount_rate=mdp.discount_rate,
+                entropy_weight=self.entropy_weight,
+                n_planning_iters=iterations,
+                policy_prior=policy_prior,
+                initial_policy=None,
+                check_convergence=True,
+                force_nonzero_probabilities=True
+            )
+        instrumentation.count("policy_evaluations", pi_res.iterations + 1)
+
+        with instrumentation.phase("result"):
+            return self._planning_result(mdp, pi_res)
+
+    def _planning_result(self, mdp, pi_res):
+        policy = ArrayPolicy(
+            mdp.state_list, mdp.action_list, pi_res.policy.detach().numpy(),
+            state_index=mdp.state_index, action_index=mdp.action_index
         )
-        policy = TabularPolicy.from_matrix(mdp.state_list, mdp.action_list, pi_res.policy.detach().numpy())
         res = PlanningResult()
         res.converged = pi_res.converged
         if not res.converged:
@@ -135,17 +147,14 @@ class EntropyRegularizedPolicyIteration(Plans):
         res.mdp = mdp
         res.policy = res.pi = policy
         res._valuevec = pi_res.state_values.detach().numpy()
-        vf = dict()
-        for s, vi in zip(mdp.state_list, res._valuevec):
-            vf[s] = vi
-        res.valuefunc = res.V = vf
+        res.valuefunc = res.V = ArrayMapping(res._valuevec, (mdp.state_list,), (mdp.state_index,))
         res._qvaluemat = pi_res.action_values.detach().numpy()
         res.iterations = pi_res.iterations
-        qf = defaultdict(lambda : dict())
-        for si, s in enumerate(mdp.state_list):
-            for ai, a in enumerate(mdp.action_list):
-                qf[s][a] = res._qvaluemat[si, ai]
-        res.actionvaluefunc = res.Q = qf
+        res.actionvaluefunc = res.Q = ArrayMapping(
+            res._qvaluemat, (mdp.state_list, mdp.action_list), (mdp.state_index, mdp.action_index)
+        )
         res.initial_value = sum([res.V[s0]*p for s0, p in mdp.initial_state_dist().items()])
-        res.policy_divergence = dict(zip(mdp.state_list, pi_res.policy_entropy))
+        res.policy_divergence = ArrayMapping(
+            pi_res.policy_entropy.detach().numpy(), (mdp.state_list,), (mdp.state_index,)
+        )
         return res
@@ -2,12 +2,19 @@ from abc import ABC, abstractmethod
 from typing import Callable
 import warnings
 import random
+import heapq
+from array import array
+from collections import namedtuple
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 
 from msdm.core.algorithmclasses import Plans, PlanningResult
 from msdm.core.problemclasses.mdp import MarkovDecisionProcess, TabularPolicy, HashableState
 from msdm.core.distributions.dictdistribution import DeterministicDistribution, DictDistribution
-from msdm.core.exceptions import SpecificationException, AlgorithmException
+from msdm.core.exceptions import SpecificationException
+
+LAOStarIteration = namedtuple("LAOStarIteration", "iteration expanded_states revised_states solution_graph_size")
 
 class LAOStar(Plans):
     def __init__(
@@ -19,6 +26,10 @@ class LAOStar(Plans):
         randomize_nextstate_order : bool=True,
         event_listener_class : "LAOStarEventListener" = None,
         seed=None,
+        dynamic_programming_method : str = "policy_iteration",
+        dynamic_programming_tolerance : float = 1e-10,
+        expansions_per_iteration = 1,
+        max_convergence_sweeps : int = int(1e5),
     ):
         """
         LAO* is a heuristic search algorithm that works on MDPs.
@@ -35,8 +46,8 @@ class LAOStar(Plans):
             Maximum number of iterations of the main LAO* loop
 
         dynamic_programming_iterations : int
-            Maximum number of policy iteration iterations in
-            the value revision step.
+            Maximum number of policy iteration (or value iteration)
+            iterations in the value revision step.
 
         randomize_action_order : bool
             If set to True, then the order of actions in a
@@ -52,6 +63,40 @@ class LAOStar(Plans):
         seed : int
             Random seed
 
+        dynamic_programming_method : str
+            How values are revised over the ancestors of expanded states.
+            "policy_iteration" (the default) solves for their values exactly.
+            "value_iteration" runs value iteration warm-started from their
+            current values, until values change by less than
+            `dynamic_programming_tolerance` or for
+            `dynamic_programming_iterations` sweeps. When the solution graph
+            has no more tip states, value iteration is then run over the whole
+            solution graph until it converges, and search continues if its
+            best partial policy changed (Hansen & Zilberstein, 2001).
+
+        dynamic_programming_tolerance : float
+            Convergence threshold for "value_iteration".
+
+        expansions_per_iteration : int or "all"
+            How many non-terminal tip states of the solution graph
+            are expanded on each iteration before values are revised.
+            With 1 (the default), the best tip state is expanded
+            (see `SolutionGraph.best_breadth_first_tip_state`);
+            with k > 1, the k best ones are; and with "all",
+            every tip state is, as in Hansen & Zilberstein (2001).
+
+        max_convergence_sweeps : int
+            Maximum number of value iteration sweeps when values are
+            revised to convergence over the solution graph with
+            "value_iteration". If they have not converged by then,
+            a warning is raised and search stops unconverged.
+
+        If `instrumentation` is enabled, it receives a `LAOStarIteration`
+        with the number of states expanded, the number of states whose
+        values were revised, and the number of states in the solution graph
+        after each iteration, and the "expansions" and "revised_states"
+        counters are incremented.
+
         References
         ----------
         Hansen, E. A., & Zilberstein, S. (2001). LAO*:
@@ -67,29 +112,46 @@ class LAOStar(Plans):
         self.randomize_nextstate_order = randomize_nextstate_order
         self.seed = seed
         self.event_listener_class = event_listener_class
+        assert dynamic_programming_method in ExplicitStateGraph.DYNAMIC_PROGRAMMING_METHODS, \
+            f"dynamic_programming_method must be one of {ExplicitStateGraph.DYNAMIC_PROGRAMMING_METHODS}"
+        self.dynamic_programming_method = dynamic_programming_method
+        self.dynamic_programming_tolerance = dynamic_programming_tolerance
+        assert expansions_per_iteration == "all" or \
+            (isinstance(expansions_per_iteration, int) and expansions_per_iteration >= 1), \
+            "expansions_per_iteration must be a positive integer or 'all'"
+        self.expansions_per_iteration = expansions_per_iteration
+        self.max_convergence_sweeps = max_convergence_sweeps
 
     def plan_on(self, mdp: MarkovDecisionProcess) -> PlanningResult:
+        instrumentation = self.instrumentation
         if self.event_listener_class is not None:
             self._event_listener = self.event_listener_class()
         else:
             self._event_listener = None
-        explicit_graph, iterations = self._run_lao_star(mdp)
-        solution_graph = explicit_graph.solution_graph()
-        if not solution_graph.is_solved():
-            warnings.warn(f"LAO* not converged after {self.max_lao_star_iterations} iterations")
-
-        return PlanningResult(
-            policy=self._create_policy(solution_graph, mdp),
-            explicit_graph=explicit_graph,
-            converged=solution_graph.is_solved(),
-            solution_graph=solution_graph,
-            iterations=iterations,
-            state_value_map=explicit_graph.state_value_map(),
-            initial_value=explicit_graph.initial_value(),
-            event_listener=self._event_listener
-        )
+        with instrumentation.phase("solve", mdp) as model:
+            explicit_graph, iterations, values_converged = self._run_lao_star(model)
+        with instrumentation.phase("result"):
+            # the explicit graph is returned, so it keeps the
+            # MDP that was given rather than the one used to solve it
+            explicit_graph.mdp = mdp
+            solution_graph = explicit_graph.solution_graph()
+            converged = values_converged and solution_graph.is_solved()
+            if values_converged and not converged:
+                warnings.warn(f"LAO* not converged after {self.max_lao_star_iterations} iterations")
+
+            return PlanningResult(
+                policy=self._create_policy(solution_graph, mdp),
+                explicit_graph=explicit_graph,
+                converged=converged,
+                solution_graph=solution_graph,
+                iterations=iterations,
+                state_value_map=explicit_graph.state_value_map(),
+                initial_value=explicit_graph.initial_value(),
+                event_listener=self._event_listener
+            )
 
     def _run_lao_star(self, mdp):
+        instrumentation = self.instrumentation
         rng = random.Random(self.seed)
         explicit_graph = ExplicitStateGraph(
             mdp=mdp,
@@ -98,19 +160,48 @@ class LAOStar(Plans):
             randomize_nextstate_order=self.randomize_nextstate_order,
             rng=rng,
             dynamic_programming_iterations=self.dynamic_programming_iterations,
+            dynamic_programming_method=self.dynamic_programming_method,
+            dynamic_programming_tolerance=self.dynamic_programming_tolerance,
         )
+        solution_graph = explicit_graph.solution_graph()
+        k = None if self.expansions_per_iteration == "all" else self.expansions_per_iteration
+        n_expansions, n_revised = 0, 0
+        values_converged = True
         for i in range(self.max_lao_star_iterations):
-            solution_graph = explicit_graph.solution_graph()
-            if solution_graph.is_solved():
+            expand_states = solution_graph.best_tip_states(k)
+            if len(expand_states) == 0 and self.dynamic_programming_method == "value_iteration":
+                # values were only partially revised, so they are
+                # revised to convergence before terminating
+                values_converged = explicit_graph.converge_values(
+                    list(solution_graph.states_to_nodes.values()),
+                    self.max_convergence_sweeps
+                )
+                if not values_converged:
+                    warnings.warn(f"LAO* value iteration not converged after {self.max_convergence_sweeps} sweeps")
+                    break
+                solution_graph.update(expanded_states=())
+                expand_states = solution_graph.best_tip_states(k)
+            if len(expand_states) == 0:
                 break
-            expand_states = [solution_graph.best_breadth_first_tip_state(), ]
             for s in expand_states:
                 explicit_graph.expand_at(s)
             ancestors = explicit_graph.revise_value_from(expand_states)
-
+            solution_graph.update(expanded_states=expand_states)
+            n_expansions += len(expand_states)
+            n_revised += len(ancestors)
+
+            if instrumentation.enabled:
+                instrumentation.iteration(LAOStarIteration(
+                    iteration=i,
+                    expanded_states=len(expand_states),
+                    revised_states=len(ancestors),
+                    solution_graph_size=len(solution_graph._node_ids)
+                ))
             if self._event_listener:
                 self._event_listener.main_lao_star_loop(locals())
-        return explicit_graph, i
+        instrumentation.count("expansions", n_expansions)
+        instrumentation.count("revised_states", n_revised)
+        return explicit_graph, i, values_converged
 
     def _create_policy(self, solution_graph, mdp):
         pi = dict()
@@ -138,7 +229,16 @@ class LAOStarEventListener(ABC):
     def main_lao_star_loop(self, localvars):
         pass
 
+def _reserve(array, size, fill=0):
+    """Returns `array`, or a copy at least twice as large if it holds fewer than `size` items."""
+    if size <= len(array):
+        return array
+    new = np.full(max(size, 2*len(array)), fill, dtype=array.dtype)
+    new[:len(array)] = array
+    return new
+
 class ExplicitStateGraph:
+    DYNAMIC_PROGRAMMING_METHODS = ("policy_iteration", "value_iteration")
     def __init__(
         self,
         mdp,
@@ -147,16 +247,60 @@ class ExplicitStateGraph:
         randomize_nextstate_order,
         rng=random,
         dynamic_programming_iterations=100,
+        dynamic_programming_method="policy_iteration",
+        dynamic_programming_tolerance=1e-10,
     ):
+        """
+        The explicit graph of states that LAO* has visited.
+
+        Nodes are identified by their `visitorder`. Besides a node for
+        each state, the graph keeps an edge store that grows as states are
+        expanded: each expanded node has a contiguous block of rows (one
+        per action, in its action order), and each row a contiguous block
+        of edges (next node, probability, reward). The parents of each node
+        are kept in a linked list of links holding the parent and a bitmask
+        of the parent's actions (by index) that can lead to the node.
+        Dynamic programming is done over sparse matrices gathered from
+        the store, so it never calls the MDP.
+        """
+        assert dynamic_programming_method in self.DYNAMIC_PROGRAMMING_METHODS
         self.mdp = mdp
         self.heuristic = heuristic
         self.rng = rng
         self.n_expanded = 0
 
         self.dynamic_programming_iterations = dynamic_programming_iterations
+        self.dynamic_programming_method = dynamic_programming_method
+        self.dynamic_programming_tolerance = dynamic_programming_tolerance
         self.randomize_action_order = randomize_action_order
         self.randomize_nextstate_order = randomize_nextstate_order
 
+        # per node
+        self._nodes = []
+        self._values = np.zeros(64)
+        self._terminal = np.zeros(64, dtype=bool)
+        self._first_row = np.zeros(64, dtype=int)
+        self._n_rows = np.zeros(64, dtype=int)
+        self._first_parent_link = array('q')
+        # scratch space mapping node ids to positions in a subgraph
+        self._subgraph_index = np.full(64, -1)
+        # per row
+        self.n_rows = 0
+        self._first_edge = np.zeros(65, dtype=int)
+        # per edge
+        self.n_edges = 0
+        self._edge_nextnodes = np.zeros(64, dtype=int)
+        self._edge_probs = np.zeros(64)
+        self._edge_rewards = np.zeros(64)
+        # per parent link
+        self._parent_link_parents = array('q')
+        self._parent_link_next = array('q')
+        self._parent_link_actions = []
+
+        # states whose optimal action changed since the last
+        # `SolutionGraph.update`
+        self.policy_changed_states = set()
+
         self.states_to_nodes = {}
         self.initial_states = sorted(mdp.initial_state_dist().support, key=lambda s: self.rng.random())
         for s in self.initial_states:
@@ -166,12 +310,12 @@ class ExplicitStateGraph:
 
     def states_by_visitorder(self):
         states = list(self.states_to_nodes.keys())
-        order = sorted(states, key=lambda s: self.states_to_nodes[s]['visitorder'])
+        order = sorted(states, key=lambda s: self.states_to_nodes[s].visitorder)
         return order
 
     def states_by_expandedorder(self):
-        states = [s for s, n in self.states_to_nodes.items() if n['expanded']]
-        order = sorted(states, key=lambda s: self.states_to_nodes[s]['expandedorder'])
+        states = [s for s, n in self.states_to_nodes.items() if n.expanded]
+        order = sorted(states, key=lambda s: self.states_to_nodes[s].expandedorder)
         return order
 
     def solution_graph(self):
@@ -207,25 +351,98 @@ class ExplicitStateGraph:
         assert id(self.states_to_nodes[node.state]) == id(node), "Node needs to be inside the explicit graph"
         assert not node.expanded
         assert node.expandedorder == -1
+        if len(set(node.action_order)) != len(node.action_order):
+            raise SpecificationException(f"Duplicate actions in state {state}: {node.action_order}")
         node.expanded = True
         node.expandedorder = self.n_expanded
         self.n_expanded += 1
         s = state
+        terminal = self._terminal[node.visitorder]
+        nextnodes, probs, rewards, row_sizes = [], [], [], []
         for a in node.action_order:
-            if len(node.action_nextstates[a]) != 0:
-                if len(set(node.action_order)) != len(node.action_order):
-                    raise SpecificationException(f"Duplicate actions in state {s}: {node.action_order}")
-                raise AlgorithmException("Unexpanded nodes should not have next states explored")
-            action_nextstates = list(self.mdp.next_state_dist(s, a).support)
+            next_state_dist = self.mdp.next_state_dist(s, a)
+            action_nextstates = list(next_state_dist.support)
             if self.randomize_nextstate_order:
                 action_nextstates = sorted(action_nextstates, key = lambda _ : self.rng.random())
             for ns in action_nextstates:
                 if ns not in self.states_to_nodes:
-                    nextnode = self._initialize_node(ns, parent_node=node)
+                    nextnode = self._initialize_node(ns)
                 else:
                     nextnode = self.states_to_nodes[ns]
-                    nextnode.parent_states.add(node.state)
-                node.action_nextstates[a].append(nextnode.state)
+                nextnodes.append(nextnode.visitorder)
+                probs.append(next_state_dist.prob(ns))
+                # terminal nodes have no rewards
+                rewards.append(0 if terminal else self.mdp.reward(s, a, ns))
+            row_sizes.append(len(action_nextstates))
+        self._add_rows(node.visitorder, nextnodes, probs, rewards, row_sizes)
+        child_actions = {}
+        row_ends = np.cumsum(row_sizes)
+        for action_index, (start, end) in enumerate(zip(row_ends - row_sizes, row_ends)):
+            for child_id in nextnodes[start:end]:
+                child_actions[child_id] = child_actions.get(child_id, 0) | (1 << action_index)
+        for child_id, actions in child_actions.items():
+            self._add_parent_link(child_id, node.visitorder, actions)
+
+    def _add_rows(self, node_id, nextnodes, probs, rewards, row_sizes):
+        r0, r1 = self.n_rows, self.n_rows + len(row_sizes)
+        e0, e1 = self.n_edges, self.n_edges + len(nextnodes)
+        self._first_edge = _reserve(self._first_edge, r1 + 1)
+        self._edge_nextnodes = _reserve(self._edge_nextnodes, e1)
+        self._edge_probs = _reserve(self._edge_probs, e1)
+        self._edge_rewards = _reserve(self._edge_rewards, e1)
+        self._first_edge[r0 + 1:r1 + 1] = e0 + np.cumsum(row_sizes, dtype=int)
+        self._edge_nextnodes[e0:e1] = nextnodes
+        self._edge_probs[e0:e1] = probs
+        self._edge_rewards[e0:e1] = rewards
+        self._first_row[node_id] = r0
+        self._n_rows[node_id] = len(row_sizes)
+        self.n_rows, self.n_edges = r1, e1
+
+    def _add_parent_link(self, node_id, parent_id, actions):
+        link = len(self._parent_link_parents)
+        self._parent_link_parents.append(parent_id)
+        self._parent_link_actions.append(actions)
+        self._parent_link_next.append(self._first_parent_link[node_id])
+        self._first_parent_link[node_id] = link
+
+    def _parent_ids(self, node_id):
+        link = self._first_parent_link[node_id]
+        while link >= 0:
+            yield self._parent_link_parents[link]
+            link = self._parent_link_next[link]
+
+    def _valid_parent_ids(self, node_id):
+        """Parents whose optimal action can lead to a node"""
+        nodes = self._nodes
+        parents, actions, next_link = self._parent_link_parents, self._parent_link_actions, self._parent_link_next
+        link = self._first_parent_link[node_id]
+        while link >= 0:
+            parent_id = parents[link]
+            if (actions[link] >> nodes[parent_id].optimal_action_index) & 1:
+                yield parent_id
+            link = next_link[link]
+
+    def _successor_ids(self, node_id, action_index):
+        row = self._first_row[node_id] + action_index
+        return self._edge_nextnodes[self._first_edge[row]:self._first_edge[row + 1]].tolist()
+
+    def parent_states(self, state):
+        """States that have been expanded and have `state` as a successor"""
+        node_id = self.states_to_nodes[state].visitorder
+        return [self._nodes[i].state for i in self._parent_ids(node_id)]
+
+    def next_states(self, state, action=None):
+        """
+        The successors of an expanded state under an action
+        (by default, its optimal action)
+        """
+        node = self.states_to_nodes[state]
+        assert node.expanded
+        if action is None:
+            action_index = node.optimal_action_index
+        else:
+            action_index = node.action_order.index(action)
+        return [self._nodes[i].state for i in self._successor_ids(node.visitorder, action_index)]
 
     def revise_value_from(self, states):
         """
@@ -250,170 +467,351 @@ class ExplicitStateGraph:
         """
         if ancestors is None:
             ancestors = {}
-        frontier = [node,]
+        frontier = [node.visitorder,]
+        seen = {n.visitorder for n in ancestors.values()}
+        seen.add(node.visitorder)
         while frontier:
-            n = frontier.pop()
+            node_id = frontier.pop()
+            n = self._nodes[node_id]
             ancestors[n.state] = n
-            for parent_state in n.parent_states:
-                if parent_state in ancestors:
-                    continue
-                parent_node = self.states_to_nodes[parent_state]
-                parent_nextstates = parent_node.action_nextstates[parent_node.optimal_action]
-                if n.state in parent_nextstates:
-                    frontier.append(parent_node)
+            for parent_id in self._valid_parent_ids(node_id):
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    frontier.append(parent_id)
+        return ancestors
 
     def dynamic_programming(self, nodes):
-        """Perform dynamic programming updates over a set of nodes"""
-        dp_action_order = list(set.union(*[set(n.action_order) for n in nodes]))
-        tf, rf, am = self._state_nodes_to_matrices(nodes, dp_action_order)
-        pi, v, q = self._policy_iteration(tf, rf, am)
+        """
+        Perform dynamic programming updates over a set of nodes,
+        holding the values of all other nodes fixed. Non-terminal
+        nodes need to be expanded. Returns the largest change in
+        value during the last value iteration sweep (or 0 for
+        policy iteration).
+        """
+        subgraph = self._subgraph(nodes)
+        if self.dynamic_programming_method == "policy_iteration":
+            v, q = self._policy_iteration(subgraph)
+            residual = 0.
+        else:
+            v, q, residual = self._value_iteration(subgraph, self.dynamic_programming_iterations)
+        self._update_nodes(nodes, subgraph, v, q)
+        return residual
 
-        for si, node in enumerate(nodes):
-            assert id(self.states_to_nodes[node.state]) == id(node)
-            assert np.isclose(pi[si, :].sum(), 1)
-            action_vals = {a: v for a, v in zip(dp_action_order, q[si, :])}
-            optimal_action = max(node.action_order, key=lambda a: action_vals[a])
-            node.optimal_action = optimal_action
-            node.value = v[si]
+    def converge_values(self, nodes, max_sweeps):
+        """
+        Run value iteration over a set of nodes until it converges,
+        for at most `max_sweeps` sweeps. Returns whether it converged.
+        """
+        subgraph = self._subgraph(nodes)
+        residual = float('inf')
+        sweeps = 0
+        while residual >= self.dynamic_programming_tolerance:
+            if sweeps >= max_sweeps:
+                return False
+            iterations = min(self.dynamic_programming_iterations, max_sweeps - sweeps)
+            v, q, residual = self._value_iteration(subgraph, iterations)
+            self._update_nodes(nodes, subgraph, v, q)
+            subgraph.values = v
+            sweeps += iterations
+        return True
+
+    def _subgraph(self, nodes):
+        """
+        Gathers the rows of a set of nodes from the edge store into
+        a sparse system where the Q-values of the rows are
+        `const + transitions @ v` for the values `v` of the nodes.
+        Edges to nodes outside the set contribute to `const`
+        using their current values.
+        """
+        ids = np.array([n.visitorder for n in nodes], dtype=int)
+        unexpanded = [n.state for n in nodes if not (n.expanded or self._terminal[n.visitorder])]
+        assert len(unexpanded) == 0, f"Non-terminal nodes need to be expanded: {unexpanded}"
+        n_rows = np.where(self._terminal[ids], 0, self._n_rows[ids])
+        row_node = np.repeat(np.arange(len(ids)), n_rows)
+        first_row = np.cumsum(n_rows) - n_rows
+        rows = self._first_row[ids][row_node] + (np.arange(len(row_node)) - first_row[row_node])
+
+        edges_per_row = self._first_edge[rows + 1] - self._first_edge[rows]
+        edge_row = np.repeat(np.arange(len(rows)), edges_per_row)
+        edges = np.repeat(self._first_edge[rows] - (np.cumsum(edges_per_row) - edges_per_row), edges_per_row) + \
+            np.arange(edges_per_row.sum())
+        nextnodes = self._edge_nextnodes[edges]
+        probs = self._edge_probs[edges]
+        rewards = self._edge_rewards[edges]
+
+        self._subgraph_index[ids] = np.arange(len(ids))
+        local = self._subgraph_index[nextnodes]
+        self._subgraph_index[ids] = -1
+        inside = local >= 0
+
+        # terminal nodes have no future value
+        outside_values = np.where(self._terminal[nextnodes], 0., self._values[nextnodes])
+        future = np.where(inside, 0., self.mdp.discount_rate*outside_values)
+        const = np.bincount(edge_row, weights=probs*(rewards + future), minlength=len(rows))
+        transitions = scipy.sparse.csr_matrix(
+            (self.mdp.discount_rate*probs[inside], (edge_row[inside], local[inside])),
+            shape=(len(rows), len(ids))
+        )
+        has_rows = n_rows > 0
+        return _Subgraph(
+            ids=ids,
+            n_rows=n_rows,
+            row_node=row_node,
+            first_row=first_row,
+            has_rows=has_rows,
+            const=const,
+            transitions=transitions,
+            values=np.where(self._terminal[ids], 0., self._values[ids]),
+        )
 
-    def _policy_iteration(self, tf, rf, am):
-        pi = am/am.sum(-1, keepdims=True)
-        assert (am.sum(-1) > 0).all()
+    def _greedy(self, subgraph, q):
+        """First maximizing row of each node with rows."""
+        best_row = np.full(len(subgraph.ids), -1)
+        if len(q) == 0:
+            return best_row, np.zeros(len(subgraph.ids))
+        v = np.zeros(len(subgraph.ids))
+        v[subgraph.has_rows] = np.maximum.reduceat(q, subgraph.first_row[subgraph.has_rows])
+        is_max = np.flatnonzero(q == v[subgraph.row_node])
+        nodes_with_max, first_max = np.unique(subgraph.row_node[is_max], return_index=True)
+        best_row[nodes_with_max] = is_max[first_max]
+        return best_row, v
+
+    def _policy_iteration(self, subgraph):
+        n_nodes = len(subgraph.ids)
+        # start from the uniform policy over each node's actions
+        row_weights = 1/subgraph.n_rows[subgraph.row_node]
+        identity = scipy.sparse.identity(n_nodes, format='csc')
         for i in range(self.dynamic_programming_iterations):
-            s_rf = np.einsum("sa,san,san->s", pi, tf, rf) # state rewards
-            mp = np.einsum("sa,san->sn", pi, tf) # policy markov chain
-            v = np.linalg.solve(np.eye(tf.shape[0]) - self.mdp.discount_rate * mp, s_rf) # state value
-            q = rf[:, :, :] + self.mdp.discount_rate * v[None, None, :]
-            q = np.einsum("san,san->sa", tf, q)
+            policy = scipy.sparse.csr_matrix(
+                (row_weights, (subgraph.row_node, np.arange(len(subgraph.row_node)))),
+                shape=(n_nodes, len(subgraph.row_node))
+            )
+            s_rf = policy @ subgraph.const
+            mp = policy @ subgraph.transitions
+            v = np.atleast_1d(scipy.sparse.linalg.spsolve((identity - mp).tocsc(), s_rf))
+            q = subgraph.const + subgraph.transitions @ v
             q = np.around(q, decimals=self.VALUE_DECIMAL_PRECISION)
 
-            # Calculate the new policy, taking into account
-            # the "infinite" cost of unavailable actions.
-            new_pi = np.zeros_like(pi)
-            np.put_along_axis(new_pi, (q + np.log(am)).argmax(axis=1)[:, None], values=1, axis=1)
+            best_row, _ = self._greedy(subgraph, q)
+            new_row_weights = np.zeros_like(row_weights)
+            new_row_weights[best_row[subgraph.has_rows]] = 1
 
             # Check convergence
-            converged = (new_pi == pi).all()
+            converged = (new_row_weights == row_weights).all()
             if converged:
                 break
-            pi = new_pi
+            row_weights = new_row_weights
         assert converged
-        return pi, v, q
+        return v, q
+
+    def _value_iteration(self, subgraph, iterations):
+        v = subgraph.values
+        residual = float('inf')
+        for i in range(iterations):
+            q = subgraph.const + subgraph.transitions @ v
+            _, nv = self._greedy(subgraph, q)
+            residual = np.abs(nv - v).max(initial=0)
+            v = nv
+            if residual < self.dynamic_programming_tolerance:
+                break
+        q = subgraph.const + subgraph.transitions @ v
+        q = np.around(q, decimals=self.VALUE_DECIMAL_PRECISION)
+        return v, q, residual
 
-    def _state_nodes_to_matrices(self, state_nodes, actions):
-        """
-        Convert a collection of state nodes into valid
-        transition and reward matrix representing the
-        subgraph.
-        """
-        assert isinstance(state_nodes, list)
-        n_states = len(state_nodes)
-        n_actions = len(actions)
-        state_index = {n.state: i for i, n in enumerate(state_nodes)}
-        action_index = {a: i for i, a in enumerate(actions)}
-        tf = np.zeros((n_states + 1, n_actions, n_states + 1))
-        am = np.zeros((n_states + 1, n_actions))
-        am[-1, :] = 1
-        rf = np.zeros((n_states + 1, n_actions, n_states + 1))
-        for node in state_nodes:
-            s = node.state
-            si = state_index[s]
-            if self.mdp.is_terminal(s):
-                tf[si, :, -1] = 1
-                am[si, :] = 1
-                continue
-            for a in self.mdp.actions(s):
-                ai = action_index[a]
-                am[si, ai] = 1
-                for ns, prob in self.mdp.next_state_dist(s, a).items():
-                    reward = self.mdp.reward(s, a, ns)
-                    if ns in state_index:
-                        nsi = state_index[ns]
-                        tf[si, ai, nsi] = prob
-                        rf[si, ai, nsi] = reward
-                    else:
-                        tf[si, ai, -1] += prob
-                        # If the next state is a real terminal state, future expected value is 0.
-                        # Otherwise, if the next state is simply not in the subgraph,
-                        # we treat it as a pseudo-terminal and add in the next state value.
-                        # Also, the pseudo-terminal reward is a probability weighted sum
-                        # of the rewards and needs to be renormalized by the total
-                        # probability of entering the pseudo-terminal state (see below).
-                        if self.mdp.is_terminal(ns):
-                            rf[si, ai, -1] += prob*reward
-                        else:
-                            rf[si, ai, -1] += prob*(reward + self.mdp.discount_rate*self.states_to_nodes[ns].value)
-                # Renormalize weighted and summed pseudo-terminal rewards
-                # by dividing by the *total* probability of entering the pseudo-terminal state
-                if tf[si, ai, -1] > 0:
-                    rf[si, ai, -1] /= tf[si, ai, -1]
-
-        assert np.isclose(tf[:-1].sum(-1)[am[:-1].astype(bool)], 1).all(), "Non-terminal valid action transitions need to sum to 1.0"
-        assert (rf[-1, :, :] == 0).all(), "Terminal to terminal rewards must be 0"
-        return tf, rf, am
-
-    def _initialize_node(self, s, parent_node=None):
+    def _update_nodes(self, nodes, subgraph, v, q):
+        best_row, _ = self._greedy(subgraph, q)
+        for si, node in enumerate(nodes):
+            assert id(self.states_to_nodes[node.state]) == id(node)
+            # all actions of terminal nodes have value 0
+            optimal_action_index = best_row[si] - subgraph.first_row[si] if best_row[si] >= 0 else 0
+            if optimal_action_index != node.optimal_action_index:
+                node.optimal_action_index = int(optimal_action_index)
+                node.optimal_action = node.action_order[optimal_action_index]
+                self.policy_changed_states.add(node.state)
+            node.value = v[si]
+        self._values[subgraph.ids] = v
+
+    def _initialize_node(self, s):
         assert s not in self.states_to_nodes
         if self.randomize_action_order:
             action_order = sorted(self.mdp.actions(s), key=lambda a : self.rng.random())
         else:
             action_order = self.mdp.actions(s)
+        node_id = len(self.states_to_nodes)
         self.states_to_nodes[s] = Node(
             state=s,
             value=self.heuristic(s),
             action_order=action_order,
             optimal_action=action_order[0],
+            optimal_action_index=0,
             expanded=False,
             expandedorder=-1,
-            visitorder=len(self.states_to_nodes),
-            parent_states=set([]) if parent_node is None else {parent_node.state},
-            action_nextstates={a : [] for a in self.mdp.actions(s)}
+            visitorder=node_id,
         )
+        self._nodes.append(self.states_to_nodes[s])
+        self._values = _reserve(self._values, node_id + 1)
+        self._terminal = _reserve(self._terminal, node_id + 1)
+        self._first_row = _reserve(self._first_row, node_id + 1)
+        self._n_rows = _reserve(self._n_rows, node_id + 1)
+        self._first_parent_link.append(-1)
+        self._subgraph_index = _reserve(self._subgraph_index, node_id + 1, fill=-1)
+        self._values[node_id] = self.states_to_nodes[s].value
+        self._terminal[node_id] = self.mdp.is_terminal(s)
         return self.states_to_nodes[s]
 
+class _Subgraph:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
 class SolutionGraph:
     def __init__(self, explicit_graph):
-        self.states_to_nodes = {}
-        self.nonterminal_tip_states = []
-        for s0 in explicit_graph.initial_states:
-            frontier = [s0, ]
-            while frontier:
-                s = frontier.pop()
-                if s in self.states_to_nodes:
+        """
+        The states reachable from the initial states of an explicit graph
+        by following the optimal actions of expanded nodes. Tip states are
+        the unexpanded ones.
+
+        LAO* keeps one solution graph up to date with `update` instead of
+        rebuilding it every iteration. Since dropping edges would require
+        traversing the graph, an updated solution graph may also contain
+        states that are no longer reachable. Tip states are checked to be
+        reachable when they are selected (see `best_tip_states`), and the
+        graph is rebuilt once it has doubled in size.
+        """
+        self.explicit_graph = explicit_graph
+        self.rebuild()
+
+    @property
+    def states_to_nodes(self):
+        nodes = self.explicit_graph._nodes
+        return {nodes[i].state: nodes[i] for i in self._node_ids}
+
+    @property
+    def nonterminal_tip_states(self):
+        nodes = self.explicit_graph._nodes
+        return [nodes[i].state for i in self._tip_ids]
+
+    def rebuild(self):
+        """Build the solution graph from the initial states"""
+        self._node_ids = set()
+        self._tip_ids = {}
+        self._tip_heap = []
+        self.explicit_graph.policy_changed_states.clear()
+        self._initial_ids = {self.explicit_graph.states_to_nodes[s].visitorder for s in self.explicit_graph.initial_states}
+        self._add_from(self._initial_ids)
+        self._rebuilt_size = len(self._node_ids)
+
+    def update(self, expanded_states):
+        """
+        Update the solution graph after `expanded_states` were expanded
+        and values were revised, by adding the successors of expanded tip
+        states and of states whose optimal action changed.
+        """
+        graph = self.explicit_graph
+        frontier = []
+        for s in expanded_states:
+            node = graph.states_to_nodes[s]
+            if self._tip_ids.pop(node.visitorder, False) is None:
+                frontier.extend(graph._successor_ids(node.visitorder, node.optimal_action_index))
+        for s in graph.policy_changed_states:
+            node = graph.states_to_nodes[s]
+            if node.visitorder in self._node_ids and node.expanded:
+                frontier.extend(graph._successor_ids(node.visitorder, node.optimal_action_index))
+        graph.policy_changed_states.clear()
+        self._add_from(frontier)
+        if len(self._node_ids) > 2*max(self._rebuilt_size, 64):
+            self.rebuild()
+
+    def _add_from(self, frontier):
+        graph = self.explicit_graph
+        frontier = list(frontier)
+        while frontier:
+            node_id = frontier.pop()
+            if node_id in self._node_ids:
+                continue
+            self._node_ids.add(node_id)
+            node = graph._nodes[node_id]
+            if node.expanded:
+                frontier.extend(graph._successor_ids(node_id, node.optimal_action_index))
+            else:
+                self._tip_ids[node_id] = None
+                heapq.heappush(self._tip_heap, (-node.value, node_id))
+
+    def _is_reachable(self, node_id, reachable):
+        """
+        Search backwards from a node through the parents whose optimal
+        action leads to it. Nodes found to be reachable are added to
+        `reachable`; if `node_id` is not, it is removed along with the
+        nodes searched, none of which are reachable either.
+        """
+        graph = self.explicit_graph
+        came_from = {node_id: None}
+        frontier = [node_id]
+        while frontier:
+            i = frontier.pop()
+            if i in reachable:
+                while i is not None:
+                    reachable.add(i)
+                    i = came_from[i]
+                return True
+            for parent_id in graph._valid_parent_ids(i):
+                if parent_id in came_from or parent_id not in self._node_ids:
                     continue
-                node = explicit_graph.states_to_nodes[s]
-                self.states_to_nodes[s] = node
-                if node.expanded:
-                    nextstates = node.action_nextstates[node.optimal_action]
-                    frontier.extend(nextstates)
-                else:
-                    self.nonterminal_tip_states.append(node.state)
+                came_from[parent_id] = i
+                frontier.append(parent_id)
+        for i in came_from:
+            self._node_ids.discard(i)
+            self._tip_ids.pop(i, None)
+        return False
 
     def is_solved(self):
-        return len(self.nonterminal_tip_states) == 0
+        reachable = set(self._initial_ids)
+        for i in list(self._tip_ids):
+            if i in self._tip_ids and self._is_reachable(i, reachable):
+                return False
+        return True
+
+    def best_tip_states(self, k=None):
+        """
+        Return the `k` tip states (or all of them if `k` is None)
+        with the highest values, breaking ties by the order
+        they were initialized in.
+        """
+        nodes = self.explicit_graph._nodes
+        reachable = set(self._initial_ids)
+        if k is None:
+            tips = [i for i in list(self._tip_ids) if i in self._tip_ids and self._is_reachable(i, reachable)]
+            tips = sorted(tips, key=lambda i: (-nodes[i].value, i))
+            return [nodes[i].state for i in tips]
+        selected = []
+        while self._tip_heap and len(selected) < k:
+            entry = heapq.heappop(self._tip_heap)
+            neg_value, i = entry
+            if i not in self._tip_ids or (selected and selected[-1][1] == i):
+                continue
+            if -neg_value != nodes[i].value:
+                heapq.heappush(self._tip_heap, (-nodes[i].value, i))
+                continue
+            if self._is_reachable(i, reachable):
+                selected.append(entry)
+        for entry in selected:
+            heapq.heappush(self._tip_heap, entry)
+        return [nodes[i].state for _, i in selected]
 
     def best_breadth_first_tip_state(self):
         """
         Return the tip state with the highest value
         and was initialized earliest.
         """
-        max_val = -float('inf')
-        min_visit = float('inf')
-        for s in self.nonterminal_tip_states:
-            n = self.states_to_nodes[s]
-            if n.value > max_val:
-                best_node = n
-                min_visit = n.visitorder
-                max_val = n.value
-            elif n.value == max_val and n.visitorder < min_visit:
-                best_node = n
-                min_visit = n.visitorder
-                max_val = n.value
-        assert best_node.value == max_val
-        assert best_node.visitorder == min_visit
-        return best_node.state
-
-class Node(dict):
-    __getattr__ = dict.get
-    __setattr__ = dict.__setitem__
-    __delattr__ = dict.__delitem__
+        return self.best_tip_states(1)[0]
+
+class Node:
+    __slots__ = (
+        "state", "value", "action_order", "optimal_action", "optimal_action_index",
+        "expanded", "expandedorder", "visitorder",
+    )
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return f"Node({', '.join(f'{k}={repr(getattr(self, k))}' for k in self.__slots__)})"
@@ -1,14 +1,19 @@
 import random
 import copy
 import warnings
-from collections import defaultdict
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+import numpy as np
 from abc import ABC, abstractmethod
 from typing import Callable
 from msdm.core.utils.dictutils import defaultdict2
 from msdm.core.distributions import DictDistribution
 from msdm.core.problemclasses.mdp import MarkovDecisionProcess, TabularPolicy, HashableState
+from msdm.core.problemclasses.mdp.batchsimulator import row_cumulative_probabilities, search_rows
 from msdm.core.algorithmclasses import Plans, PlanningResult
 
+LRTDPTrial = namedtuple("LRTDPTrial", "trial length bellman_backups")
+
 class LRTDP(Plans):
     def __init__(self,
                  heuristic : Callable[[HashableState], float],
@@ -17,7 +22,9 @@ class LRTDP(Plans):
                  randomize_action_order : bool=False,
                  max_trial_length : int=None,
                  event_listener_class : "LRTDPEventListener"=None,
-                 seed=None
+                 seed=None,
+                 indexed : bool=False,
+                 trials_per_batch : int=None
                  ):
         """
         Labeled Real-Time Dynamic Programming (Bonet & Geffner 2003).
@@ -49,6 +56,30 @@ class LRTDP(Plans):
         seed : int
             Random seed
 
+        indexed : bool
+            False by default. If set to True, states are interned to
+            integer indices when first visited, and the successors of
+            each state (next state indices, probabilities, and rewards)
+            are queried from the MDP once and cached as arrays (see
+            `IndexedSuccessors`). Values and labels are stored in NumPy
+            arrays, and each backup computes the Q-values of a state once
+            for both its greedy action and its residual. Event listeners
+            then see state indices rather than states.
+
+        trials_per_batch : int
+            If set, trials are run this many at a time in lockstep on
+            a shared indexed value table (this implies `indexed`): at each
+            step, the current states of all running trials are backed up
+            together and their next states sampled together. As each trial
+            ends, its states are checked and labeled as in a sequential
+            trial. Event listeners are not called in this mode.
+
+        The result's `iterations` is the number of trials that were run.
+        If `instrumentation` is enabled, it receives an `LRTDPTrial`
+        with the number of states visited and the Bellman backups
+        made since the previous trial as each trial ends, and the
+        "trials" and "bellman_backups" counters are incremented.
+
         References
         ----------
         Bonet, Blai, and Hector Geffner. "Labeled RTDP:
@@ -70,14 +101,32 @@ class LRTDP(Plans):
             max_trial_length = float('inf')
         self.max_trial_length = max_trial_length
         self.event_listener_class = event_listener_class
+        self.indexed = indexed
+        self.trials_per_batch = trials_per_batch
 
     def plan_on(self, mdp: MarkovDecisionProcess):
+        instrumentation = self.instrumentation
         self._set_up_plan_on()
-        self.lrtdp(
-            mdp, heuristic=self.heuristic, iterations=self.iterations
-        )
-        res = self._tear_down_plan_on(mdp, self.heuristic)
-        return res
+        with instrumentation.phase("solve", mdp) as model:
+            if self.trials_per_batch is not None:
+                self.batched_lrtdp(
+                    model, heuristic=self.heuristic, iterations=self.iterations
+                )
+            elif self.indexed:
+                self.indexed_lrtdp(
+                    model, heuristic=self.heuristic, iterations=self.iterations
+                )
+            else:
+                self.lrtdp(
+                    model, heuristic=self.heuristic, iterations=self.iterations
+                )
+        instrumentation.count("trials", self._trials)
+        instrumentation.count("bellman_backups", self._backups)
+        self.res.iterations = self._trials
+        with instrumentation.phase("result"):
+            if self.trials_per_batch is not None or self.indexed:
+                return self._tear_down_indexed_plan_on(mdp)
+            return self._tear_down_plan_on(mdp, self.heuristic)
 
     def _set_up_plan_on(self):
         self.res = PlanningResult()
@@ -87,6 +136,9 @@ class LRTDP(Plans):
         else:
             self.res.seed = self.seed
         self.rng = random.Random(self.seed)
+        self._trials = 0
+        self._backups = 0
+        self._reported_backups = 0
 
         if self.event_listener_class is not None:
             self.res.event_listener = self.event_listener_class()
@@ -114,6 +166,147 @@ class LRTDP(Plans):
         self.res = None
         return res
 
+    def _tear_down_indexed_plan_on(self, mdp):
+        res = self.res
+        model = self.model
+        res.V = defaultdict2(self.heuristic)
+        res.solved = defaultdict2(lambda s: False)
+        res.Q = defaultdict(lambda : dict())
+        policy = {}
+        for si, s in enumerate(model.states):
+            # states only seen as successors keep their heuristic value
+            if not (model.terminal[si] or model.is_expanded(si)):
+                continue
+            res.V[s] = float(model.V[si])
+            res.solved[s] = bool(model.solved[si])
+            q = model.q_values(si)
+            actions = model.actions[si]
+            res.Q[s] = dict(zip(actions, q.tolist()))
+            if len(actions) > 0:
+                policy[s] = DictDistribution.deterministic(actions[int(np.argmax(q))])
+        res.action_orders = dict(zip(model.states, model.actions))
+        res.policy = DefaultTabularPolicy.with_default(
+            policy_dict=policy,
+            default_generator=lambda s: DictDistribution.uniform(mdp.actions(s))
+        )
+        res.initial_value = sum([res.V[s0]*p for s0, p in mdp.initial_state_dist().items()])
+
+        self.res = None
+        self.model = None
+        return res
+
+    def indexed_lrtdp(self, mdp, heuristic=None, iterations=None):
+        self.model = model = IndexedSuccessors(
+            mdp, heuristic,
+            rng=self.rng if self.randomize_action_order else None
+        )
+        initial_dist = mdp.initial_state_dist()
+        initial_states = [model.intern(s) for s in initial_dist.support]
+        for i in range(iterations):
+            if model.solved[initial_states].all():
+                self.res.converged = True
+                return
+            self.indexed_lrtdp_trial(model.intern(initial_dist.sample(rng=self.rng)))
+        if i == (iterations - 1):
+            warnings.warn(f"LRTDP not converged after {iterations} iterations")
+            self.res.converged = False
+        else:
+            self.res.converged = True
+
+    def indexed_lrtdp_trial(self, s):
+        model = self.model
+        visited = [s, ]
+        while not model.solved[s]:
+            q = model.q_values(s)
+            a = int(np.argmax(q))
+            model.V[s] = q[a]
+            self._backups += 1
+            s = model.sample_next_state(s, a, self.rng)
+            visited.append(s)
+            # Terminal states are interned as solved.
+            if len(visited) > self.max_trial_length:
+                break
+            if self.res.event_listener is not None:
+                self.res.event_listener.end_of_lrtdp_timestep(locals())
+        if self.res.event_listener is not None:
+            self.res.event_listener.end_of_lrtdp_trial(locals())
+        length = len(visited)
+        s = visited.pop()
+        while self._indexed_check_solved(s) and visited:
+            s = visited.pop()
+        self._end_trial(length)
+
+    def batched_lrtdp(self, mdp, heuristic=None, iterations=None):
+        self.model = model = IndexedSuccessors(
+            mdp, heuristic,
+            rng=self.rng if self.randomize_action_order else None
+        )
+        rng = np.random.default_rng(self.res.seed)
+        initial_dist = mdp.initial_state_dist()
+        initial_states = [model.intern(s) for s in initial_dist.support]
+        trials = []
+        n_trials = 0
+        while not model.solved[initial_states].all():
+            while len(trials) < self.trials_per_batch and n_trials < iterations:
+                trials.append([model.intern(initial_dist.sample(rng=self.rng))])
+                n_trials += 1
+            if not trials:
+                warnings.warn(f"LRTDP not converged after {iterations} iterations")
+                self.res.converged = False
+                return
+            current = np.array([visited[-1] for visited in trials])
+            ended = model.solved[current]
+            if self.max_trial_length < float('inf'):
+                ended |= np.array([len(visited) for visited in trials]) > self.max_trial_length
+            if ended.any():
+                # labeling can solve the states that other trials are at,
+                # so the running trials are checked again before stepping
+                for visited in [visited for visited, e in zip(trials, ended) if e]:
+                    length = len(visited)
+                    s = visited.pop()
+                    while self._indexed_check_solved(s) and visited:
+                        s = visited.pop()
+                    self._end_trial(length)
+                trials = [visited for visited, e in zip(trials, ended) if not e]
+                continue
+            actions, values = model.greedy(current)
+            model.V[current] = values
+            self._backups += len(current)
+            next_states = model.sample_next_states(current, actions, rng)
+            for visited, ns in zip(trials, next_states.tolist()):
+                visited.append(ns)
+        self.res.converged = True
+
+    def _indexed_check_solved(self, s):
+        model = self.model
+        V, solved = model.V, model.solved
+        flag = True
+        open = []
+        closed = []
+        seen = {s}
+        if not solved[s]:
+            open.append(s)
+        while open:
+            s = open.pop()
+            closed.append(s)
+            q = model.q_values(s)
+            a = int(np.argmax(q))
+            if abs(V[s] - q[a]) > self.bellman_error_margin:
+                flag = False
+                continue
+            for ns in model.next_states(s, a):
+                if not solved[ns] and ns not in seen:
+                    seen.add(ns)
+                    open.append(ns)
+        if flag:
+            solved[closed] = True
+        else:
+            self._backups += len(closed)
+            while closed:
+                s = closed.pop()
+                V[s] = model.q_values(s).max()
+        return flag
+
     def lrtdp(self, mdp, heuristic=None, iterations=None):
         # Ghallab, Nau, Traverso: Algorithm 6.17
         self.res.V = defaultdict2(heuristic)
@@ -124,6 +317,7 @@ class LRTDP(Plans):
 
         for i in range(iterations):
             if all(self.res.solved[s] for s in mdp.initial_state_dist().support):
+                self.res.converged = True
                 return
             self.lrtdp_trial(mdp, mdp.initial_state_dist().sample(rng=self.rng))
         if i == (iterations - 1):
@@ -136,8 +330,11 @@ class LRTDP(Plans):
         # Ghallab, Nau, Traverso: Algorithm 6.17
         visited = [s, ]
         while not self.res.solved[s]:
-            self._bellman_update(mdp, s)
-            s = mdp.next_state_dist(s, self.policy(mdp, s)).sample(rng=self.rng)
+            # The backed-up value is the greedy action's Q-value, so the
+            # backup and the action taken come from one pass over the actions.
+            a, self.res.V[s] = self._greedy_action_value(mdp, s)
+            self._backups += 1
+            s = mdp.next_state_dist(s, a).sample(rng=self.rng)
             visited.append(s)
 
             # Terminal states are solved.
@@ -149,26 +346,43 @@ class LRTDP(Plans):
                 self.res.event_listener.end_of_lrtdp_timestep(locals())
         if self.res.event_listener is not None:
             self.res.event_listener.end_of_lrtdp_trial(locals())
+        length = len(visited)
         s = visited.pop()
         while self._check_solved(mdp, s) and visited:
             s = visited.pop()
+        self._end_trial(length)
+
+    def _end_trial(self, length):
+        self._trials += 1
+        if self.instrumentation.enabled:
+            self.instrumentation.iteration(LRTDPTrial(
+                trial=self._trials - 1,
+                length=length,
+                bellman_backups=self._backups - self._reported_backups
+            ))
+            self._reported_backups = self._backups
 
     def _check_solved(self, mdp, s):
         # GNT Algorithm 6.18
         flag = True
         open = []
         closed = []
+        # states that have been on `open`, which is
+        # every state on `open` or `closed`
+        seen = {s}
         if not self.res.solved[s]:
             open.append(s)
         while open:
             s = open.pop()
             closed.append(s)
-            residual = self.res.V[s] - self.Q(mdp, s, self.policy(mdp, s))
+            a, q = self._greedy_action_value(mdp, s)
+            residual = self.res.V[s] - q
             if abs(residual) > self.bellman_error_margin:
                 flag = False
             else:
-                for ns in mdp.next_state_dist(s, self.policy(mdp, s)).support:
-                    if not self.res.solved[ns] and ns not in open and ns not in closed:
+                for ns in mdp.next_state_dist(s, a).support:
+                    if not self.res.solved[ns] and ns not in seen:
+                        seen.add(ns)
                         open.append(ns)
         if flag:
             for ns in closed:
@@ -186,6 +400,7 @@ class LRTDP(Plans):
         the residual in _check_solved().
         '''
         self.res.V[s] = max(self.Q(mdp, s, a) for a in mdp.actions(s))
+        self._backups += 1
 
     def Q(self, mdp, s, a):
         if mdp.is_terminal(s):
@@ -198,7 +413,7 @@ class LRTDP(Plans):
             q += prob * (mdp.reward(s, a, ns) + mdp.discount_rate*future)
         return q
 
-    def policy(self, mdp, s):
+    def _action_order(self, mdp, s):
         if s in self.res.action_orders:
             action_list = self.res.action_orders[s]
         else:
@@ -208,7 +423,225 @@ class LRTDP(Plans):
             else:
                 action_list = mdp.actions(s)
             self.res.action_orders[s] = action_list
-        return max(action_list, key=lambda a: self.Q(mdp, s, a))
+        return action_list
+
+    def _greedy_action_value(self, mdp, s):
+        """
+        The greedy action at a state and its Q-value. Ties are
+        broken in favor of the action that comes first.
+        """
+        best_a, best_q = None, None
+        for a in self._action_order(mdp, s):
+            q = self.Q(mdp, s, a)
+            if best_q is None or q > best_q:
+                best_a, best_q = a, q
+        if best_q is None:
+            raise ValueError(f"No actions available at state {s}")
+        return best_a, best_q
+
+    def policy(self, mdp, s):
+        return self._greedy_action_value(mdp, s)[0]
+
+class IndexedSuccessors:
+    def __init__(self, mdp : MarkovDecisionProcess, heuristic, rng=None, capacity=1024):
+        """
+        Interns the states of an MDP to integer indices as they are
+        encountered and caches their successors as arrays, so that
+        backups do not call the MDP. Values (initialized by `heuristic`,
+        and fixed at 0 for terminal states) and solved labels
+        (True for terminal states) are stored in NumPy arrays that
+        grow as states are added.
+
+        The successors of all expanded states are stored together:
+        each state has a contiguous block of rows, one per action, and
+        each row a contiguous block of entries, one per next state. This
+        lets the Q-values of many states be computed at once (see `greedy`).
+
+        If `rng` is given, each state's actions are shuffled
+        with it when the state is expanded.
+        """
+        self.mdp = mdp
+        self.heuristic = heuristic
+        self.rng = rng
+        self.discount_rate = mdp.discount_rate
+        self.states = []
+        self.index = {}
+        self.actions = []
+        # per state
+        self.V = np.zeros(capacity)
+        self.solved = np.zeros(capacity, dtype=bool)
+        self.terminal = np.zeros(capacity, dtype=bool)
+        self._first_row = np.zeros(capacity, dtype=int)
+        self._n_rows = np.full(capacity, -1)
+        # per row (state-action)
+        self.n_rows = 0
+        self._first_entry = np.zeros(capacity + 1, dtype=int)
+        self._row_total = np.zeros(capacity)
+        # per entry (state-action-next state); `_cumulative` accumulates
+        # probabilities within each row
+        self.n_entries = 0
+        self._next_states = np.zeros(capacity, dtype=int)
+        self._probs = np.zeros(capacity)
+        self._rewards = np.zeros(capacity)
+        self._cumulative = np.zeros(capacity)
+
+    @property
+    def n_states(self):
+        return len(self.states)
+
+    @staticmethod
+    def _reserve(array, size, fill=0):
+        if size <= len(array):
+            return array
+        new = np.full(max(size, 2*len(array)), fill, dtype=array.dtype)
+        new[:len(array)] = array
+        return new
+
+    def intern(self, s):
+        si = self.index.get(s)
+        if si is not None:
+            return si
+        si = len(self.states)
+        if si == len(self.V):
+            self.V = self._reserve(self.V, si + 1)
+            self.solved = self._reserve(self.solved, si + 1)
+            self.terminal = self._reserve(self.terminal, si + 1)
+            self._first_row = self._reserve(self._first_row, si + 1)
+            self._n_rows = self._reserve(self._n_rows, si + 1, fill=-1)
+        self.index[s] = si
+        self.states.append(s)
+        self.actions.append(None)
+        if self.mdp.is_terminal(s):
+            self.terminal[si] = True
+            self.solved[si] = True
+            self.V[si] = 0.
+        else:
+            self.V[si] = self.heuristic(s)
+        return si
+
+    def is_expanded(self, si):
+        return self._n_rows[si] >= 0
+
+    def expand(self, si):
+        if self.is_expanded(si):
+            return
+        mdp = self.mdp
+        s = self.states[si]
+        actions = list(mdp.actions(s))
+        if self.rng is not None:
+            self.rng.shuffle(actions)
+        next_states, probs, rewards, row_sizes = [], [], [], []
+        for a in actions:
+            row_start = len(next_states)
+            for ns, p in mdp.next_state_dist(s, a).items():
+                next_states.append(self.intern(ns))
+                probs.append(p)
+                rewards.append(mdp.reward(s, a, ns))
+            row_sizes.append(len(next_states) - row_start)
+        self.actions[si] = actions
+
+        r0, r1 = self.n_rows, self.n_rows + len(actions)
+        e0, e1 = self.n_entries, self.n_entries + len(next_states)
+        self._first_entry = self._reserve(self._first_entry, r1 + 1)
+        self._row_total = self._reserve(self._row_total, r1)
+        for name in ("_next_states", "_probs", "_rewards", "_cumulative"):
+            setattr(self, name, self._reserve(getattr(self, name), e1))
+        probs = np.array(probs, dtype=float)
+        self._next_states[e0:e1] = next_states
+        self._probs[e0:e1] = probs
+        self._rewards[e0:e1] = rewards
+        row_sizes = np.array(row_sizes, dtype=int)
+        row_indptr = np.concatenate([[0], np.cumsum(row_sizes)])
+        cumulative = row_cumulative_probabilities(row_indptr, probs)
+        self._cumulative[e0:e1] = cumulative
+        self._first_entry[r0 + 1:r1 + 1] = e0 + row_indptr[1:]
+        nonempty = row_sizes > 0
+        self._row_total[r0:r1] = 0.
+        self._row_total[r0:r1][nonempty] = cumulative[row_indptr[1:][nonempty] - 1]
+        self._first_row[si] = r0
+        self._n_rows[si] = len(actions)
+        self.n_rows, self.n_entries = r1, e1
+
+    def _row_values(self, entries, entries_per_row):
+        # Rows can be empty (an action with no next states), so rows
+        # are summed with bincount rather than reduced at their starts.
+        row_of_entry = np.repeat(np.arange(len(entries_per_row)), entries_per_row)
+        future = self._rewards[entries] + self.discount_rate*self.V[self._next_states[entries]]
+        return np.bincount(
+            row_of_entry, weights=self._probs[entries]*future, minlength=len(entries_per_row)
+        )
+
+    def _check_has_actions(self, states):
+        no_actions = states[self._n_rows[states] == 0]
+        if len(no_actions) > 0:
+            raise ValueError(f"No actions available at state {self.states[no_actions[0]]}")
+
+    def q_values(self, si):
+        """Q-values of each of a state's actions under the current values."""
+        if self.terminal[si]:
+            if self.actions[si] is None:
+                self.actions[si] = list(self.mdp.actions(self.states[si]))
+            return np.zeros(len(self.actions[si]))
+        self.expand(si)
+        self._check_has_actions(np.array([si]))
+        r0 = self._first_row[si]
+        r1 = r0 + self._n_rows[si]
+        e0, e1 = self._first_entry[r0], self._first_entry[r1]
+        return self._row_values(np.arange(e0, e1), np.diff(self._first_entry[r0:r1 + 1]))
+
+    def greedy(self, states):
+        """
+        Greedy action indices and their Q-values for an array of
+        non-terminal states, computed together. As with `np.argmax`,
+        ties go to the first action.
+        """
+        for si in np.unique(states[self._n_rows[states] < 0]).tolist():
+            self.expand(si)
+        self._check_has_actions(states)
+        n_rows = self._n_rows[states]
+        state_of_row = np.repeat(np.arange(len(states)), n_rows)
+        first_row_of_state = np.cumsum(n_rows) - n_rows
+        rows = self._first_row[states][state_of_row] + \
+            (np.arange(len(state_of_row)) - first_row_of_state[state_of_row])
+
+        entries_per_row = self._first_entry[rows + 1] - self._first_entry[rows]
+        first_entry_of_row = np.cumsum(entries_per_row) - entries_per_row
+        entries = np.repeat(self._first_entry[rows] - first_entry_of_row, entries_per_row) + \
+            np.arange(entries_per_row.sum())
+        q = self._row_values(entries, entries_per_row)
+
+        values = np.full(len(states), -np.inf)
+        np.maximum.at(values, state_of_row, q)
+        is_max = np.flatnonzero(q == values[state_of_row])
+        _, first_max = np.unique(state_of_row[is_max], return_index=True)
+        actions = is_max[first_max] - first_row_of_state
+        return actions, values
+
+    def next_states(self, si, ai):
+        """Indices of the next states of a state-action with non-zero probability."""
+        row = self._first_row[si] + ai
+        e0, e1 = self._first_entry[row], self._first_entry[row + 1]
+        return self._next_states[e0:e1][self._probs[e0:e1] > 0]
+
+    def sample_next_state(self, si, ai, rng):
+        row = self._first_row[si] + ai
+        e0, e1 = self._first_entry[row], self._first_entry[row + 1]
+        if e0 == e1:
+            raise ValueError(f"{self.actions[si][ai]} has no next states at state {self.states[si]}")
+        u = rng.random()*self._row_total[row]
+        entry = min(bisect_right(self._cumulative, u, e0, e1), e1 - 1)
+        return int(self._next_states[entry])
+
+    def sample_next_states(self, states, actions, rng : np.random.Generator):
+        """Samples next state indices for arrays of state and action indices."""
+        rows = self._first_row[states] + actions
+        starts, ends = self._first_entry[rows], self._first_entry[rows + 1]
+        empty = np.flatnonzero(ends <= starts)
+        if len(empty) > 0:
+            si, ai = states[empty[0]], actions[empty[0]]
+            raise ValueError(f"{self.actions[si][ai]} has no next states at state {self.states[si]}")
+        u = rng.random(len(rows))*self._row_total[rows]
+        return self._next_states[search_rows(self._cumulative, starts, ends, u)]
 
 # TODO: this is a copy from laostar_refactor, we should consolidate
 # once this is finalized
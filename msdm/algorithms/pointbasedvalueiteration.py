@@ -5,29 +5,54 @@ Based on Pineau, Gordon & Thrun (2003). Point-based Value Iteration: An Anytime
 Also see Shani, Pineau & Kaplow (2012) A survey of point-based POMDP solvers
 
 """
+from collections import namedtuple
 import numpy as np
+import scipy.sparse
 from scipy.spatial.distance import cdist
 
 from msdm.core.problemclasses.pomdp import TabularPOMDP
 from msdm.core.algorithmclasses import Plans, Result
 from msdm.core.problemclasses.pomdp.alphavectorpolicy import AlphaVectorPolicy
 
-def next_beliefs(pomdp, b):
+PBVIExpansion = namedtuple("PBVIExpansion", "expansion belief_set_size value_iterations max_value_change")
+
+def action_transition_matrices(pomdp):
+    """
+    Splits the sparse (S*A, S) transition matrix into
+    a list of per-action sparse (S, S) matrices.
+    """
+    tf = pomdp.sparse_transition_matrix
+    n_actions = len(pomdp.action_list)
+    return [tf[ai::n_actions].tocsr() for ai in range(n_actions)]
+
+def next_beliefs(pomdp, b, sparse=False, action_transitions=None):
+    """
+    With `sparse`, next-state distributions are computed with the
+    per-action matrices of `action_transition_matrices`, which can be
+    passed as `action_transitions` to avoid splitting them on each call.
+    """
     assert np.isclose(sum(b), 1), sum(b)
-    tf = pomdp.transition_matrix
     of = pomdp.observation_matrix
-    ns_dist = np.einsum("san,s->an", tf, b)
+    if sparse:
+        if action_transitions is None:
+            action_transitions = action_transition_matrices(pomdp)
+        ns_dist = np.stack([tf_a.T @ b for tf_a in action_transitions])
+    else:
+        tf = pomdp.transition_matrix
+        ns_dist = np.einsum("san,s->an", tf, b)
     nbs = np.einsum("an,ano->aon", ns_dist, of)
     nbs = nbs[nbs.sum(-1) > 0, :] #ignore 0 beliefs
     nbs = nbs/nbs.sum(-1, keepdims=True)
     nbs = nbs.reshape((-1, nbs.shape[-1]))
     return np.unique(nbs, axis=0)
 
-def expand_beliefs(pomdp, belief_set):
+def expand_beliefs(pomdp, belief_set, sparse=False, action_transitions=None):
+    if sparse and action_transitions is None:
+        action_transitions = action_transition_matrices(pomdp)
     new_bs = []
     for b in belief_set:
         # First generate all beliefs following from this one
-        nbs = next_beliefs(pomdp, b)
+        nbs = next_beliefs(pomdp, b, sparse=sparse, action_transitions=action_transitions)
 
         # only add the belief that is the furthest from existing beliefs
         # this is the heuristic used in Pineau et al 2003
@@ -48,7 +73,9 @@ def point_based_value_iteration(
     pomdp,
     belief_set,
     value_convergence_epsilon,
-    horizon=None
+    horizon=None,
+    sparse=False,
+    action_transitions=None
 ):
     # iterations for infinite horizon as suggested in Pineau et al. 2003
     if horizon is None:
@@ -58,7 +85,6 @@ def point_based_value_iteration(
         horizon = np.log(horizon) / np.log(pomdp.discount_rate)
         horizon = int(np.ceil(horizon))
 
-    tf = pomdp.transition_matrix
     sa_rf = pomdp.state_action_reward_matrix
     nt = pomdp.nonterminal_state_vec
     of = pomdp.observation_matrix
@@ -70,7 +96,14 @@ def point_based_value_iteration(
     count_b = np.arange(len(bb))
 
     sa_rf = sa_rf*nt[:,None] #reward at terminal state is 0
-    tf = tf*nt[:, None, None] #terminal states transition nowhere
+    if sparse:
+        if action_transitions is None:
+            action_transitions = action_transition_matrices(pomdp)
+        #terminal states transition nowhere
+        tf = [scipy.sparse.diags(nt) @ tf_a for tf_a in action_transitions]
+    else:
+        tf = pomdp.transition_matrix
+        tf = tf*nt[:, None, None] #terminal states transition nowhere
 
     # alpha vectors - one per belief
     bv = np.zeros((len(bb), len(pomdp.state_list)))
@@ -78,7 +111,14 @@ def point_based_value_iteration(
     for i in range(horizon):
         ### Alpha-vectors over states (s) associated with each action (a),
         ### observation (o), and next-belief (p)
-        aops_fut_vf = np.einsum("san,ano,pn->aops", tf, of, bv)
+        if sparse:
+            aops_fut_vf = np.stack([
+                (tf_a @ np.einsum("no,pn->nop", of[ai], bv).reshape(len(ss), -1)).\
+                    reshape(len(ss), len(oo), len(bb)).transpose(1, 2, 0)
+                for ai, tf_a in enumerate(tf)
+            ])
+        else:
+            aops_fut_vf = np.einsum("san,ano,pn->aops", tf, of, bv)
 
         ### We want to find the indices of the best next-belief (p) alpha-vector
         ### for every last-belief (b), action (a), and observation (o)
@@ -95,7 +135,14 @@ def point_based_value_iteration(
 
         ### Recalculate the next-state alpha-vectors over states associated with each
         ### action, observation, last-belief
-        aobs_fut_vf = np.einsum("san,ano,aobn->aobs", tf, of, aobn_alpha_star)
+        if sparse:
+            aobs_fut_vf = np.stack([
+                (tf_a @ np.einsum("no,obn->nob", of[ai], aobn_alpha_star[ai]).reshape(len(ss), -1)).\
+                    reshape(len(ss), len(oo), len(bb)).transpose(1, 2, 0)
+                for ai, tf_a in enumerate(tf)
+            ])
+        else:
+            aobs_fut_vf = np.einsum("san,ano,aobn->aobs", tf, of, aobn_alpha_star)
 
         ### Now we can marginalize out the observations (summation in Eq 9)
         abs_fut_vf = np.einsum("aobs->abs", aobs_fut_vf)
@@ -133,7 +180,8 @@ class PointBasedValueIteration(Plans):
         min_belief_expansions=int(1e2),
         max_belief_expansions=int(1e5),
         value_convergence_epsilon=.01,
-        horizon=None
+        horizon=None,
+        sparse=False
     ):
         """
         Point-based value iteration approximates an exact
@@ -158,6 +206,9 @@ class PointBasedValueIteration(Plans):
             The planning horizon to optimize value over.
             None corresponds to an infinite horizon.
             If this is not None, then it overrides value_convergence_epsilon.
+        sparse : bool
+            If True, backups use per-action sparse transition
+            matrices instead of the dense (S, A, S) transition matrix.
 
         Returns
         -------
@@ -168,13 +219,20 @@ class PointBasedValueIteration(Plans):
         self.max_belief_expansions = max_belief_expansions
         self.value_convergence_epsilon = value_convergence_epsilon
         self.horizon = horizon
+        self.sparse = sparse
 
     def _solve(self, pomdp):
+        instrumentation = self.instrumentation
         s0 = pomdp.initial_state_vec
+        # split once and shared by every expansion and backup
+        action_transitions = action_transition_matrices(pomdp) if self.sparse else None
         belief_set = np.array([s0,])
         iterator = range(self.max_belief_expansions)
         for i in iterator:
-            belief_set = expand_beliefs(pomdp, belief_set)
+            belief_set = expand_beliefs(
+                pomdp, belief_set, sparse=self.sparse, action_transitions=action_transitions
+            )
+            instrumentation.count("belief_expansions")
             if i >= self.min_belief_expansions:
                 break
 
@@ -185,19 +243,34 @@ class PointBasedValueIteration(Plans):
                 pomdp,
                 belief_set,
                 value_convergence_epsilon=self.value_convergence_epsilon,
-                horizon=self.horizon
+                horizon=self.horizon,
+                sparse=self.sparse,
+                action_transitions=action_transitions
             )
 
+            instrumentation.count("value_iterations", res['iterations'] + 1)
+
             # expand belief set
-            belief_set = expand_beliefs(pomdp, belief_set)
+            belief_set = expand_beliefs(
+                pomdp, belief_set, sparse=self.sparse, action_transitions=action_transitions
+            )
+            instrumentation.count("belief_expansions")
 
             # convergence check
+            diff = None
             if last_res:
                 last_v = belief_values(last_res['alpha_vectors'], belief_set)
                 curr_v = belief_values(res['alpha_vectors'], belief_set)
                 diff = np.max(np.abs(last_v - curr_v))
-                if diff < self.value_convergence_epsilon:
-                    break
+            if instrumentation.enabled:
+                instrumentation.iteration(PBVIExpansion(
+                    expansion=i,
+                    belief_set_size=len(belief_set),
+                    value_iterations=res['iterations'] + 1,
+                    max_value_change=None if diff is None else float(diff),
+                ))
+            if diff is not None and diff < self.value_convergence_epsilon:
+                break
             last_res = res
         del res['iterations']
         res['belief_set'] = belief_set
@@ -205,12 +278,16 @@ class PointBasedValueIteration(Plans):
         return res
 
     def plan_on(self, pomdp: TabularPOMDP):
-        res = self._solve(pomdp)
-        pi = AlphaVectorPolicy(pomdp, res['alpha_vectors'])
-        return Result(
-            policy=pi,
-            alpha_vectors=res['alpha_vectors'],
-            alpha_actions=[pomdp.action_list[i] for i in res['belief_action_indices']],
-            belief_set=res['belief_set'],
-            expansion_iterations=res['expansion_iterations']
-        )
+        instrumentation = self.instrumentation
+        with instrumentation.phase("solve", pomdp) as model:
+            res = self._solve(model)
+
+        with instrumentation.phase("result"):
+            pi = AlphaVectorPolicy(pomdp, res['alpha_vectors'])
+            return Result(
+                policy=pi,
+                alpha_vectors=res['alpha_vectors'],
+                alpha_actions=[pomdp.action_list[i] for i in res['belief_action_indices']],
+                belief_set=res['belief_set'],
+                expansion_iterations=res['expansion_iterations']
+            )
@@ -1,33 +1,117 @@
+import inspect
 import warnings
+from collections import namedtuple
 import numpy as np
-from collections import defaultdict
+import scipy.sparse
+import scipy.sparse.linalg
 from msdm.core.problemclasses.mdp import \
-    TabularMarkovDecisionProcess, TabularPolicy
+    TabularMarkovDecisionProcess, ArrayPolicy
 from msdm.core.algorithmclasses import Plans, PlanningResult
+from msdm.core.utils.arrayviews import ArrayMapping
+
+PolicyIterationStep = namedtuple("PolicyIterationStep", "iteration policy_changes max_residual")
+
+# SciPy 1.12 renamed the relative tolerance of its Krylov solvers from `tol`
+# to `rtol`, and older releases (the only ones on Python 3.7/3.8) reject `rtol`.
+_KRYLOV_RTOL = "rtol" if "rtol" in inspect.signature(scipy.sparse.linalg.gmres).parameters else "tol"
 
 class PolicyIteration(Plans):
+    POLICY_EVALUATIONS = ("exact", "modified", "gmres", "bicgstab")
     def __init__(self, iterations=None,
-                 check_unreachable_convergence=True):
+                 check_unreachable_convergence=True,
+                 sparse=False,
+                 policy_evaluation="exact",
+                 evaluation_sweeps=20,
+                 evaluation_tolerance=1e-8):
+        """
+        Parameters
+        ----------
+        sparse : bool
+            If True, policy evaluation solves a sparse linear system
+            built from `mdp.sparse_transition_matrix` and the dense
+            (S, A, S) matrices are never built.
+        policy_evaluation : str
+            "exact" (the default) solves for the value of each policy
+            directly. "modified" runs `evaluation_sweeps` Bellman
+            evaluation sweeps per improvement step (modified policy
+            iteration). "gmres" and "bicgstab" solve the sparse system
+            `(I - discount*P_pi) v = r_pi` with the corresponding Krylov
+            method. Evaluation starts from the previous policy's values,
+            and all modes other than "exact" use the sparse transition matrix.
+            If a Krylov solve does not converge, a warning is raised and
+            that step's system is solved directly.
+        evaluation_sweeps : int
+            Number of evaluation sweeps per step when `policy_evaluation`
+            is "modified".
+        evaluation_tolerance : float
+            Tolerance of the Krylov solvers. For modified policy iteration,
+            planning only converges once the policy is stable and the
+            Bellman residual on reachable states is below this.
+        """
+        assert policy_evaluation in self.POLICY_EVALUATIONS, \
+            f"policy_evaluation must be one of {self.POLICY_EVALUATIONS}"
         self.iterations = iterations
         self.check_unreachable_convergence = check_unreachable_convergence
+        self.sparse = sparse
+        self.policy_evaluation = policy_evaluation
+        self.evaluation_sweeps = evaluation_sweeps
+        self.evaluation_tolerance = evaluation_tolerance
         self.VALUE_DECIMAL_PRECISION = 10
 
-    def plan_on(self, mdp: TabularMarkovDecisionProcess):
-        ss = mdp.state_list
-        tf = mdp.transition_matrix
-        rf = mdp.reward_matrix
-        nt = mdp.nonterminal_state_vec
-        rs = mdp.reachable_state_vec
-        am = mdp.action_matrix
+    def _evaluate_policy(self, mp, s_rf, v, discount_rate):
+        """
+        Values of the Markov chain `mp` with rewards `s_rf`, starting
+        from the values `v` of the previous policy.
+        """
+        if self.policy_evaluation == "modified":
+            for _ in range(self.evaluation_sweeps):
+                v = s_rf + discount_rate * (mp @ v)
+            return v
+        system = scipy.sparse.identity(len(s_rf), format='csr') - discount_rate * mp
+        if self.policy_evaluation == "exact":
+            return scipy.sparse.linalg.spsolve(system.tocsc(), s_rf)
+        solver = {
+            "gmres": scipy.sparse.linalg.gmres,
+            "bicgstab": scipy.sparse.linalg.bicgstab,
+        }[self.policy_evaluation]
+        v, info = solver(
+            system.tocsr(), s_rf, x0=v,
+            atol=self.evaluation_tolerance,
+            **{_KRYLOV_RTOL: self.evaluation_tolerance}
+        )
+        if info != 0:
+            warnings.warn(
+                f"{self.policy_evaluation} policy evaluation did not converge "
+                f"(info={info}); solving the system directly instead"
+            )
+            return scipy.sparse.linalg.spsolve(system.tocsc(), s_rf)
+        return v
 
-        # In general, terminal states only lead to themselves
-        # and return zero rewards, but to ensure that the
-        # the transition matrix is non-singular
-        # we assume terminal states transition nowhere.
-        tf = tf*nt[:, None, None]
+    def plan_on(self, mdp: TabularMarkovDecisionProcess):
+        instrumentation = self.instrumentation
+        with instrumentation.phase("compile", mdp) as model:
+            ss = model.state_list
+            nt = model.nonterminal_state_vec
+            rs = model.reachable_state_vec
+            am = model.action_matrix
 
-        # reward function assigns 0 to all transitions out of a terminal
-        rf = rf*nt[:, None, None]
+            # In general, terminal states only lead to themselves
+            # and return zero rewards, but to ensure that the
+            # the transition matrix is non-singular
+            # we assume terminal states transition nowhere.
+            # The reward function assigns 0 to all transitions out of a terminal.
+            use_sparse = self.sparse or self.policy_evaluation != "exact"
+            if use_sparse:
+                n_actions = len(model.action_list)
+                tf = scipy.sparse.diags(np.repeat(nt, n_actions), dtype=float) @ model.sparse_transition_matrix
+                sarf = model.state_action_reward_matrix*nt[:, None]
+                # maps an (S, A) policy onto the rows of tf
+                policy_rows = (np.repeat(np.arange(len(ss)), n_actions), np.arange(len(ss)*n_actions))
+            else:
+                tf = model.transition_matrix
+                rf = model.reward_matrix
+                tf = tf*nt[:, None, None]
+                rf = rf*nt[:, None, None]
 
         iterations = self.iterations
         if iterations is None:
@@ -36,40 +120,75 @@ class PolicyIteration(Plans):
         # Initialize to uniform random policy over available
         # actions.
         pi = am / am.sum(axis=1, keepdims=True)
+        v = np.zeros(len(ss))
+        enabled = instrumentation.enabled
 
-        for i in range(iterations):
-            # Calculate the expected per-state reward under
-            # the current policy.
-            s_rf = (pi[:, :, None] * tf[:, :, :] * rf[:, :, :]).sum(axis=(1, 2))
+        with instrumentation.phase("solve", mdp) as model:
+            for i in range(iterations):
+                if use_sparse:
+                    s_rf = (pi * sarf).sum(axis=1)
+                    pi_op = scipy.sparse.csr_matrix((pi.ravel(), policy_rows), shape=(len(ss), tf.shape[0]))
+                    mp = scipy.sparse.diags(rs, dtype=float) @ (pi_op @ tf)
+                    with instrumentation.phase("policy_evaluation"):
+                        v = self._evaluate_policy(mp, s_rf, v, model.discount_rate)
+                    q = sarf + model.discount_rate * (tf @ v).reshape(sarf.shape)
+                    q = np.around(q, decimals=self.VALUE_DECIMAL_PRECISION)
+                else:
+                    # Calculate the expected per-state reward under
+                    # the current policy.
+                    s_rf = (pi[:, :, None] * tf[:, :, :] * rf[:, :, :]).sum(axis=(1, 2))
 
-            # Construct a markov chain, marginalizing over
-            # the current policy. Only consider reachable states.
-            mp = (pi[:, :, None] * tf[:, :, :]).sum(axis=1)
-            mp = rs[:, None] * mp
+                    # Construct a markov chain, marginalizing over
+                    # the current policy. Only consider reachable states.
+                    mp = (pi[:, :, None] * tf[:, :, :]).sum(axis=1)
+                    mp = rs[:, None] * mp
 
-            # The value the solution to a set of linear equations.
-            v = np.linalg.solve(np.eye(len(ss)) - mdp.discount_rate * mp, s_rf)
+                    # The value the solution to a set of linear equations.
+                    with instrumentation.phase("policy_evaluation"):
+                        v = np.linalg.solve(np.eye(len(ss)) - model.discount_rate * mp, s_rf)
 
-            # The action value is the expectation over next state transitions
-            q = (tf[:, :, :] * (rf[:, :, :] + mdp.discount_rate * v[None, None, :])).sum(axis=2)
-            q = np.around(q, decimals=self.VALUE_DECIMAL_PRECISION)
+                    # The action value is the expectation over next state transitions
+                    q = (tf[:, :, :] * (rf[:, :, :] + model.discount_rate * v[None, None, :])).sum(axis=2)
+                    q = np.around(q, decimals=self.VALUE_DECIMAL_PRECISION)
 
-            # Calculate the new policy, taking into account
-            # the "infinite" cost of unavailable actions.
-            new_pi = np.zeros_like(pi)
-            np.put_along_axis(new_pi, (q + np.log(am)).argmax(axis=1)[:, None], values=1, axis=1)
+                # Calculate the new policy, taking into account
+                # the "infinite" cost of unavailable actions.
+                new_pi = np.zeros_like(pi)
+                np.put_along_axis(new_pi, (q + np.log(am)).argmax(axis=1)[:, None], values=1, axis=1)
 
-            # Check convergence
-            if self.check_unreachable_convergence:
-                converged = (new_pi == pi).all()
-            else:
-                converged = (new_pi[rs, :] == pi[rs, :]).all()
-            if converged:
-                break
-            pi = new_pi
+                # Check convergence
+                if self.check_unreachable_convergence:
+                    converged = (new_pi == pi).all()
+                else:
+                    converged = (new_pi[rs, :] == pi[rs, :]).all()
+                if converged and self.policy_evaluation == "modified":
+                    # A few sweeps can leave a stable policy with
+                    # inaccurate values, so also require that the
+                    # values be consistent with the greedy policy.
+                    bellman_error = np.abs((new_pi*q).sum(axis=1) - v)[rs.astype(bool)]
+                    converged = bellman_error.max(initial=0) < self.evaluation_tolerance
+                if enabled:
+                    instrumentation.iteration(PolicyIterationStep(
+                        iteration=i,
+                        policy_changes=int((new_pi != pi).any(axis=1).sum()),
+                        max_residual=float(np.abs((new_pi*q).sum(axis=1) - v)[rs.astype(bool)].max(initial=0)),
+                    ))
+                if converged:
+                    break
+                pi = new_pi
+        instrumentation.count("policy_evaluations", i + 1)
+        instrumentation.count("bellman_backups", (i + 1)*len(ss))
 
+        with instrumentation.phase("result"):
+            return self._planning_result(mdp, v, q, i, iterations)
+
+    def _planning_result(self, mdp, v, q, i, iterations):
+        am = mdp.action_matrix
         validq = q + np.log(am)
-        pi = TabularPolicy.from_q_matrix(mdp.state_list, mdp.action_list, validq)
+        pi = ArrayPolicy.from_q_matrix(
+            mdp.state_list, mdp.action_list, validq,
+            state_index=mdp.state_index, action_index=mdp.action_index
+        )
 
         # create result object
         res = PlanningResult()
@@ -81,16 +200,11 @@ class PolicyIteration(Plans):
         res.mdp = mdp
         res.policy = res.pi = pi
         res._valuevec = v
-        vf = dict()
-        for s, vi in zip(mdp.state_list, v):
-            vf[s] = vi
-        res.valuefunc = res.V = vf
+        res.valuefunc = res.V = ArrayMapping(v, (mdp.state_list,), (mdp.state_index,))
         res._qvaluemat = q
         res.iterations = i
-        qf = defaultdict(lambda : dict())
-        for si, s in enumerate(mdp.state_list):
-            for ai, a in enumerate(mdp.action_list):
-                qf[s][a] = q[si, ai]
-        res.actionvaluefunc = res.Q = qf
+        res.actionvaluefunc = res.Q = ArrayMapping(
+            q, (mdp.state_list, mdp.action_list), (mdp.state_index, mdp.action_index)
+        )
         res.initial_value = sum([res.V[s0]*p for s0, p in mdp.initial_state_dist().items()])
         return res
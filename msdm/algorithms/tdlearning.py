@@ -2,14 +2,18 @@
 
 """
 from msdm.core.algorithmclasses import Learns, Result
-from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess, TabularPolicy
+from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess, TabularPolicy, BatchSimulator
 from msdm.core.distributions import DictDistribution, SoftmaxDistribution
 from msdm.core.utils.dictutils import defaultdict2
 from collections import defaultdict
 from types import SimpleNamespace
 from abc import abstractmethod, ABC
+from bisect import bisect_right
+from itertools import count
+import heapq
 import random
 import math
+import numpy as np
 
 def epsilon_softmax_sample(action_values, rand_choose, softmax_temp, rng):
     aa, qs = zip(*action_values.items())
@@ -43,6 +47,141 @@ def argmax(d, rng):
     rng.shuffle(aa)
     return aa
 
+class IndexedTDEngine:
+    def __init__(self, mdp: TabularMarkovDecisionProcess, initial_q):
+        """
+        Q-values and dynamics of a tabular MDP over the indices of
+        `mdp.state_list` and `mdp.action_list`, for temporal difference
+        learners running with `indexed=True`.
+
+        Q-values are an (S, A) array and `available` is the (S, A) action
+        availability mask. Q-values of unavailable actions are -inf and
+        those of terminal states are 0. Transitions are sampled one at a
+        time from the arrays of a `BatchSimulator` by inverse-CDF lookup.
+        """
+        self.mdp = mdp
+        self.simulator = sim = BatchSimulator(mdp)
+        self.n_states, self.n_actions = sim.n_states, sim.n_actions
+        self.discount_rate = mdp.discount_rate
+        self.nonterminal = sim.nonterminal.tolist()
+        self.available = mdp.action_matrix.astype(bool)
+        self._available_action_lists = [np.flatnonzero(row).tolist() for row in self.available]
+
+        # python lists are faster than arrays to index one element at a time
+        self._next_state_indices = sim._next_state_indices.tolist()
+        self._rewards = sim._rewards.tolist()
+        self._row_cumulative = sim._row_cumulative.tolist()
+        self._row_totals = sim._row_totals.tolist()
+        self._row_starts = sim._row_starts.tolist()
+        self._row_ends = sim._row_ends.tolist()
+        self._initial_cumulative = sim._initial_cumulative.tolist()
+
+        ss, aa = mdp.state_list, mdp.action_list
+        self.initial_q = np.full((self.n_states, self.n_actions), -np.inf)
+        for si, s in enumerate(ss):
+            for ai in self._available_action_lists[si]:
+                self.initial_q[si, ai] = initial_q(s, aa[ai]) if self.nonterminal[si] else 0.0
+
+    def new_q_table(self):
+        return self.initial_q.copy()
+
+    def sample_initial_state(self, rng):
+        u = rng.random()*self._initial_cumulative[-1]
+        return min(bisect_right(self._initial_cumulative, u), self.n_states - 1)
+
+    def step(self, si, ai, rng):
+        """Samples a next state index and reward"""
+        row = si*self.n_actions + ai
+        e0, e1 = self._row_starts[row], self._row_ends[row]
+        if e0 == e1:
+            raise ValueError(f"Action {ai} has no next states at state {si}; it may be unavailable")
+        u = rng.random()*self._row_totals[row]
+        entry = min(bisect_right(self._row_cumulative, u, e0, e1), e1 - 1)
+        return self._next_state_indices[entry], self._rewards[entry]
+
+    # Rows of Q-values are short, so they are converted to lists:
+    # this is faster than operating on them as arrays.
+    def sample_action(self, action_values, si, rand_choose, softmax_temp, rng):
+        """
+        Samples an action index for state index `si` as in `epsilon_softmax_sample`,
+        given a row of Q-values.
+        """
+        if rand_choose and rng.random() < rand_choose:
+            return rng.choice(self._available_action_lists[si])
+        qs = action_values.tolist()
+        maxq = max(qs)
+        if softmax_temp != 0.0:
+            # unavailable actions have a Q-value of -inf and so a weight of 0
+            weights = [math.exp((qi - maxq)/softmax_temp) for qi in qs]
+            return rng.choices(range(len(qs)), weights=weights, k=1)[0]
+        return self._random_max(qs, maxq, rng)
+
+    def argmax_action(self, action_values, si, rng):
+        """A maximizing action index, with ties broken at random"""
+        qs = action_values.tolist()
+        return self._random_max(qs, max(qs), rng)
+
+    @staticmethod
+    def _random_max(qs, maxq, rng):
+        ties = [ai for ai, qi in enumerate(qs) if qi == maxq]
+        if len(ties) == 1:
+            return ties[0]
+        return rng.choice(ties)
+
+    def expected_value(self, action_values, si, rand_choose, softmax_temp):
+        """
+        Expected Q-value for state index `si` under `epsilon_softmax_dist`,
+        given a row of Q-values.
+        """
+        qs = [action_values[ai] for ai in self._available_action_lists[si]]
+        maxq = max(qs)
+        if softmax_temp == 0.0:
+            weights = [1.0 if qi == maxq else 0.0 for qi in qs]
+        else:
+            weights = [math.exp((qi - maxq)/softmax_temp) for qi in qs]
+        total = sum(weights)
+        greedy_value = sum(w*qi for w, qi in zip(weights, qs))/total
+        if rand_choose == 0.0:
+            return greedy_value
+        return rand_choose*sum(qs)/len(qs) + (1 - rand_choose)*greedy_value
+
+    def action_probs(self, action_values, si, rand_choose, softmax_temp):
+        """
+        Action probabilities of `epsilon_softmax_dist` for arrays of
+        state indices `si`, given their (n, A) rows of Q-values and (n,)
+        arrays of `rand_choose` and `softmax_temp`. Returns an (n, A) array.
+        """
+        available = self.available[si]
+        maxq = action_values.max(axis=1, keepdims=True)
+        temp = softmax_temp[:, None]
+        with np.errstate(invalid='ignore'):
+            softmax = np.exp((action_values - maxq)/np.where(temp > 0, temp, 1.0))
+        greedy = np.where(temp > 0, softmax, (action_values == maxq) & available)
+        greedy = greedy/greedy.sum(axis=1, keepdims=True)
+        uniform = available/available.sum(axis=1, keepdims=True)
+        eps = rand_choose[:, None]
+        return eps*uniform + (1 - eps)*greedy
+
+    def sample_actions(self, action_values, si, rand_choose, softmax_temp, rng : np.random.Generator):
+        """Samples action indices for arrays of state indices (see `action_probs`)."""
+        probs = self.action_probs(action_values, si, rand_choose, softmax_temp)
+        cumulative = np.cumsum(probs, axis=1)
+        u = rng.random(len(si))*cumulative[:, -1]
+        return np.minimum((cumulative <= u[:, None]).sum(axis=1), self.n_actions - 1)
+
+    def expected_values(self, action_values, si, rand_choose, softmax_temp):
+        """Expected Q-values under `action_probs` for arrays of state indices."""
+        probs = self.action_probs(action_values, si, rand_choose, softmax_temp)
+        return (probs*np.where(self.available[si], action_values, 0.0)).sum(axis=1)
+
+    def q_values(self, q):
+        """Converts an (S, A) Q-value array to a dictionary of action-value dictionaries"""
+        ss, aa = self.mdp.state_list, self.mdp.action_list
+        return {
+            s: {aa[ai]: float(q[si, ai]) for ai in self._available_action_lists[si]}
+            for si, s in enumerate(ss)
+        }
+
 class TDLearningEventListener(ABC):
     @abstractmethod
     def __init__(self):
@@ -72,6 +211,17 @@ class EpisodeRewardEventListener(TDLearningEventListener):
         )
 
 class TemporalDifferenceLearning(Learns):
+    # Learners that support `indexed` mode set this to True and define
+    # `_indexed_training(engine, rng, event_listener)`, the main training
+    # loop of `indexed` mode, which returns an (S, A) array of Q-values.
+    supports_indexed = False
+    # Learners that support `train_vectorized_on` set this to True and define
+    # `_vectorized_step(engine, q, rows, s, a, r, ns, params, rng)`, which
+    # updates Q-values for a batch of transitions, where `rows` index the
+    # Q-value table rows of (environment, state), and returns the next
+    # action indices, or -1 where they still need to be selected.
+    supports_vectorized = False
+
     def __init__(
         self,
         episodes : int = 100,
@@ -80,7 +230,8 @@ class TemporalDifferenceLearning(Learns):
         softmax_temp : float = 0.0,
         initial_q : float = 0.0,
         seed : int = None,
-        event_listener_class : TDLearningEventListener = EpisodeRewardEventListener
+        event_listener_class : TDLearningEventListener = EpisodeRewardEventListener,
+        indexed : bool = False,
     ):
         """
         Generic temporal difference learning interface based on Sutton & Barto, Ch 6.
@@ -101,6 +252,14 @@ class TemporalDifferenceLearning(Learns):
             Random seed
         event_listener_class : TDLearningEventListener
             Event listener class
+        indexed : bool
+            False by default. If set to True, the MDP is compiled to arrays
+            and Q-values are kept in an (S, A) array (see `IndexedTDEngine`),
+            so that action selection and updates work on state and action
+            indices. Q-values are converted to dictionaries once training
+            ends. Event listeners then see state and action indices
+            rather than states and actions. A `ValueError` is raised for
+            learners that do not support it.
         """
         self.episodes = episodes
         self.step_size = step_size
@@ -114,6 +273,9 @@ class TemporalDifferenceLearning(Learns):
         else:
             raise ValueError("`inital_q` needs to be a float, int, or real-valued state-action function")
         self.event_listener_class = event_listener_class
+        if indexed and not self.supports_indexed:
+            raise ValueError(f"{self.__class__.__name__} has no indexed mode")
+        self.indexed = indexed
 
     @abstractmethod
     def _training(self, mdp, rng):
@@ -154,15 +316,133 @@ class TemporalDifferenceLearning(Learns):
         q = defaultdict2(initial_avals, initialize_defaults=True)
         return q
 
+    def _vectorized_update(self, engine, q, rows, a, target, params):
+        delta = params.step_size*(target - q[rows, a])
+        # Environments sharing a table can update the same entry in one
+        # step. Their updates are averaged rather than summed, so that
+        # the entry moves by at most one step size towards the targets.
+        _, entry, counts = np.unique(rows*q.shape[1] + a, return_inverse=True, return_counts=True)
+        np.add.at(q, (rows, a), delta/counts[entry.reshape(-1)])
+
+    def train_vectorized_on(
+        self,
+        mdp: TabularMarkovDecisionProcess,
+        n_envs : int,
+        shared_q : bool = False,
+        step_size=None,
+        rand_choose=None,
+        softmax_temp=None,
+    ):
+        """
+        Trains in `n_envs` independent environments in lockstep, each
+        running `episodes` episodes. At each step, actions and next states
+        for all running environments are sampled as arrays (see
+        `IndexedTDEngine`) and their updates are applied with a scatter-add,
+        where updates of the same entry of a shared table are averaged.
+        Event listeners are not called in this mode. A `ValueError` is
+        raised for learners that do not support it.
+
+        Parameters
+        ----------
+        n_envs : int
+            Number of environments
+        shared_q : bool
+            If True, all environments learn a single Q-value table.
+            Otherwise, each learns its own.
+        step_size, rand_choose, softmax_temp : float or array of length `n_envs`
+            Per-environment overrides of the learner's parameters,
+            e.g., for hyperparameter sweeps.
+
+        Returns
+        -------
+        A Result with `q_table`, an (S, A) array if `shared_q` is True
+        or else an (n_envs, S, A) array over `state_list` and `action_list`,
+        and `episode_rewards`, an (n_envs, episodes) array of the sum of
+        rewards in each episode. With `shared_q`, `q_values` and `policy`
+        are also given as in `train_on`.
+        """
+        if not self.supports_vectorized:
+            raise ValueError(f"{self.__class__.__name__} does not support vectorized training")
+        instrumentation = self.instrumentation
+        rng = np.random.default_rng(self.seed)
+        params = SimpleNamespace(**{
+            name: np.broadcast_to(
+                np.asarray(getattr(self, name) if value is None else value, dtype=float), (n_envs, )
+            )
+            for name, value in dict(step_size=step_size, rand_choose=rand_choose, softmax_temp=softmax_temp).items()
+        })
+        with instrumentation.phase("solve", mdp) as model:
+            engine = IndexedTDEngine(model, self.initial_q)
+            n_states = engine.n_states
+            n_tables = 1 if shared_q else n_envs
+            # rows of the table are (environment, state)
+            q = np.tile(engine.initial_q, (n_tables, 1))
+            table_offsets = np.zeros(n_envs, dtype=int) if shared_q else np.arange(n_envs)*n_states
+            nonterminal = np.array(engine.nonterminal, dtype=bool)
+            sim = engine.simulator
+
+            episode_rewards = np.zeros((n_envs, self.episodes))
+            episodes_done = np.zeros(n_envs, dtype=int)
+            returns = np.zeros(n_envs)
+            s = sim.initial_state_indices(n_envs, rng)
+            a = np.full(n_envs, -1)
+            while True:
+                ended = np.flatnonzero(~nonterminal[s] & (episodes_done < self.episodes))
+                while len(ended) > 0:
+                    episode_rewards[ended, episodes_done[ended]] = returns[ended]
+                    episodes_done[ended] += 1
+                    returns[ended] = 0
+                    a[ended] = -1
+                    s[ended] = sim.initial_state_indices(len(ended), rng)
+                    ended = ended[~nonterminal[s[ended]] & (episodes_done[ended] < self.episodes)]
+                envs = np.flatnonzero(episodes_done < self.episodes)
+                if len(envs) == 0:
+                    break
+                env_params = SimpleNamespace(**{k: v[envs] for k, v in vars(params).items()})
+                rows = table_offsets[envs] + s[envs]
+                env_a = a[envs]
+                select = env_a < 0
+                if select.any():
+                    env_a[select] = engine.sample_actions(
+                        q[rows[select]], s[envs][select],
+                        env_params.rand_choose[select], env_params.softmax_temp[select], rng
+                    )
+                ns, r = sim.step(s[envs], env_a, rng)
+                a[envs] = self._vectorized_step(engine, q, rows, s[envs], env_a, r, ns, env_params, rng)
+                returns[envs] += r
+                s[envs] = ns
+        instrumentation.count("episodes", self.episodes*n_envs)
+        with instrumentation.phase("result"):
+            if shared_q:
+                q_values = engine.q_values(q)
+                return Result(
+                    q_table=q,
+                    q_values=q_values,
+                    policy=self._create_policy(mdp, q_values),
+                    episode_rewards=episode_rewards,
+                )
+            return Result(
+                q_table=q.reshape(n_envs, n_states, engine.n_actions),
+                episode_rewards=episode_rewards,
+            )
+
     def train_on(self, mdp: TabularMarkovDecisionProcess):
+        instrumentation = self.instrumentation
         rng = self._init_random_number_generator()
         event_listener = self.event_listener_class()
-        q = self._training(mdp, rng, event_listener)
-        return Result(
-            q_values=q,
-            policy=self._create_policy(mdp, q),
-            event_listener_results=event_listener.results()
-        )
+        with instrumentation.phase("solve", mdp) as model:
+            if self.indexed:
+                engine = IndexedTDEngine(model, self.initial_q)
+                q = engine.q_values(self._indexed_training(engine, rng, event_listener))
+            else:
+                q = self._training(model, rng, event_listener)
+        instrumentation.count("episodes", self.episodes)
+        with instrumentation.phase("result"):
+            return Result(
+                q_values=q,
+                policy=self._create_policy(mdp, q),
+                event_listener_results=event_listener.results()
+            )
 
 class QLearning(TemporalDifferenceLearning):
     r"""
@@ -172,6 +452,9 @@ class QLearning(TemporalDifferenceLearning):
     \delta_t = R_{t+1} + \gamma\max_a Q(S_{t+1}, a) - Q(S_t, A_t)
     $$
     """
+    supports_indexed = True
+    supports_vectorized = True
+
     def _training(self, mdp, rng, event_listener):
         q = self._initial_q_table(mdp)
         for ep in range(self.episodes):
@@ -190,6 +473,27 @@ class QLearning(TemporalDifferenceLearning):
             event_listener.end_of_episode(locals())
         return q
 
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        nonterminal = engine.nonterminal
+        for ep in range(self.episodes):
+            s = engine.sample_initial_state(rng)
+            while nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+                ns, r = engine.step(s, a, rng)
+                future = max(q[ns].tolist()) if nonterminal[ns] else 0.0
+                q[s, a] += self.step_size*(r + engine.discount_rate*future - q[s, a])
+                event_listener.end_of_timestep(locals())
+                s = ns
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _vectorized_step(self, engine, q, rows, s, a, r, ns, params, rng):
+        next_rows = rows - s + ns
+        future = np.where(engine.simulator.nonterminal[ns], q[next_rows].max(axis=1), 0.0)
+        self._vectorized_update(engine, q, rows, a, r + engine.discount_rate*future, params)
+        return np.full(len(a), -1)
+
 class DoubleQLearning(TemporalDifferenceLearning):
     r"""
     Double Q-learning is an off-policy temporal difference control method
@@ -200,6 +504,8 @@ class DoubleQLearning(TemporalDifferenceLearning):
     $$
     where Q_i and Q_j are two different Q functions selected at random each update.
     """
+    supports_indexed = True
+
     def _training(self, mdp, rng, event_listener):
         q1 = self._initial_q_table(mdp)
         q2 = self._initial_q_table(mdp)
@@ -233,6 +539,27 @@ class DoubleQLearning(TemporalDifferenceLearning):
                 q[s][a] = q1[s][a]*.5 +q2[s][a]*.5
         return q
 
+    def _indexed_training(self, engine, rng, event_listener):
+        q1 = engine.new_q_table()
+        q2 = engine.new_q_table()
+        nonterminal = engine.nonterminal
+        for ep in range(self.episodes):
+            s = engine.sample_initial_state(rng)
+            while nonterminal[s]:
+                avals = q1[s]*.5 + q2[s]*.5
+                a = engine.sample_action(avals, s, self.rand_choose, self.softmax_temp, rng)
+                ns, r = engine.step(s, a, rng)
+                if rng.random() > .5:
+                    future = q2[ns, engine.argmax_action(q1[ns], ns, rng)] if nonterminal[ns] else 0.0
+                    q1[s, a] += self.step_size*(r + engine.discount_rate*future - q1[s, a])
+                else:
+                    future = q1[ns, engine.argmax_action(q2[ns], ns, rng)] if nonterminal[ns] else 0.0
+                    q2[s, a] += self.step_size*(r + engine.discount_rate*future - q2[s, a])
+                event_listener.end_of_timestep(locals())
+                s = ns
+            event_listener.end_of_episode(locals())
+        return q1*.5 + q2*.5
+
 class SARSA(TemporalDifferenceLearning):
     r"""
     SARSA is an on-policy temporal difference control method.
@@ -241,6 +568,9 @@ class SARSA(TemporalDifferenceLearning):
     \delta_t = R_{t+1} + \gamma Q(S_{t+1}, A_{t+1}) - Q(S_t, A_t)
     $$
     """
+    supports_indexed = True
+    supports_vectorized = True
+
     def _training(self, mdp, rng, event_listener):
         q = self._initial_q_table(mdp)
         for ep in range(self.episodes):
@@ -261,6 +591,39 @@ class SARSA(TemporalDifferenceLearning):
             event_listener.end_of_episode(locals())
         return q
 
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        nonterminal = engine.nonterminal
+        for ep in range(self.episodes):
+            s = engine.sample_initial_state(rng)
+            if nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+            while nonterminal[s]:
+                ns, r = engine.step(s, a, rng)
+                if nonterminal[ns]:
+                    na = engine.sample_action(q[ns], ns, self.rand_choose, self.softmax_temp, rng)
+                    future = q[ns, na]
+                else:
+                    na, future = None, 0.0
+                q[s, a] += self.step_size*(r + engine.discount_rate*future - q[s, a])
+                event_listener.end_of_timestep(locals())
+                s, a = ns, na
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _vectorized_step(self, engine, q, rows, s, a, r, ns, params, rng):
+        next_rows = rows - s + ns
+        continuing = engine.simulator.nonterminal[ns]
+        na = np.full(len(a), -1)
+        na[continuing] = engine.sample_actions(
+            q[next_rows[continuing]], ns[continuing],
+            params.rand_choose[continuing], params.softmax_temp[continuing], rng
+        )
+        future = np.zeros(len(a))
+        future[continuing] = q[next_rows[continuing], na[continuing]]
+        self._vectorized_update(engine, q, rows, a, r + engine.discount_rate*future, params)
+        return na
+
 class ExpectedSARSA(TemporalDifferenceLearning):
     r"""
     Expected SARSA is an on-policy temporal difference control method.
@@ -269,6 +632,9 @@ class ExpectedSARSA(TemporalDifferenceLearning):
     \delta_t = R_{t+1} + \gamma \sum_a \pi(a \mid S_{t + 1})Q(S_{t+1}, a) - Q(S_t, A_t)
     $$
     """
+    supports_indexed = True
+    supports_vectorized = True
+
     def _training(self, mdp, rng, event_listener):
         q = self._initial_q_table(mdp)
         for ep in range(self.episodes):
@@ -288,3 +654,393 @@ class ExpectedSARSA(TemporalDifferenceLearning):
                 s = ns
             event_listener.end_of_episode(locals())
         return q
+
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        nonterminal = engine.nonterminal
+        for ep in range(self.episodes):
+            s = engine.sample_initial_state(rng)
+            while nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+                ns, r = engine.step(s, a, rng)
+                if nonterminal[ns]:
+                    future = engine.expected_value(q[ns].tolist(), ns, self.rand_choose, self.softmax_temp)
+                else:
+                    future = 0.0
+                q[s, a] += self.step_size*(r + engine.discount_rate*future - q[s, a])
+                event_listener.end_of_timestep(locals())
+                s = ns
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _vectorized_step(self, engine, q, rows, s, a, r, ns, params, rng):
+        next_rows = rows - s + ns
+        continuing = engine.simulator.nonterminal[ns]
+        future = np.zeros(len(a))
+        future[continuing] = engine.expected_values(
+            q[next_rows[continuing]], ns[continuing],
+            params.rand_choose[continuing], params.softmax_temp[continuing]
+        )
+        self._vectorized_update(engine, q, rows, a, r + engine.discount_rate*future, params)
+        return np.full(len(a), -1)
+
+class TemporalDifferenceLambda(TemporalDifferenceLearning):
+    TRACE_TYPES = ("replacing", "accumulating")
+
+    def __init__(
+        self,
+        *args,
+        trace_decay : float = .9,
+        trace_type : str = "replacing",
+        trace_cutoff : float = 1e-4,
+        **kwargs
+    ):
+        """
+        Temporal difference learning with eligibility traces (Sutton & Barto, Ch 12).
+        Takes the parameters of `TemporalDifferenceLearning` and the following.
+
+        Traces are stored sparsely in a dictionary that only holds
+        the state-action pairs whose trace is at least `trace_cutoff`,
+        so each step updates the active traces rather than every
+        state-action pair. Traces are cleared at the end of each episode.
+
+        Parameters
+        ----------
+        trace_decay : float
+            Lambda, the decay rate of traces on top of the discount rate
+        trace_type : str
+            "replacing" sets the trace of a visited state-action pair to 1;
+            "accumulating" adds 1 to it
+        trace_cutoff : float
+            Traces that decay below this value are dropped
+        """
+        super().__init__(*args, **kwargs)
+        if trace_type not in self.TRACE_TYPES:
+            raise ValueError(f"`trace_type` needs to be one of {self.TRACE_TYPES}")
+        self.trace_decay = trace_decay
+        self.trace_type = trace_type
+        self.trace_cutoff = trace_cutoff
+
+    def _visit(self, traces, key):
+        if self.trace_type == "accumulating":
+            traces[key] = traces.get(key, 0.0) + 1.0
+        else:
+            traces[key] = 1.0
+
+    def _decay_traces(self, traces, decay):
+        """Decays traces and drops those below `trace_cutoff`"""
+        cutoff = self.trace_cutoff
+        return {key: e*decay for key, e in traces.items() if e*decay >= cutoff}
+
+class SARSALambda(TemporalDifferenceLambda):
+    r"""
+    SARSA(λ) is an on-policy temporal difference control method
+    that assigns the SARSA error to recently visited state-action
+    pairs in proportion to their eligibility traces:
+    $$
+    \delta_t = R_{t+1} + \gamma Q(S_{t+1}, A_{t+1}) - Q(S_t, A_t) \\
+    Q(s, a) \leftarrow Q(s, a) + \alpha\delta_t e_t(s, a)
+    $$
+    where traces decay by $\gamma\lambda$ each step.
+    """
+    supports_indexed = True
+
+    def _training(self, mdp, rng, event_listener):
+        q = self._initial_q_table(mdp)
+        decay = mdp.discount_rate*self.trace_decay
+        for ep in range(self.episodes):
+            traces = {}
+            s = mdp.initial_state_dist().sample(rng=rng)
+            if s not in q:
+                q[s] = {a: self.initial_q(s, a) for a in mdp.actions(s)}
+            a = epsilon_softmax_sample(q[s], self.rand_choose, self.softmax_temp, rng)
+            while not mdp.is_terminal(s):
+                # get next state, reward, next action
+                ns = mdp.next_state_dist(s, a).sample(rng=rng)
+                r = mdp.reward(s, a, ns)
+                na = epsilon_softmax_sample(q[ns], self.rand_choose, self.softmax_temp, rng)
+                # update all state-action pairs with active traces
+                td_error = r + mdp.discount_rate*q[ns][na] - q[s][a]
+                self._visit(traces, (s, a))
+                for (ts, ta), e in traces.items():
+                    q[ts][ta] += self.step_size*td_error*e
+                traces = self._decay_traces(traces, decay)
+                # end of timestep
+                event_listener.end_of_timestep(locals())
+                s, a = ns, na
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        # traces are keyed by the flat index si*n_actions + ai
+        q_flat = q.reshape(-1)
+        n_actions = engine.n_actions
+        nonterminal = engine.nonterminal
+        decay = engine.discount_rate*self.trace_decay
+        for ep in range(self.episodes):
+            traces = {}
+            s = engine.sample_initial_state(rng)
+            if nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+            while nonterminal[s]:
+                ns, r = engine.step(s, a, rng)
+                if nonterminal[ns]:
+                    na = engine.sample_action(q[ns], ns, self.rand_choose, self.softmax_temp, rng)
+                    future = q[ns, na]
+                else:
+                    na, future = None, 0.0
+                td_error = r + engine.discount_rate*future - q[s, a]
+                self._visit(traces, s*n_actions + a)
+                for row, e in traces.items():
+                    q_flat[row] += self.step_size*td_error*e
+                traces = self._decay_traces(traces, decay)
+                event_listener.end_of_timestep(locals())
+                s, a = ns, na
+            event_listener.end_of_episode(locals())
+        return q
+
+class WatkinsQLambda(TemporalDifferenceLambda):
+    r"""
+    Watkins's Q(λ) is an off-policy temporal difference control method
+    that assigns the Q-learning error to recently visited state-action
+    pairs in proportion to their eligibility traces:
+    $$
+    \delta_t = R_{t+1} + \gamma\max_a Q(S_{t+1}, a) - Q(S_t, A_t) \\
+    Q(s, a) \leftarrow Q(s, a) + \alpha\delta_t e_t(s, a)
+    $$
+    Traces decay by $\gamma\lambda$ each step while the greedy
+    action is taken, and are cleared after an exploratory action,
+    since the remaining experience no longer follows the greedy policy.
+    """
+    supports_indexed = True
+
+    def _training(self, mdp, rng, event_listener):
+        q = self._initial_q_table(mdp)
+        decay = mdp.discount_rate*self.trace_decay
+        for ep in range(self.episodes):
+            traces = {}
+            s = mdp.initial_state_dist().sample(rng=rng)
+            if s not in q:
+                q[s] = {a: self.initial_q(s, a) for a in mdp.actions(s)}
+            a = epsilon_softmax_sample(q[s], self.rand_choose, self.softmax_temp, rng)
+            while not mdp.is_terminal(s):
+                # transition to next state
+                ns = mdp.next_state_dist(s, a).sample(rng=rng)
+                r = mdp.reward(s, a, ns)
+                # select next action
+                if mdp.is_terminal(ns):
+                    na, maxq, greedy = None, 0.0, True
+                else:
+                    na = epsilon_softmax_sample(q[ns], self.rand_choose, self.softmax_temp, rng)
+                    maxq = max(q[ns].values())
+                    greedy = q[ns][na] == maxq
+                # update all state-action pairs with active traces
+                td_error = r + mdp.discount_rate*maxq - q[s][a]
+                self._visit(traces, (s, a))
+                for (ts, ta), e in traces.items():
+                    q[ts][ta] += self.step_size*td_error*e
+                traces = self._decay_traces(traces, decay) if greedy else {}
+                # end of timestep
+                event_listener.end_of_timestep(locals())
+                s, a = ns, na
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        # traces are keyed by the flat index si*n_actions + ai
+        q_flat = q.reshape(-1)
+        n_actions = engine.n_actions
+        nonterminal = engine.nonterminal
+        decay = engine.discount_rate*self.trace_decay
+        for ep in range(self.episodes):
+            traces = {}
+            s = engine.sample_initial_state(rng)
+            if nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+            while nonterminal[s]:
+                ns, r = engine.step(s, a, rng)
+                if nonterminal[ns]:
+                    na = engine.sample_action(q[ns], ns, self.rand_choose, self.softmax_temp, rng)
+                    maxq = max(q[ns].tolist())
+                    greedy = q[ns, na] == maxq
+                else:
+                    na, maxq, greedy = None, 0.0, True
+                td_error = r + engine.discount_rate*maxq - q[s, a]
+                self._visit(traces, s*n_actions + a)
+                for row, e in traces.items():
+                    q_flat[row] += self.step_size*td_error*e
+                traces = self._decay_traces(traces, decay) if greedy else {}
+                event_listener.end_of_timestep(locals())
+                s, a = ns, na
+            event_listener.end_of_episode(locals())
+        return q
+
+class EmpiricalModel:
+    def __init__(self):
+        """
+        Counts of the outcomes observed for each state-action pair.
+        `outcomes[(s, a)]` maps each observed (next state, reward)
+        pair to its count and `visits[(s, a)]` is their total.
+        `predecessors[ns]` holds the state-action pairs observed
+        to lead to `ns`, in the order they were first observed.
+        """
+        self.outcomes = {}
+        self.visits = {}
+        self.predecessors = {}
+        self.state_actions = []
+
+    def record(self, s, a, ns, r):
+        sa = (s, a)
+        if sa not in self.outcomes:
+            self.outcomes[sa] = {}
+            self.visits[sa] = 0
+            self.state_actions.append(sa)
+        outcomes = self.outcomes[sa]
+        outcomes[(ns, r)] = outcomes.get((ns, r), 0) + 1
+        self.visits[sa] += 1
+        self.predecessors.setdefault(ns, {})[sa] = None
+
+    def expected_target(self, s, a, max_q, discount_rate):
+        """Expected one-step Q-learning target of (s, a) under the empirical distribution"""
+        total = sum(
+            n*(r + discount_rate*max_q(ns))
+            for (ns, r), n in self.outcomes[(s, a)].items()
+        )
+        return total/self.visits[(s, a)]
+
+class _PriorityQueue:
+    def __init__(self, threshold):
+        # a max-heap of state-action pairs with lazily removed stale entries
+        self.threshold = threshold
+        self._heap = []
+        self._priorities = {}
+        self._order = count()
+
+    def push(self, sa, priority):
+        if priority <= self.threshold or priority <= self._priorities.get(sa, 0.0):
+            return
+        self._priorities[sa] = priority
+        heapq.heappush(self._heap, (-priority, next(self._order), sa))
+
+    def pop(self):
+        while self._heap:
+            priority, _, sa = heapq.heappop(self._heap)
+            if self._priorities.get(sa) == -priority:
+                del self._priorities[sa]
+                return sa
+        return None
+
+class DynaQ(TemporalDifferenceLearning):
+    r"""
+    Dyna-Q (Sutton & Barto, Ch 8) learns Q-values from real experience
+    with Q-learning, and also plans with an `EmpiricalModel` of that
+    experience. After each real step, it makes `planning_steps`
+    updates of previously observed state-action pairs towards their
+    expected target under the model:
+    $$
+    Q(s, a) \leftarrow Q(s, a) + \alpha\left(\sum_{s', r}\hat{p}(s', r \mid s, a)
+    \left[r + \gamma\max_{a'} Q(s', a')\right] - Q(s, a)\right)
+    $$
+    """
+    supports_indexed = True
+
+    def __init__(
+        self,
+        *args,
+        planning_steps : int = 5,
+        prioritized_sweeping : bool = False,
+        priority_threshold : float = 1e-4,
+        **kwargs
+    ):
+        """
+        Takes the parameters of `TemporalDifferenceLearning` and the following.
+
+        Parameters
+        ----------
+        planning_steps : int
+            The number of planning updates after each real step
+        prioritized_sweeping : bool
+            False by default, in which case planning updates state-action
+            pairs chosen uniformly from those observed. If set to True,
+            planning updates the pairs in a priority queue keyed on the
+            size of their expected TD error, and the predecessors of
+            each updated state are queued in turn.
+        priority_threshold : float
+            State-action pairs whose TD error is at most this
+            value are not queued in prioritized sweeping
+        """
+        super().__init__(*args, **kwargs)
+        self.planning_steps = planning_steps
+        self.prioritized_sweeping = prioritized_sweeping
+        self.priority_threshold = priority_threshold
+
+    # Q-values are read and written as q[s][a] in both modes,
+    # which works for nested dictionaries and (S, A) arrays alike
+    def _planning_update(self, q, model, s, a, max_q, discount_rate):
+        target = model.expected_target(s, a, max_q, discount_rate)
+        q[s][a] += self.step_size*(target - q[s][a])
+
+    def _queue_predecessors(self, q, model, queue, s, max_q, discount_rate):
+        for ps, pa in model.predecessors.get(s, ()):
+            td_error = model.expected_target(ps, pa, max_q, discount_rate) - q[ps][pa]
+            queue.push((ps, pa), abs(td_error))
+
+    def _learn(self, q, model, queue, s, a, ns, r, max_q, discount_rate, rng):
+        model.record(s, a, ns, r)
+        # direct update from the real transition
+        q[s][a] += self.step_size*(r + discount_rate*max_q(ns) - q[s][a])
+        if not self.planning_steps:
+            return
+        if not self.prioritized_sweeping:
+            for _ in range(self.planning_steps):
+                ps, pa = rng.choice(model.state_actions)
+                self._planning_update(q, model, ps, pa, max_q, discount_rate)
+            return
+        td_error = model.expected_target(s, a, max_q, discount_rate) - q[s][a]
+        queue.push((s, a), abs(td_error))
+        self._queue_predecessors(q, model, queue, s, max_q, discount_rate)
+        for _ in range(self.planning_steps):
+            sa = queue.pop()
+            if sa is None:
+                break
+            ps, pa = sa
+            self._planning_update(q, model, ps, pa, max_q, discount_rate)
+            self._queue_predecessors(q, model, queue, ps, max_q, discount_rate)
+
+    def _training(self, mdp, rng, event_listener):
+        q = self._initial_q_table(mdp)
+        max_q = lambda ns: max(q[ns].values())
+        model, queue = EmpiricalModel(), _PriorityQueue(self.priority_threshold)
+        for ep in range(self.episodes):
+            s = mdp.initial_state_dist().sample(rng=rng)
+            while not mdp.is_terminal(s):
+                # select action
+                a = epsilon_softmax_sample(q[s], self.rand_choose, self.softmax_temp, rng)
+                # transition to next state
+                ns = mdp.next_state_dist(s, a).sample(rng=rng)
+                r = mdp.reward(s, a, ns)
+                # update model and Q-values, then plan
+                self._learn(q, model, queue, s, a, ns, r, max_q, mdp.discount_rate, rng)
+                # end of timestep
+                event_listener.end_of_timestep(locals())
+                s = ns
+            event_listener.end_of_episode(locals())
+        return q
+
+    def _indexed_training(self, engine, rng, event_listener):
+        q = engine.new_q_table()
+        nonterminal = engine.nonterminal
+        max_q = lambda ns: max(q[ns].tolist()) if nonterminal[ns] else 0.0
+        model, queue = EmpiricalModel(), _PriorityQueue(self.priority_threshold)
+        for ep in range(self.episodes):
+            s = engine.sample_initial_state(rng)
+            while nonterminal[s]:
+                a = engine.sample_action(q[s], s, self.rand_choose, self.softmax_temp, rng)
+                ns, r = engine.step(s, a, rng)
+                self._learn(q, model, queue, s, a, ns, r, max_q, engine.discount_rate, rng)
+                event_listener.end_of_timestep(locals())
+                s = ns
+            event_listener.end_of_episode(locals())
+        return q
@@ -1,56 +1,538 @@
 from scipy.special import softmax, logsumexp
+import scipy.sparse
+import scipy.sparse.csgraph
+import heapq
 import warnings
+from collections import namedtuple
 import numpy as np
-from collections import defaultdict
 from msdm.core.problemclasses.mdp import \
-    TabularMarkovDecisionProcess, TabularPolicy
-from msdm.core.algorithmclasses import Plans, PlanningResult
+    TabularMarkovDecisionProcess, ArrayPolicy
+from msdm.core.algorithmclasses import Plans, PlanningResult, NULL_INSTRUMENTATION
+from msdm.core.utils.arrayviews import ArrayMapping
+
+ValueIterationStep = namedtuple("ValueIterationStep", "iteration max_residual")
+
+class StateBackups:
+    def __init__(self, transition_matrix, state_action_rewards, action_matrix, discount_rate):
+        """
+        Single-state Bellman backups over a sparse (S*A, S) transition
+        matrix, along with the state-level successor and predecessor
+        graphs used to order asynchronous backups.
+        """
+        self.tf = tf = scipy.sparse.csr_matrix(transition_matrix)
+        self.n_states, self.n_actions = state_action_rewards.shape
+        self.sarf = state_action_rewards
+        self.log_am = np.log(action_matrix)
+        self.discount_rate = discount_rate
+        self.data = tf.data
+        self.indices = tf.indices
+        # offsets of each state's entries and the action of each entry
+        self.state_ptr = tf.indptr[::self.n_actions]
+        self.entry_action = np.repeat(np.arange(tf.shape[0]) % self.n_actions, np.diff(tf.indptr))
+        entry_state = np.repeat(np.arange(tf.shape[0]) // self.n_actions, np.diff(tf.indptr))
+        # successors[s, ns] is the total probability of s -> ns over actions
+        self.successors = scipy.sparse.csr_matrix(
+            (self.data, (entry_state, self.indices)),
+            shape=(self.n_states, self.n_states)
+        )
+        self.successors.eliminate_zeros()
+        self.predecessors = self.successors.T.tocsr()
+
+    def value(self, si, v):
+        lo, hi = self.state_ptr[si], self.state_ptr[si + 1]
+        future = np.bincount(
+            self.entry_action[lo:hi],
+            weights=self.data[lo:hi]*v[self.indices[lo:hi]],
+            minlength=self.n_actions
+        )
+        return np.max(self.sarf[si] + self.discount_rate*future + self.log_am[si])
+
+    def residuals(self, v):
+        q = self.sarf + self.discount_rate*(self.tf @ v).reshape(self.sarf.shape)
+        return np.abs(np.max(q + self.log_am, axis=-1) - v)
+
+    def sweep(self, v, states, convergence_mask):
+        """In-place Gauss-Seidel sweep. Returns the max change in value."""
+        max_diff = 0.
+        for si in states:
+            nv = self.value(si, v)
+            if convergence_mask[si]:
+                max_diff = max(max_diff, abs(nv - v[si]))
+            v[si] = nv
+        return max_diff
+
+    def goal_distance_order(self, goal_states):
+        """
+        States ordered by the fewest transitions needed to reach one
+        of `goal_states`, so that sweeps propagate values outward from goals.
+        States that cannot reach a goal come last.
+        """
+        if len(goal_states) == 0:
+            return np.arange(self.n_states)
+        dist = scipy.sparse.csgraph.dijkstra(
+            self.predecessors, indices=goal_states, unweighted=True, min_only=True
+        )
+        return np.argsort(dist, kind='stable')
+
+    def topological_components(self):
+        """
+        Strongly connected components of the state graph, ordered so that
+        every component comes after all components it can transition to.
+        """
+        n_components, labels = scipy.sparse.csgraph.connected_components(
+            self.successors, directed=True, connection='strong'
+        )
+        edges = self.successors.tocoo()
+        between = labels[edges.row] != labels[edges.col]
+        condensed = scipy.sparse.csr_matrix(
+            (np.ones(between.sum()), (labels[edges.row][between], labels[edges.col][between])),
+            shape=(n_components, n_components)
+        )
+        condensed.sum_duplicates()
+        condensed_predecessors = condensed.T.tocsr()
+        n_successors = np.diff(condensed.indptr)
+        ready = list(np.where(n_successors == 0)[0])
+        order = []
+        while ready:
+            c = ready.pop()
+            order.append(c)
+            for pc in condensed_predecessors.indices[condensed_predecessors.indptr[c]:condensed_predecessors.indptr[c + 1]]:
+                n_successors[pc] -= 1
+                if n_successors[pc] == 0:
+                    ready.append(pc)
+        return [np.where(labels == c)[0] for c in order]
+
+def asynchronous_value_iteration(
+    backups : StateBackups,
+    backup_order : str,
+    convergence_diff : float,
+    max_sweeps : int,
+    convergence_mask : np.array,
+    goal_states : np.array = (),
+):
+    """
+    Asynchronous value iteration, where each backup immediately
+    uses the latest values of other states.
+
+    Parameters
+    ----------
+    backup_order : str
+        "gauss-seidel" does in-place sweeps over all states, ordered
+        outward from `goal_states`.
+        "prioritized" repeatedly backs up the state with the largest
+        estimated Bellman residual. After each backup, predecessors are
+        re-prioritized by their transition probability times the change
+        in value (Moore & Atkeson, 1993).
+        "topological" sweeps each strongly connected component
+        to convergence, starting from components closest to terminal
+        states (Dai & Goldsmith, 2007).
+    max_sweeps : int
+        Maximum number of backups, in units of the number of states.
+    convergence_mask : np.array
+        States whose residuals are checked for convergence.
+    goal_states : np.array
+        Indices of states (e.g., terminal states) that sweeps are ordered from.
+
+    Returns
+    -------
+    The value vector, number of backups, and whether the values converged.
+    """
+    n_states = backups.n_states
+    max_backups = max_sweeps*n_states
+    v = np.zeros(n_states)
+    order = backups.goal_distance_order(goal_states)
+    if backup_order == "gauss-seidel":
+        for sweep in range(max_sweeps):
+            if backups.sweep(v, order, convergence_mask) < convergence_diff:
+                return v, (sweep + 1)*n_states, True
+        return v, max_backups, False
+
+    if backup_order == "topological":
+        rank = np.empty(n_states, dtype=int)
+        rank[order] = np.arange(n_states)
+        n_backups = 0
+        for component in backups.topological_components():
+            component = component[np.argsort(rank[component])]
+            for sweep in range(max_sweeps):
+                n_backups += len(component)
+                if backups.sweep(v, component, convergence_mask) < convergence_diff:
+                    break
+            else:
+                return v, n_backups, False
+        return v, n_backups, True
+
+    if backup_order == "prioritized":
+        pred_ptr, pred_idx, pred_prob = \
+            backups.predecessors.indptr, backups.predecessors.indices, backups.predecessors.data
+        n_backups = 0
+        while n_backups < max_backups:
+            # priorities are estimates, so convergence is checked on exact residuals
+            priority = backups.residuals(v)*convergence_mask
+            if priority.max() < convergence_diff:
+                return v, n_backups, True
+            heap = [(-p, si) for si, p in enumerate(priority) if p >= convergence_diff]
+            heapq.heapify(heap)
+            while heap and n_backups < max_backups:
+                neg_p, si = heapq.heappop(heap)
+                if -neg_p != priority[si]:
+                    continue # stale entry
+                nv = backups.value(si, v)
+                change = abs(nv - v[si])
+                v[si] = nv
+                priority[si] = 0.
+                n_backups += 1
+                lo, hi = pred_ptr[si], pred_ptr[si + 1]
+                for pred, prob in zip(pred_idx[lo:hi], pred_prob[lo:hi]):
+                    if not convergence_mask[pred]:
+                        continue
+                    p = max(priority[pred], backups.discount_rate*min(prob, 1.)*change)
+                    if p > priority[pred] and p >= convergence_diff:
+                        priority[pred] = p
+                        heapq.heappush(heap, (-p, pred))
+        return v, n_backups, False
+    raise ValueError(f"Unknown backup order: {backup_order}")
+
+def synchronous_value_iteration(
+    transition_matrix,
+    state_action_rewards : np.array,
+    action_matrix : np.array,
+    discount_rate : float,
+    convergence_diff : float,
+    iterations : int,
+    convergence_mask : np.array = None,
+    dtype=np.float64,
+    instrumentation=NULL_INSTRUMENTATION,
+):
+    """
+    Synchronous (Jacobi) value iteration with backups computed as
+    `Q = R + discount_rate * (T @ v)`, where T is an (S*A, S) dense
+    array or sparse matrix, and R is the (S, A) expected immediate reward.
+    Rows of T for terminal states should be masked out (or `discount_rate`
+    can be an (S, 1) array that is zero for them).
+    Dense backups reuse the same buffers across iterations.
+    If `instrumentation` is enabled, it receives a `ValueIterationStep`
+    after each iteration.
+
+    Returns
+    -------
+    The value vector, Q-values for that value vector, the Bellman
+    residuals of the value vector, the last iteration, and whether the values converged.
+    """
+    n_states, n_actions = state_action_rewards.shape
+    sparse = scipy.sparse.issparse(transition_matrix)
+    tf = transition_matrix.astype(dtype, copy=False)
+    if not sparse:
+        tf = np.ascontiguousarray(tf.reshape(n_states*n_actions, n_states))
+    sarf = state_action_rewards.astype(dtype)
+    log_am = np.log(action_matrix).astype(dtype)
+    discount_rate = np.asarray(discount_rate, dtype=dtype)
+
+    v = np.zeros(n_states, dtype=dtype)
+    nv = np.empty(n_states, dtype=dtype)
+    future = np.empty(n_states*n_actions, dtype=dtype)
+    q = np.empty((n_states, n_actions), dtype=dtype)
+    validq = np.empty((n_states, n_actions), dtype=dtype)
+    diff = np.empty(n_states, dtype=dtype)
+    abs_diff = np.empty(n_states, dtype=dtype)
+    on_iteration = instrumentation.iteration if instrumentation.enabled else None
+    for i in range(iterations):
+        if sparse:
+            future[:] = tf @ v
+        else:
+            np.dot(tf, v, out=future)
+        np.multiply(future.reshape(n_states, n_actions), discount_rate, out=q)
+        np.add(q, sarf, out=q)
+        np.add(q, log_am, out=validq)
+        np.max(validq, axis=-1, out=nv)
+        np.subtract(v, nv, out=diff)
+        if convergence_mask is not None:
+            np.multiply(diff, convergence_mask, out=diff)
+        np.abs(diff, out=abs_diff)
+        max_diff = abs_diff.max()
+        if on_iteration is not None:
+            on_iteration(ValueIterationStep(i, float(max_diff)))
+        if max_diff < convergence_diff:
+            return v, q, diff, i, True
+        v, nv = nv, v
+    return v, q, diff, i, False
+
+def batched_value_iteration(
+    transition_matrix,
+    state_action_rewards : np.array,
+    action_matrix : np.array,
+    discount_rate,
+    convergence_diff : float,
+    iterations : int,
+    convergence_mask : np.array = None,
+    dtype=np.float64,
+    instrumentation=NULL_INSTRUMENTATION,
+):
+    """
+    Synchronous value iteration on K MDPs that share an (S*A, S)
+    transition matrix T but have their own (K, S, A) expected rewards.
+    Each backup is a single product of T with the (S, K) matrix of values.
+    `discount_rate` broadcasts against (K, S, 1) (e.g., a scalar,
+    one rate per MDP as a (K, 1, 1) array, or a (K, S, 1) array that is
+    zero for terminal states), and `convergence_mask` against (K, S).
+    Each MDP is dropped from the batch once it has converged,
+    and iteration continues until every MDP has converged.
+    If `instrumentation` is enabled, it receives a `ValueIterationStep`
+    with the largest residual across MDPs after each iteration.
+
+    Returns
+    -------
+    The (K, S) value vectors, (K, S, A) Q-values for those values,
+    the Bellman residuals of the values, the iteration at which
+    each MDP converged, and whether each MDP converged.
+    """
+    n_mdps, n_states, n_actions = state_action_rewards.shape
+    sparse = scipy.sparse.issparse(transition_matrix)
+    tf = transition_matrix.astype(dtype, copy=False)
+    if not sparse:
+        tf = np.ascontiguousarray(tf.reshape(n_states*n_actions, n_states))
+    # values are stored state-major, with the batch as the trailing axis
+    sarf = np.ascontiguousarray(np.moveaxis(state_action_rewards, 0, -1), dtype=dtype)
+    log_am = np.log(action_matrix).astype(dtype)[:, :, None]
+    discount_rate = np.moveaxis(np.broadcast_to(
+        np.asarray(discount_rate, dtype=dtype), (n_mdps, n_states, 1)
+    ), 0, -1)
+    if convergence_mask is not None:
+        convergence_mask = np.broadcast_to(convergence_mask, (n_mdps, n_states)).T
+
+    v_out = np.empty((n_mdps, n_states), dtype=dtype)
+    q_out = np.empty((n_mdps, n_states, n_actions), dtype=dtype)
+    diff_out = np.empty((n_mdps, n_states), dtype=dtype)
+    converged = np.zeros(n_mdps, dtype=bool)
+    converged_iteration = np.full(n_mdps, iterations - 1)
+    # indices of the MDPs still being backed up
+    active = np.arange(n_mdps)
+    v = np.zeros((n_states, n_mdps), dtype=dtype)
+    on_iteration = instrumentation.iteration if instrumentation.enabled else None
+    for i in range(iterations):
+        if i == 0 or len(active) < n_active:
+            n_active = len(active)
+            nv = np.empty((n_states, n_active), dtype=dtype)
+            future = np.empty((n_states*n_actions, n_active), dtype=dtype)
+            q = np.empty((n_states, n_actions, n_active), dtype=dtype)
+            validq = np.empty((n_states, n_actions, n_active), dtype=dtype)
+            diff = np.empty((n_states, n_active), dtype=dtype)
+            abs_diff = np.empty((n_states, n_active), dtype=dtype)
+        if sparse:
+            future[:] = tf @ v
+        else:
+            np.dot(tf, v, out=future)
+        np.multiply(future.reshape(n_states, n_actions, n_active), discount_rate, out=q)
+        np.add(q, sarf, out=q)
+        np.add(q, log_am, out=validq)
+        np.max(validq, axis=1, out=nv)
+        np.subtract(v, nv, out=diff)
+        if convergence_mask is not None:
+            np.multiply(diff, convergence_mask, out=diff)
+        np.abs(diff, out=abs_diff)
+        max_diff = abs_diff.max(axis=0)
+        if on_iteration is not None:
+            on_iteration(ValueIterationStep(i, float(max_diff.max())))
+        newly_converged = max_diff < convergence_diff
+        if newly_converged.any():
+            # converged MDPs keep the values they converged with
+            # and are dropped from the batch
+            done = active[newly_converged]
+            converged[done] = True
+            converged_iteration[done] = i
+            v_out[done] = v[:, newly_converged].T
+            q_out[done] = np.moveaxis(q[..., newly_converged], -1, 0)
+            diff_out[done] = diff[:, newly_converged].T
+            if newly_converged.all():
+                break
+            keep = ~newly_converged
+            active = active[keep]
+            v = nv[:, keep]
+            sarf = np.ascontiguousarray(sarf[..., keep])
+            discount_rate = discount_rate[..., keep]
+            if convergence_mask is not None:
+                convergence_mask = convergence_mask[:, keep]
+            continue
+        v, nv = nv, v
+    else:
+        v_out[active] = v.T
+        q_out[active] = np.moveaxis(q, -1, 0)
+        diff_out[active] = diff.T
+    return v_out, q_out, diff_out, converged_iteration, converged
 
 class ValueIteration(Plans):
+    BACKUP_ORDERS = ("synchronous", "gauss-seidel", "prioritized", "topological")
     def __init__(self,
                  iterations=None,
                  convergence_diff=1e-5,
-                 check_unreachable_convergence=True
+                 check_unreachable_convergence=True,
+                 sparse=False,
+                 backup_order="synchronous",
+                 dtype=np.float64
                  ):
+        """
+        Parameters
+        ----------
+        sparse : bool
+            If True, Bellman backups are computed as sparse
+            matrix-vector products over `mdp.sparse_transition_matrix`
+            and the dense (S, A, S) matrices are never built.
+        backup_order : str
+            "synchronous" (the default) backs up all states at once
+            each iteration. "gauss-seidel", "prioritized", and "topological"
+            are asynchronous orderings that back up one state at a time
+            (see `asynchronous_value_iteration`). Asynchronous backups always
+            use the sparse transition matrix, and iterations are counted
+            as the number of backups divided by the number of states.
+        dtype : np.dtype
+            Floating point type used for synchronous backups.
+            np.float32 halves the memory traffic of each backup on large
+            problems, at the cost of precision (`convergence_diff` should
+            be well above float32 resolution at the scale of the values).
+        """
+        assert backup_order in self.BACKUP_ORDERS, f"backup_order must be one of {self.BACKUP_ORDERS}"
         self.iterations = iterations
         self.convergence_diff = convergence_diff
         self.check_unreachable_convergence = check_unreachable_convergence
+        self.sparse = sparse
+        self.backup_order = backup_order
+        self.dtype = dtype
 
     def plan_on(self, mdp: TabularMarkovDecisionProcess):
-        ss = mdp.state_list
-        tf = mdp.transition_matrix
-        rf = mdp.reward_matrix
-        nt = mdp.nonterminal_state_vec
-        rs = mdp.reachable_state_vec
-        am = mdp.action_matrix
+        instrumentation = self.instrumentation
+        with instrumentation.phase("compile", mdp) as model:
+            ss = model.state_list
+            nt = model.nonterminal_state_vec
+            rs = model.reachable_state_vec
+            am = model.action_matrix
 
-        # transition function goes nowhere
-        tf = tf*nt[:, None, None]
-        # reward function assigns 0 to all transitions out of a terminal
-        rf = rf*nt[:, None, None]
+            # reward function assigns 0 to all transitions out of a terminal
+            sarf = model.state_action_reward_matrix*nt[:, None]
+            if self.sparse or self.backup_order != "synchronous":
+                tf = model.sparse_transition_matrix
+            else:
+                tf = model.transition_matrix
 
         iterations = self.iterations
         if iterations is None:
             iterations = max(len(ss), int(1e5))
 
-        v = np.zeros(len(ss))
-        for i in range(iterations):
-            q = np.einsum("san,san->sa", tf, rf + mdp.discount_rate * v[None, None, :])
-            nv = np.max(q + np.log(am), axis=-1)
+        with instrumentation.phase("solve", mdp) as model:
+            v, q, diff, i, converged, n_backups = self._solve(model, tf, sarf, am, nt, rs, iterations)
+        instrumentation.count("bellman_backups", n_backups)
+
+        with instrumentation.phase("result"):
+            return self._planning_result(mdp, v, q, diff, i, converged, iterations)
+
+    def _solve(self, mdp, tf, sarf, am, nt, rs, iterations):
+        ss = mdp.state_list
+        if self.backup_order != "synchronous":
+            # transition function goes nowhere
+            tf = scipy.sparse.diags(np.repeat(nt, len(mdp.action_list))) @ tf
+            backups = StateBackups(tf, sarf, am, mdp.discount_rate)
+            convergence_mask = np.ones(len(ss), dtype=bool) if self.check_unreachable_convergence else rs.astype(bool)
+            v, n_backups, converged = asynchronous_value_iteration(
+                backups,
+                backup_order=self.backup_order,
+                convergence_diff=self.convergence_diff,
+                max_sweeps=iterations,
+                convergence_mask=convergence_mask,
+                goal_states=np.where(nt == 0)[0]
+            )
+            q = sarf + mdp.discount_rate * (tf @ v).reshape(sarf.shape)
+            diff = (v - np.max(q + np.log(am), axis=-1))*convergence_mask
+            i = int(np.ceil(n_backups/len(ss)))
+            return v, q, diff, i, converged, n_backups
+
+        # transition function goes nowhere
+        v, q, diff, i, converged = synchronous_value_iteration(
+            tf,
+            sarf,
+            am,
+            discount_rate=mdp.discount_rate*nt[:, None],
+            convergence_diff=self.convergence_diff,
+            iterations=iterations,
+            convergence_mask=None if self.check_unreachable_convergence else rs,
+            dtype=self.dtype,
+            instrumentation=self.instrumentation
+        )
+        return v, q, diff, i, converged, (i + 1)*len(ss)
+
+    def plan_on_batch(self, mdps):
+        """
+        Plans on several MDPs that share states, actions, transitions,
+        and terminal states, but differ in their rewards (and possibly
+        their discount rates), such as variants of a `GridWorld` with
+        different `feature_rewards` or `step_cost`. Bellman backups
+        for all the MDPs are computed together (see `batched_value_iteration`),
+        always synchronously.
+
+        Returns
+        -------
+        A list with a `PlanningResult` for each MDP.
+        """
+        mdps = list(mdps)
+        if len(mdps) == 0:
+            return []
+        instrumentation = self.instrumentation
+        mdp = mdps[0]
+        with instrumentation.phase("compile"):
+            if self.sparse:
+                tf = mdp.sparse_transition_matrix
+            else:
+                tf = mdp.transition_matrix
+            nt = mdp.nonterminal_state_vec
+            am = mdp.action_matrix
+            for other in mdps[1:]:
+                shared = (
+                    list(other.state_list) == list(mdp.state_list) and
+                    list(other.action_list) == list(mdp.action_list) and
+                    (other.nonterminal_state_vec == nt).all() and
+                    (other.action_matrix == am).all() and
+                    (other.sparse_transition_matrix != mdp.sparse_transition_matrix).nnz == 0
+                )
+                if not shared:
+                    raise ValueError("Batched planning requires MDPs with the same states, actions, and transitions")
+            sarf = np.stack([m.state_action_reward_matrix for m in mdps])*nt[None, :, None]
+            discount_rates = np.array([m.discount_rate for m in mdps])[:, None, None]
             if self.check_unreachable_convergence:
-                diff = (v - nv)
+                convergence_mask = None
             else:
-                diff = (v - nv)*rs
-            if np.abs(diff).max() < self.convergence_diff:
-                break
-            v = nv
+                convergence_mask = np.stack([m.reachable_state_vec for m in mdps])
 
+        iterations = self.iterations
+        if iterations is None:
+            iterations = max(len(mdp.state_list), int(1e5))
+        with instrumentation.phase("solve"):
+            v, q, diff, converged_iteration, converged = batched_value_iteration(
+                tf,
+                sarf,
+                am,
+                discount_rate=discount_rates*nt[None, :, None],
+                convergence_diff=self.convergence_diff,
+                iterations=iterations,
+                convergence_mask=convergence_mask,
+                dtype=self.dtype,
+                instrumentation=instrumentation
+            )
+        instrumentation.count("bellman_backups", int((converged_iteration + 1).sum())*len(mdp.state_list))
+
+        with instrumentation.phase("result"):
+            return [
+                self._planning_result(m, v[k], q[k], diff[k], converged_iteration[k], converged[k], iterations)
+                for k, m in enumerate(mdps)
+            ]
+
+    def _planning_result(self, mdp, v, q, diff, i, converged, iterations):
+        am = mdp.action_matrix
         validq = q + np.log(am)
-        pi = TabularPolicy.from_q_matrix(mdp.state_list, mdp.action_list, validq)
+        pi = ArrayPolicy.from_q_matrix(
+            mdp.state_list, mdp.action_list, validq,
+            state_index=mdp.state_index, action_index=mdp.action_index
+        )
 
         # create result object
         res = PlanningResult()
-        if i == (iterations - 1):
+        if not converged:
             warnings.warn(f"VI not converged after {iterations} iterations")
             res.converged = False
         else:
@@ -58,18 +540,13 @@ class ValueIteration(Plans):
         res.mdp = mdp
         res.policy = res.pi = pi
         res._valuevec = v
-        vf = dict()
-        for s, vi in zip(mdp.state_list, v):
-            vf[s] = vi
-        res.valuefunc = res.V = vf
+        res.valuefunc = res.V = ArrayMapping(v, (mdp.state_list,), (mdp.state_index,))
         res._qvaluemat = q
         res.iterations = i
         res.max_bellman_error = diff
-        qf = defaultdict(lambda : dict())
-        for si, s in enumerate(mdp.state_list):
-            for ai, a in enumerate(mdp.action_list):
-                qf[s][a] = q[si, ai]
-        res.actionvaluefunc = res.Q = qf
+        res.actionvaluefunc = res.Q = ArrayMapping(
+            q, (mdp.state_list, mdp.action_list), (mdp.state_index, mdp.action_index)
+        )
         res.initial_value = sum([res.V[s0]*p for s0, p in mdp.initial_state_dist().items()])
         return res
 
@@ -0,0 +1,4 @@
+from msdm.benchmarks.generators import Garnet, GENERATORS
+from msdm.benchmarks.runner import BenchmarkCase, SUITES, suite_cases, run_case, \
+    run_cases, run_suite, save_report, load_report, compare
+from msdm.benchmarks.learningcurves import CompiledTabularMDP, run_learning_curves
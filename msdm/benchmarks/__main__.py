@@ -0,0 +1,55 @@
+"""
+Command line entry point for the benchmarks, e.g.,
+
+    python -m msdm.benchmarks --suite small --output bench.json
+    python -m msdm.benchmarks --suite small --compare bench.json
+"""
+import argparse
+import json
+import sys
+
+from msdm.benchmarks.runner import SUITES, run_suite, save_report, load_report, compare
+
+def _print_record(record):
+    wall_time = "-" if record["wall_time"] is None else f"{record['wall_time']:.4f}s"
+    peak_rss = "-" if record["peak_rss"] is None else f"{record['peak_rss']/2**20:.1f}MB"
+    print(
+        f"{record['domain']:>18} {record['size']:>6} {record['algorithm']:>24} "
+        f"{record['status']:>8} {wall_time:>10} {peak_rss:>10} "
+        f"iterations={record['iterations']}",
+        file=sys.stderr
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run msdm benchmarks.")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="small")
+    parser.add_argument("--domains", nargs="*", default=None)
+    parser.add_argument("--algorithms", nargs="*", default=None)
+    parser.add_argument("--output", default=None, help="Path to write the JSON report to (default: stdout)")
+    parser.add_argument("--compare", default=None, help="Path to a baseline JSON report")
+    parser.add_argument("--tolerance", type=float, default=.25)
+    parser.add_argument("--no-isolate", action="store_true", help="Run all cases in this process")
+    args = parser.parse_args(argv)
+
+    report = run_suite(
+        suite=args.suite,
+        domains=args.domains,
+        algorithms=args.algorithms,
+        isolate=not args.no_isolate,
+        progress=_print_record,
+    )
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        save_report(report, args.output)
+
+    if args.compare is not None:
+        regressions = compare(load_report(args.compare), report, tolerance=args.tolerance)
+        for record in regressions:
+            print(f"REGRESSION: {record['domain']} {record['size']} {record['algorithm']} "
+                  f"{record['baseline_wall_time']} -> {record['wall_time']}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
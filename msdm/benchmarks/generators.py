@@ -0,0 +1,120 @@
+"""
+Scalable problem generators for benchmarks.
+"""
+import numpy as np
+
+from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
+from msdm.core.distributions import DictDistribution
+from msdm.domains import GridWorld
+from msdm.domains.gridmdp.windygridworld import WindyGridWorld
+from msdm.domains.loadunload import LoadUnload
+from msdm.domains.gridgame.tabulargridgame import TabularGridGame
+
+class Garnet(TabularMarkovDecisionProcess):
+    def __init__(
+        self,
+        n_states : int,
+        n_actions : int = 4,
+        branching : int = 3,
+        discount_rate : float = .95,
+        seed : int = 0
+    ):
+        """
+        A random Garnet MDP (Archibald, McKinnon & Thomas, 1995).
+        Every state-action leads to `branching` distinct next states
+        with probabilities drawn from a flat Dirichlet distribution, and
+        has a standard normal reward. The initial state is uniformly random
+        and there are no terminal states.
+        """
+        rng = np.random.default_rng(seed)
+        self.n_states = n_states
+        self.n_actions = n_actions
+        self.branching = branching
+        self.discount_rate = discount_rate
+        self.seed = seed
+        self.next_state_indices = np.array([
+            rng.choice(n_states, size=branching, replace=False)
+            for _ in range(n_states*n_actions)
+        ]).reshape(n_states, n_actions, branching)
+        self.next_state_probs = rng.dirichlet(np.ones(branching), size=(n_states, n_actions))
+        self.state_action_rewards = rng.normal(size=(n_states, n_actions))
+
+    def initial_state_dist(self):
+        return DictDistribution.uniform(range(self.n_states))
+
+    def actions(self, s):
+        return range(self.n_actions)
+
+    def next_state_dist(self, s, a):
+        return DictDistribution(zip(
+            self.next_state_indices[s, a].tolist(),
+            self.next_state_probs[s, a].tolist()
+        ))
+
+    def reward(self, s, a, ns):
+        return self.state_action_rewards[s, a]
+
+    def is_terminal(self, s):
+        return False
+
+def garnet(size, seed=0):
+    """A Garnet MDP with `size` states."""
+    return Garnet(n_states=size, seed=seed)
+
+def gridworld(size):
+    """A `size` x `size` GridWorld from one corner to the opposite one."""
+    rows = ['.'*size for _ in range(size)]
+    rows[0] = '.'*(size - 1) + 'g'
+    rows[-1] = 's' + '.'*(size - 1)
+    return GridWorld(
+        tile_array=rows,
+        feature_rewards={'g': 0},
+        step_cost=-1,
+        success_prob=.8,
+        discount_rate=.99
+    )
+
+def windy_gridworld(size):
+    """
+    A `size` x `size` WindyGridWorld with an upward wind
+    blowing through its middle column.
+    """
+    rows = []
+    for y in range(size):
+        row = ['.']*size
+        row[size//2] = '^'
+        rows.append(row)
+    rows[0][-1] = '$'
+    rows[-1][0] = '@'
+    return WindyGridWorld(
+        grid='\n'.join(''.join(row) for row in rows),
+        feature_rewards={'$': 0},
+        step_cost=-1,
+        wall_bump_cost=-1,
+        wind_probability=.5,
+        discount_rate=.99
+    )
+
+def loadunload(size):
+    """A LoadUnload POMDP with `size` locations."""
+    return LoadUnload(nstates=size)
+
+def tabular_grid_game(size):
+    """
+    A two-agent `size` x `size` TabularGridGame where
+    each agent's goal is in the opposite corner.
+    """
+    rows = [['.']*size for _ in range(size)]
+    rows[0][0], rows[0][-1] = 'A0', 'A1'
+    rows[-1][0], rows[-1][-1] = 'G1', 'G0'
+    walls = ['#']*(size + 2)
+    lines = [walls] + [['#'] + row + ['#'] for row in rows] + [walls]
+    return TabularGridGame('\n'.join(' '.join(line) for line in lines))
+
+GENERATORS = {
+    'garnet': garnet,
+    'gridworld': gridworld,
+    'windy_gridworld': windy_gridworld,
+    'loadunload': loadunload,
+    'tabular_grid_game': tabular_grid_game,
+}
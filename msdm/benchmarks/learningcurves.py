@@ -0,0 +1,314 @@
+"""
+Learning curves for temporal difference learners.
+
+A learning curve experiment trains every learner configuration with every
+seed on every domain and collects the sum of rewards of each episode.
+Domains are compiled once in the parent process and their arrays placed
+in shared memory, so that worker processes rebuild each domain from the
+shared arrays once instead of receiving a pickled copy with every task.
+"""
+import atexit
+import multiprocessing
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from types import SimpleNamespace
+from typing import Callable, Mapping, Sequence
+
+import numpy as np
+import scipy.sparse
+
+from msdm.core.algorithmclasses import Learns, Result
+from msdm.core.distributions import DictDistribution, UniformDistribution
+from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
+
+class CompiledTabularMDP(TabularMarkovDecisionProcess):
+    def __init__(
+        self,
+        state_list : Sequence,
+        action_list : Sequence,
+        arrays : Mapping[str, np.ndarray],
+        discount_rate : float,
+    ):
+        """
+        A tabular MDP defined by the compiled arrays of another one
+        (see `compile_arrays`), e.g., arrays in shared memory.
+        Its matrices are the arrays themselves, so they are never
+        recompiled, and its model methods look up the arrays, listing
+        actions and next states in the order of the original domain.
+        Distributions the original domain gave as `UniformDistribution`s
+        are also returned as uniform distributions, since those draw
+        from a random number generator differently.
+        """
+        self.discount_rate = discount_rate
+        self._arrays = arrays
+        self._n_actions = len(action_list)
+        shape = (len(arrays['indptr']) - 1, len(state_list))
+        self.set_compiled_matrices(
+            state_list=state_list,
+            action_list=action_list,
+            sparse_transition_matrix=scipy.sparse.csr_matrix(
+                (arrays['probs'], arrays['next_states'], arrays['indptr']), shape=shape, copy=False
+            ),
+            sparse_reward_matrix=scipy.sparse.csr_matrix(
+                (arrays['rewards'], arrays['next_states'], arrays['indptr']), shape=shape, copy=False
+            ),
+            action_matrix=arrays['action_matrix'],
+            initial_state_vec=arrays['initial_state_vec'],
+            nonterminal_state_vec=arrays['nonterminal_state_vec'],
+        )
+
+    def _row(self, s, a):
+        row = self.state_index[s]*self._n_actions + self.action_index[a]
+        indptr = self._arrays['indptr']
+        return indptr[row], indptr[row + 1]
+
+    def next_state_dist(self, s, a):
+        start, end = self._row(s, a)
+        ss = self.state_list
+        support = [ss[nsi] for nsi in self._arrays['next_states'][start:end]]
+        if self._arrays['uniform_rows'][self.state_index[s]*self._n_actions + self.action_index[a]]:
+            return DictDistribution.uniform(support)
+        return DictDistribution(zip(support, self._arrays['probs'][start:end].tolist()))
+
+    def reward(self, s, a, ns):
+        start, end = self._row(s, a)
+        entries = np.flatnonzero(self._arrays['next_states'][start:end] == self.state_index[ns])
+        if len(entries) == 0:
+            raise KeyError(f"{ns!r} is not a next state of state {s!r} and action {a!r}")
+        return float(self._arrays['rewards'][start + entries[0]])
+
+    def actions(self, s):
+        si = self.state_index[s]
+        indptr = self._arrays['action_indptr']
+        aa = self.action_list
+        return [aa[ai] for ai in self._arrays['actions'][indptr[si]:indptr[si + 1]]]
+
+    def initial_state_dist(self):
+        ss = self.state_list
+        s0 = self._arrays['initial_state_vec']
+        initial_states = self._arrays['initial_states']
+        if self._arrays['uniform_initial'][0]:
+            return DictDistribution.uniform([ss[si] for si in initial_states])
+        return DictDistribution({ss[si]: float(s0[si]) for si in initial_states})
+
+    def is_terminal(self, s):
+        return not self._arrays['nonterminal_state_vec'][self.state_index[s]]
+
+def compile_arrays(mdp : TabularMarkovDecisionProcess) -> dict:
+    """
+    The arrays defining a tabular MDP: transitions and rewards in CSR form
+    (`indptr`, `next_states`, `probs`, `rewards`) over rows
+    `si*len(action_list) + ai`, the actions of each state (`action_indptr`,
+    `actions`), along with its action matrix and initial and non-terminal
+    state vectors. Actions, next states and initial states
+    (`initial_states`) keep the order `mdp` gives them, and `uniform_rows`
+    and `uniform_initial` mark distributions `mdp` gives as
+    `UniformDistribution`s, so that a `CompiledTabularMDP` samples
+    the same states as `mdp` with the same random number generator.
+    """
+    tf = mdp.sparse_transition_matrix
+    rf = mdp.sparse_reward_matrix
+    row_ids = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+    if np.array_equal(rf.indptr, tf.indptr) and np.array_equal(rf.indices, tf.indices):
+        rewards = rf.data
+    else:
+        rewards = np.asarray(rf[row_ids, tf.indices]).ravel()
+    ss, aa = mdp.state_list, mdp.action_list
+    support_rank = np.zeros(len(tf.indices), dtype=np.int64)
+    uniform_rows = np.zeros(tf.shape[0], dtype=np.int64)
+    for row in np.flatnonzero(np.diff(tf.indptr)):
+        start, end = tf.indptr[row], tf.indptr[row + 1]
+        si, ai = divmod(row, len(aa))
+        dist = mdp.next_state_dist(ss[si], aa[ai])
+        rank = {mdp.state_index[ns]: i for i, ns in enumerate(dist.support)}
+        support_rank[start:end] = [rank.get(nsi, len(rank)) for nsi in tf.indices[start:end]]
+        uniform_rows[row] = isinstance(dist, UniformDistribution)
+    order = np.lexsort((support_rank, row_ids))
+    initial_dist = mdp.initial_state_dist()
+    initial_states = [mdp.state_index[s] for s in initial_dist.support if initial_dist.prob(s) > 0]
+    state_actions = [[mdp.action_index[a] for a in mdp.actions(s)] for s in ss]
+    return dict(
+        indptr=tf.indptr.astype(np.int64),
+        next_states=tf.indices[order].astype(np.int64),
+        probs=tf.data[order].astype(float),
+        rewards=np.asarray(rewards, dtype=float)[order],
+        uniform_rows=uniform_rows,
+        action_indptr=np.cumsum([0] + [len(aa) for aa in state_actions], dtype=np.int64),
+        actions=np.fromiter((ai for aa in state_actions for ai in aa), dtype=np.int64),
+        action_matrix=np.asarray(mdp.action_matrix, dtype=float),
+        initial_state_vec=np.asarray(mdp.initial_state_vec, dtype=float),
+        initial_states=np.asarray(initial_states, dtype=np.int64),
+        uniform_initial=np.array([isinstance(initial_dist, UniformDistribution)], dtype=np.int64),
+        nonterminal_state_vec=np.asarray(mdp.nonterminal_state_vec, dtype=np.int64),
+    )
+
+def _share_arrays(arrays):
+    """Copies arrays into shared memory blocks and returns the blocks and their specs."""
+    from multiprocessing import shared_memory
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+def _attach_arrays(specs):
+    """
+    Attaches to shared memory blocks created by `_share_arrays`.
+    The process that created them unlinks them, so attached blocks are
+    not tracked for cleanup where this can be turned off (Python >= 3.13).
+    On earlier versions, workers started by `run_learning_curves` share
+    the parent's resource tracker, which records each block once, so the
+    parent's unlink also clears the workers' registrations.
+    """
+    from multiprocessing import shared_memory
+    blocks, arrays = [], {}
+    for name, (block_name, shape, dtype) in specs.items():
+        try:
+            block = shared_memory.SharedMemory(name=block_name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+# State of each worker process, set up once by `_initialize_worker`
+_worker = SimpleNamespace(domains={}, learners=None, blocks=[])
+
+def _initialize_worker(domain_specs, learners):
+    _worker.learners = learners
+    for domain, (state_list, action_list, discount_rate, specs) in domain_specs.items():
+        blocks, arrays = _attach_arrays(specs)
+        _worker.blocks.extend(blocks)
+        _worker.domains[domain] = CompiledTabularMDP(state_list, action_list, arrays, discount_rate)
+    atexit.register(_close_worker_blocks)
+
+def _close_worker_blocks():
+    # arrays viewing a block need to be released before it is closed
+    _worker.domains.clear()
+    while _worker.blocks:
+        _worker.blocks.pop().close()
+
+def _train(mdp, learner_factory, seed):
+    learner = learner_factory(seed=seed)
+    res = learner.train_on(mdp)
+    return np.asarray(res.event_listener_results.episode_rewards, dtype=float)
+
+def _run_task(domain_index, domain, config_index, seed_index, seed):
+    rewards = _train(_worker.domains[domain], _worker.learners[config_index], seed)
+    return domain_index, config_index, seed_index, rewards
+
+def run_learning_curves(
+    domains : Mapping[str, TabularMarkovDecisionProcess],
+    learners : Mapping[str, Callable[..., Learns]],
+    seeds : Sequence[int],
+    parallel : bool = True,
+    max_workers : int = None,
+    progress : Callable[[int, int], None] = None,
+) -> Result:
+    """
+    Trains each learner configuration with each seed on each domain
+    and collects the sum of rewards of every episode.
+
+    Parameters
+    ----------
+    domains : Mapping[str, TabularMarkovDecisionProcess]
+        Named domains. Each is compiled once (see `compile_arrays`) and
+        learners are trained on a `CompiledTabularMDP` built from its arrays.
+    learners : Mapping[str, Callable[..., Learns]]
+        Named learner configurations. Each is called with a `seed`
+        keyword argument to create a learner, e.g.,
+        `functools.partial(QLearning, episodes=200, rand_choose=.1)`.
+        Learners need to use the default `EpisodeRewardEventListener`.
+    seeds : Sequence[int]
+        Seeds to train each configuration with
+    parallel : bool
+        If True, tasks run in a `ProcessPoolExecutor` whose workers
+        read the compiled domains from shared memory. Otherwise
+        they run one after another in this process, as they
+        also do, with a warning, where `multiprocessing.shared_memory`
+        is unavailable (Python < 3.8).
+    max_workers : int
+        Number of worker processes (defaults to the number of CPUs)
+    progress : Callable[[int, int], None]
+        Called with the number of finished and total tasks
+        as each task finishes
+
+    Returns
+    -------
+    A Result with `domains`, `learners` (the configuration names) and
+    `seeds`, and `episode_rewards`, a (domain, configuration, seed, episode)
+    array. If configurations train for different numbers of episodes,
+    missing episodes are NaN.
+    """
+    domain_names, learner_names, seeds = list(domains), list(learners), list(seeds)
+    factories = [learners[name] for name in learner_names]
+    tasks = [
+        (di, domain, ci, si, seed)
+        for di, domain in enumerate(domain_names)
+        for ci in range(len(factories))
+        for si, seed in enumerate(seeds)
+    ]
+    compiled = {
+        domain: (mdp.state_list, mdp.action_list, mdp.discount_rate, compile_arrays(mdp))
+        for domain, mdp in domains.items()
+    }
+    task_rewards = {}
+
+    def collect(di, ci, si, rewards):
+        task_rewards[di, ci, si] = rewards
+        if progress is not None:
+            progress(len(task_rewards), len(tasks))
+
+    if parallel:
+        try:
+            from multiprocessing import shared_memory  # noqa: F401
+        except ImportError:
+            warnings.warn("multiprocessing.shared_memory is unavailable; running learning curves serially")
+            parallel = False
+
+    if parallel:
+        blocks, domain_specs = [], {}
+        try:
+            for domain, (state_list, action_list, discount_rate, arrays) in compiled.items():
+                domain_blocks, specs = _share_arrays(arrays)
+                blocks.extend(domain_blocks)
+                domain_specs[domain] = (state_list, action_list, discount_rate, specs)
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_initialize_worker,
+                initargs=(domain_specs, factories),
+            ) as executor:
+                futures = [executor.submit(_run_task, *task) for task in tasks]
+                try:
+                    for future in as_completed(futures):
+                        collect(*future.result())
+                except BaseException:
+                    # otherwise leaving the executor waits for every queued task
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        mdps = {
+            domain: CompiledTabularMDP(state_list, action_list, arrays, discount_rate)
+            for domain, (state_list, action_list, discount_rate, arrays) in compiled.items()
+        }
+        for di, domain, ci, si, seed in tasks:
+            collect(di, ci, si, _train(mdps[domain], factories[ci], seed))
+
+    n_episodes = max((len(rewards) for rewards in task_rewards.values()), default=0)
+    episode_rewards = np.full((len(domain_names), len(factories), len(seeds), n_episodes), np.nan)
+    for (di, ci, si), rewards in task_rewards.items():
+        episode_rewards[di, ci, si, :len(rewards)] = rewards
+    return Result(
+        domains=domain_names,
+        learners=learner_names,
+        seeds=seeds,
+        episode_rewards=episode_rewards,
+    )
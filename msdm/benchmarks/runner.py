@@ -0,0 +1,233 @@
+"""
+Timing harness for planners, learners and model compilation.
+
+A benchmark case is a (domain, size, algorithm) triple. The special
+algorithm "compile" times `as_matrices()` on a fresh instance of the
+domain; every other algorithm is timed on an instance whose matrices
+have already been compiled, so that the two costs are reported separately.
+"""
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+import warnings
+from collections import namedtuple
+
+import numpy as np
+
+from msdm.algorithms import ValueIteration, PolicyIteration, LAOStar, LRTDP, \
+    PointBasedValueIteration, QLearning, SARSA, ExpectedSARSA, DoubleQLearning
+from msdm.benchmarks.generators import GENERATORS
+
+BenchmarkCase = namedtuple("BenchmarkCase", "domain size algorithm")
+
+COMPILE = "compile"
+
+ALGORITHMS = {
+    "ValueIteration": lambda: ValueIteration(),
+    "PolicyIteration": lambda: PolicyIteration(),
+    "LAOStar": lambda: LAOStar(heuristic=_zero_heuristic, seed=0),
+    "LRTDP": lambda: LRTDP(heuristic=_zero_heuristic, seed=0),
+    "PointBasedValueIteration": lambda: PointBasedValueIteration(
+        min_belief_expansions=10, max_belief_expansions=100
+    ),
+    "QLearning": lambda: QLearning(episodes=200, seed=0),
+    "SARSA": lambda: SARSA(episodes=200, seed=0),
+    "ExpectedSARSA": lambda: ExpectedSARSA(episodes=200, seed=0),
+    "DoubleQLearning": lambda: DoubleQLearning(episodes=200, seed=0),
+}
+
+_PLANNERS = ("ValueIteration", "PolicyIteration")
+_HEURISTIC_SEARCH = ("LAOStar", "LRTDP")
+_TD_LEARNERS = ("QLearning", "SARSA", "ExpectedSARSA", "DoubleQLearning")
+
+# Which algorithms apply to each domain. Heuristic search and TD learning
+# need episodes that end, so they are left out of the (non-episodic) Garnet
+# MDPs; LoadUnload is a POMDP; TabularGridGame only supports compilation.
+DOMAIN_ALGORITHMS = {
+    "garnet": (COMPILE, ) + _PLANNERS,
+    "gridworld": (COMPILE, ) + _PLANNERS + _HEURISTIC_SEARCH + _TD_LEARNERS,
+    "windy_gridworld": (COMPILE, ) + _PLANNERS + _HEURISTIC_SEARCH + _TD_LEARNERS,
+    "loadunload": (COMPILE, "PointBasedValueIteration"),
+    "tabular_grid_game": (COMPILE, ),
+}
+
+SUITES = {
+    "small": dict(garnet=[50], gridworld=[5], windy_gridworld=[5], loadunload=[8], tabular_grid_game=[3]),
+    "medium": dict(garnet=[500], gridworld=[15], windy_gridworld=[15], loadunload=[32], tabular_grid_game=[4]),
+    "large": dict(garnet=[2000], gridworld=[50], windy_gridworld=[50], loadunload=[128], tabular_grid_game=[5]),
+}
+
+def _zero_heuristic(s):
+    return 0.0
+
+def suite_cases(suite="small", domains=None, algorithms=None):
+    """
+    Lists the cases in a suite, optionally restricted to
+    a subset of domains and algorithms.
+    """
+    cases = []
+    for domain, sizes in SUITES[suite].items():
+        if domains is not None and domain not in domains:
+            continue
+        for size in sizes:
+            for algorithm in DOMAIN_ALGORITHMS[domain]:
+                if algorithms is not None and algorithm not in algorithms:
+                    continue
+                cases.append(BenchmarkCase(domain, size, algorithm))
+    return cases
+
+def _peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        # the resource module is Unix-only
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return peak
+    return peak*1024
+
+def _iterations(res):
+    for attr in ("iterations", "expansion_iterations"):
+        if getattr(res, attr, None) is not None:
+            return int(getattr(res, attr))
+    return None
+
+def _compile(problem):
+    if hasattr(problem, "as_matrices"):
+        return problem.as_matrices()
+    # stochastic games build their matrices property by property
+    return dict(
+        tf=problem.transitionmatrix,
+        am=problem.actionmatrix,
+        rf=problem.rewardmatrix,
+    )
+
+def run_case(case: BenchmarkCase) -> dict:
+    """
+    Runs a single case in the current process and returns a
+    JSON-serializable record of it. Peak RSS is that of the whole
+    process, so cases should be isolated (see `run_cases`)
+    for it to be meaningful. It is None where the `resource`
+    module is unavailable (e.g., on Windows).
+    """
+    record = dict(case._asdict(), status="ok", wall_time=None, iterations=None, n_states=None)
+    try:
+        problem = GENERATORS[case.domain](case.size)
+        if case.algorithm == COMPILE:
+            start = time.perf_counter()
+            _compile(problem)
+            record["wall_time"] = time.perf_counter() - start
+            record["n_states"] = len(problem.state_list)
+        else:
+            problem.as_matrices()
+            algorithm = ALGORITHMS[case.algorithm]()
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                start = time.perf_counter()
+                if case.algorithm in _TD_LEARNERS:
+                    res = algorithm.train_on(problem)
+                else:
+                    res = algorithm.plan_on(problem)
+                record["wall_time"] = time.perf_counter() - start
+            record["n_states"] = len(problem.state_list)
+            if case.algorithm in _TD_LEARNERS:
+                record["iterations"] = algorithm.episodes
+            else:
+                record["iterations"] = _iterations(res)
+    except ImportError as e:
+        # e.g., TabularGridGame needs the optional `sparse` package
+        record.update(status="skipped", error=repr(e))
+    except Exception as e:
+        record.update(status="error", error=repr(e))
+    record["peak_rss"] = _peak_rss_bytes()
+    return record
+
+def run_cases(cases, isolate=True, progress=None) -> list:
+    """
+    Runs each case and returns a list of records.
+
+    With `isolate=True`, each case runs in its own freshly spawned
+    process so that peak RSS and timings are not affected by
+    earlier cases. `progress` is called with each record as it finishes.
+    """
+    records = []
+    if isolate:
+        context = multiprocessing.get_context("spawn")
+        for case in cases:
+            with context.Pool(1, maxtasksperchild=1) as pool:
+                record = pool.apply(run_case, (case, ))
+            records.append(record)
+            if progress is not None:
+                progress(record)
+    else:
+        for case in cases:
+            record = run_case(case)
+            records.append(record)
+            if progress is not None:
+                progress(record)
+    return records
+
+def _git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+def run_suite(suite="small", domains=None, algorithms=None, isolate=True, progress=None) -> dict:
+    """
+    Runs a benchmark suite and returns a JSON-serializable report
+    with the environment it was run in and a record for every case.
+    """
+    cases = suite_cases(suite, domains=domains, algorithms=algorithms)
+    records = run_cases(cases, isolate=isolate, progress=progress)
+    return dict(
+        metadata=dict(
+            suite=suite,
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            git_commit=_git_commit(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+            platform=platform.platform(),
+            isolated=isolate,
+        ),
+        results=records,
+    )
+
+def save_report(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+def load_report(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def compare(baseline: dict, current: dict, tolerance=.25) -> list:
+    """
+    Compares two reports case by case. Returns a list of records for
+    cases whose wall time grew by more than a `tolerance` fraction of the
+    baseline, or that ran in the baseline but no longer do.
+    """
+    def key(record):
+        return (record["domain"], record["size"], record["algorithm"])
+    baseline_records = {key(r): r for r in baseline["results"]}
+    regressions = []
+    for record in current["results"]:
+        base = baseline_records.get(key(record))
+        if base is None or base["status"] != "ok":
+            continue
+        if record["status"] != "ok":
+            regressions.append(dict(record, baseline_wall_time=base["wall_time"], ratio=None))
+            continue
+        ratio = record["wall_time"]/max(base["wall_time"], 1e-12)
+        if ratio > 1 + tolerance:
+            regressions.append(dict(record, baseline_wall_time=base["wall_time"], ratio=ratio))
+    return regressions
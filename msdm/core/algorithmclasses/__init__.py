@@ -2,10 +2,18 @@ from abc import ABC, abstractmethod
 from typing import Iterable
 from msdm.core.problemclasses.problemclass import ProblemClass
 from msdm.core.assignment.assignmentmap import AssignmentMap
+from msdm.core.algorithmclasses.instrumentation import Instrumentation, Profiler, NULL_INSTRUMENTATION
 
 class Algorithm(ABC):
-    """Abstract superclass for all algorithms"""
-    pass
+    """
+    Abstract superclass for all algorithms.
+
+    Algorithms report phase timings, counters, and per-iteration payloads
+    to their `instrumentation`, which does nothing by default.
+    Assign an instance, e.g., `algorithm.instrumentation = Profiler()`,
+    to collect them.
+    """
+    instrumentation : Instrumentation = NULL_INSTRUMENTATION
 
 class Result(ABC):
     """Abstract superclass for all result objects"""
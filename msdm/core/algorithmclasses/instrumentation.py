@@ -0,0 +1,179 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, NamedTuple
+
+class Instrumentation:
+    '''
+    Instrumentation receives timings, counts, and per-iteration
+    payloads from an algorithm. Algorithms use it as follows:
+
+        with self.instrumentation.phase("solve", mdp) as model:
+            ...  # calls model methods on `model`
+        self.instrumentation.count("bellman_backups", n)
+        if self.instrumentation.enabled:
+            self.instrumentation.iteration(ValueIterationStep(...))
+
+    This base class does nothing. Algorithms check `enabled` before
+    building per-iteration payloads, so the default
+    instrumentation adds no work to their inner loops.
+    '''
+    enabled = False
+    _null_phase = nullcontext()
+
+    def phase(self, name: str, problem=None):
+        '''
+        Context manager for a named phase of an algorithm, e.g.,
+        "compile", "solve", or "result". If `problem` is given,
+        the context manager returns an object to use in its place
+        during the phase, through which calls to its model
+        (e.g., `next_state_dist`) may be counted. This base class
+        returns `problem` itself.
+        '''
+        if problem is None:
+            return self._null_phase
+        return nullcontext(problem)
+
+    def count(self, name: str, n: int = 1):
+        '''Increments a named counter.'''
+        pass
+
+    def iteration(self, payload: NamedTuple):
+        '''Records a per-iteration payload.'''
+        pass
+
+NULL_INSTRUMENTATION = Instrumentation()
+
+class Profiler(Instrumentation):
+    '''
+    Instrumentation that accumulates the wall time of each phase,
+    counters, and per-iteration payloads across every call
+    of the algorithms it is attached to.
+
+    Model calls made during a phase with a problem are counted
+    by the name of the method called (e.g., "model_calls.next_state_dist"),
+    and hits and misses of the problem's `method_cache`s
+    are counted as "cache_hits" and "cache_misses". Calls are counted
+    through a view of the problem that the phase returns: an instance of
+    a subclass of the problem's class with counting model methods that
+    shares the problem's attributes (and so its caches). The problem
+    itself is not modified. Each phase counts into its own counters,
+    which are added to `counters` when it ends, so calls the view
+    receives after its phase has ended are not counted. Model calls of
+    problems without a `__dict__` (e.g., with `__slots__`) are not counted.
+    '''
+    enabled = True
+    MODEL_METHODS = (
+        "next_state_dist", "reward", "actions", "is_terminal",
+        "initial_state_dist", "observation_dist",
+    )
+
+    def __init__(
+        self,
+        callback: Callable[[NamedTuple], None] = None,
+        record_iterations: bool = True
+    ):
+        '''
+        Parameters
+        ----------
+        callback : Callable[[NamedTuple], None]
+            Called with each per-iteration payload.
+        record_iterations : bool
+            Whether to keep per-iteration payloads in `iterations`.
+        '''
+        self.callback = callback
+        self.record_iterations = record_iterations
+        self.reset()
+
+    def reset(self):
+        self.phase_times = defaultdict(float)
+        self.phase_calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.iterations = []
+
+    @contextmanager
+    def phase(self, name: str, problem=None):
+        if problem is not None:
+            problem, end_counting = self._count_model_calls(problem)
+        start = time.perf_counter()
+        try:
+            yield problem
+        finally:
+            self.phase_times[name] += time.perf_counter() - start
+            self.phase_calls[name] += 1
+            if problem is not None:
+                end_counting()
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] += n
+
+    def iteration(self, payload: NamedTuple):
+        if self.record_iterations:
+            self.iterations.append(payload)
+        if self.callback is not None:
+            self.callback(payload)
+
+    def summary(self) -> dict:
+        '''A JSON-serializable summary of phase times and counters.'''
+        return dict(
+            phase_times=dict(self.phase_times),
+            phase_calls=dict(self.phase_calls),
+            counters=dict(self.counters),
+            n_iterations=len(self.iterations),
+        )
+
+    def _cache_stats(self, problem):
+        hits, misses = 0, 0
+        for attr, stats in getattr(problem, "__dict__", {}).items():
+            if attr.startswith("_cache_info_"):
+                hits += stats['hits']
+                misses += stats['misses']
+        return hits, misses
+
+    def _count_model_calls(self, problem):
+        # Views made by this profiler are already being counted, so nested
+        # phases on the same problem are counted by the outermost one.
+        view_class = type(problem)
+        if getattr(view_class, "_profiler", None) is self and view_class._profiler_calls is not None:
+            return problem, lambda: None
+        attrs = getattr(problem, "__dict__", None)
+        if attrs is None:
+            return problem, lambda: None
+        calls = defaultdict(int)
+        view_class = self._view_class(type(problem), calls)
+        view = object.__new__(view_class)
+        view.__dict__ = attrs
+        hits, misses = self._cache_stats(problem)
+
+        def end_counting():
+            view_class._profiler_calls = None
+            for name, n in calls.items():
+                self.counters["model_calls." + name] += n
+            end_hits, end_misses = self._cache_stats(problem)
+            self.counters["cache_hits"] += end_hits - hits
+            self.counters["cache_misses"] += end_misses - misses
+        return view, end_counting
+
+    def _view_class(self, cls, calls):
+        # Each phase gets its own class, so phases that overlap
+        # (e.g., in different threads) count calls separately.
+        namespace = dict(
+            _profiler=self,
+            _profiler_calls=calls,
+            __module__=cls.__module__,
+            __qualname__=cls.__qualname__,
+        )
+        for name in self.MODEL_METHODS:
+            if callable(getattr(cls, name, None)):
+                namespace[name] = self._counting_method(name)
+        return type(cls)(cls.__name__, (cls,), namespace)
+
+    def _counting_method(self, name):
+        def counted(view, *args, **kwargs):
+            view_class = type(view)
+            calls = view_class._profiler_calls
+            if calls is not None:
+                calls[name] += 1
+            return getattr(super(view_class, view), name)(*args, **kwargs)
+        counted.__name__ = name
+        return counted
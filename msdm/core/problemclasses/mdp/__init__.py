@@ -3,4 +3,6 @@ from msdm.core.problemclasses.mdp.deterministic_shortest_path import *
 from msdm.core.problemclasses.mdp.tabularmdp import *
 from msdm.core.problemclasses.mdp.quicktabularmdp import QuickTabularMDP
 from msdm.core.problemclasses.mdp.quickmdp import QuickMDP
+from msdm.core.problemclasses.mdp.matrixcache import MatrixCache
+from msdm.core.problemclasses.mdp.batchsimulator import BatchSimulator
 from msdm.core.problemclasses.mdp.policy import *
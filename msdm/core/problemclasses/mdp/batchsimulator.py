@@ -0,0 +1,160 @@
+import numpy as np
+
+from msdm.core.problemclasses.mdp.tabularmdp import TabularMarkovDecisionProcess
+from msdm.core.problemclasses.mdp.policy.policy import Policy
+from msdm.core.problemclasses.mdp.policy.tabularpolicy import ArrayPolicy
+from msdm.core.algorithmclasses import Result
+
+def row_cumulative_probabilities(indptr, probs):
+    """
+    Cumulative probabilities of the entries of each row of a CSR
+    array of probabilities, accumulated within rows (so the last
+    entry of each row holds the row's total).
+    """
+    cumulative = np.array(probs, dtype=float)
+    row_sizes = np.diff(indptr)
+    row_starts = np.asarray(indptr[:-1])
+    for k in range(1, row_sizes.max(initial=0)):
+        entries = row_starts[row_sizes > k] + k
+        cumulative[entries] += cumulative[entries - 1]
+    return cumulative
+
+def search_rows(cumulative, starts, ends, u):
+    """
+    For each row, given by the range of entries `[starts, ends)` in
+    `cumulative` (see `row_cumulative_probabilities`), the first entry
+    whose cumulative probability exceeds `u`, or the row's last entry if
+    none does. Rows must not be empty. This is a binary search within
+    each row, run for all rows at once.
+    """
+    lo, hi = np.array(starts), np.asarray(ends) - 1
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi)//2
+        right = cumulative[mid] <= u
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+        active = lo < hi
+    return lo
+
+class BatchSimulator:
+    def __init__(self, mdp: TabularMarkovDecisionProcess):
+        """
+        Simulates many episodes of a tabular MDP in lockstep.
+
+        States and actions are represented by their indices in
+        `mdp.state_list` and `mdp.action_list`. Next states are sampled
+        by inverse-CDF lookup: the transition probabilities of each row
+        (state-action) of `mdp.as_matrices(sparse=True)['tf']` are
+        accumulated once, and sampling a batch of transitions is a
+        binary search within each of their rows (see `search_rows`).
+        """
+        mats = mdp.as_matrices(sparse=True)
+        tf, rf = mats['tf'], mats['rf']
+        self.mdp = mdp
+        self.n_states = len(mats['ss'])
+        self.n_actions = len(mats['aa'])
+        self.nonterminal = mats['nt'].astype(bool)
+        self.discount_rate = mdp.discount_rate
+
+        self._next_state_indices = tf.indices
+        self._row_starts = tf.indptr[:-1]
+        self._row_ends = tf.indptr[1:]
+        # cumulative probabilities within each row
+        self._row_cumulative = row_cumulative_probabilities(tf.indptr, tf.data)
+        self._row_totals = np.zeros(tf.shape[0])
+        nonempty = self._row_ends > self._row_starts
+        self._row_totals[nonempty] = self._row_cumulative[self._row_ends[nonempty] - 1]
+        if np.array_equal(rf.indptr, tf.indptr) and np.array_equal(rf.indices, tf.indices):
+            self._rewards = rf.data
+        else:
+            row_ids = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+            self._rewards = np.asarray(rf[row_ids, tf.indices]).ravel()
+        self._initial_cumulative = np.cumsum(mats['s0'])
+
+    def initial_state_indices(self, n, rng: np.random.Generator):
+        draws = rng.random(n)*self._initial_cumulative[-1]
+        return np.minimum(
+            np.searchsorted(self._initial_cumulative, draws, side='right'),
+            self.n_states - 1
+        )
+
+    def step(self, state_indices, action_indices, rng: np.random.Generator):
+        """
+        Samples next state indices and rewards for arrays
+        of state and action indices.
+        """
+        rows = state_indices*self.n_actions + action_indices
+        starts, ends = self._row_starts[rows], self._row_ends[rows]
+        empty = np.flatnonzero(ends <= starts)
+        if len(empty) > 0:
+            si, ai = np.divmod(rows[empty[0]], self.n_actions)
+            raise ValueError(f"Action {ai} has no next states at state {si}; it may be unavailable")
+        draws = rng.random(len(rows))*self._row_totals[rows]
+        entries = search_rows(self._row_cumulative, starts, ends, draws)
+        return self._next_state_indices[entries], self._rewards[entries]
+
+    def simulate(
+        self,
+        policy: Policy,
+        n_episodes: int,
+        max_steps: int,
+        rng: np.random.Generator = None,
+        initial_state_indices=None,
+    ) -> Result:
+        """
+        Runs `n_episodes` episodes of up to `max_steps` steps.
+        As in `Policy.run_on`, an episode ends when it reaches a
+        terminal state, and no action is taken in that state.
+
+        Returns
+        -------
+        A Result with (n_episodes, T) arrays `state_indices`, `action_indices`,
+        `next_state_indices`, and `rewards`, where T is the length of the longest
+        episode. Steps after an episode has ended are padded with -1 (or
+        0 for rewards) and are False in `mask`. `lengths` holds the number of
+        steps in each episode and `returns` each episode's discounted return.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        ss, aa = self.mdp.state_list, self.mdp.action_list
+        if not (isinstance(policy, ArrayPolicy) and policy.states is ss and policy.actions is aa):
+            policy = ArrayPolicy(
+                ss, aa, policy.as_matrix(ss, aa),
+                state_index=self.mdp.state_index,
+                action_index=self.mdp.action_index
+            )
+
+        if initial_state_indices is None:
+            s = self.initial_state_indices(n_episodes, rng)
+        else:
+            s = np.array(initial_state_indices, dtype=int)
+        state_indices = np.full((n_episodes, max_steps), -1)
+        action_indices = np.full((n_episodes, max_steps), -1)
+        next_state_indices = np.full((n_episodes, max_steps), -1)
+        rewards = np.zeros((n_episodes, max_steps))
+        t = 0
+        for t in range(max_steps):
+            active = np.flatnonzero(self.nonterminal[s])
+            if len(active) == 0:
+                break
+            a = policy.sample_action_indices(s[active], rng=rng)
+            ns, r = self.step(s[active], a, rng)
+            state_indices[active, t] = s[active]
+            action_indices[active, t] = a
+            next_state_indices[active, t] = ns
+            rewards[active, t] = r
+            s[active] = ns
+        else:
+            t = max_steps
+        mask = state_indices[:, :t] >= 0
+        discounts = self.discount_rate**np.arange(t)
+        return Result(
+            state_indices=state_indices[:, :t],
+            action_indices=action_indices[:, :t],
+            next_state_indices=next_state_indices[:, :t],
+            rewards=rewards[:, :t],
+            mask=mask,
+            lengths=mask.sum(axis=1),
+            returns=rewards[:, :t] @ discounts,
+        )
@@ -0,0 +1,196 @@
+import os
+import re
+import shutil
+import pickle
+import hashlib
+import logging
+import numpy as np
+import scipy.sparse
+
+from msdm.core.problemclasses.mdp.tabularmdp import TabularMarkovDecisionProcess
+
+logger = logging.getLogger(__name__)
+
+class MatrixCache:
+    DENSE_MATRICES = (
+        'transition_matrix',
+        'reward_matrix',
+    )
+    SPARSE_MATRICES = (
+        'sparse_transition_matrix',
+        'sparse_reward_matrix',
+    )
+    VECTORS = (
+        'state_action_reward_matrix',
+        'action_matrix',
+        'initial_state_vec',
+        'nonterminal_state_vec',
+        'reachable_state_vec',
+        'absorbing_state_vec',
+    )
+    def __init__(self, directory, max_bytes=None):
+        """
+        An on-disk cache of the matrices of tabular MDPs.
+
+        Entries are keyed by a fingerprint of the MDP's class
+        and attributes (see `fingerprint`). Each matrix is stored
+        as a `.npy` file and loaded with `np.load(mmap_mode='r')`,
+        so processes using the same entry share memory and
+        the loaded arrays are read-only.
+
+        Parameters
+        ----------
+        directory : str
+            Directory holding cache entries. It is created if needed.
+        max_bytes : int
+            If set, least recently used entries are evicted
+            whenever the total size of the cache exceeds this.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def fingerprint(cls, mdp: TabularMarkovDecisionProcess) -> str:
+        """
+        A content hash of an MDP's class and attributes (excluding
+        computed caches). Raises a ValueError if any attribute
+        has no stable representation (e.g., functions or lambdas).
+        """
+        params = {
+            k: v for k, v in vars(mdp).items()
+            if not k.startswith('_cache')
+        }
+        description = repr((
+            type(mdp).__module__,
+            type(mdp).__qualname__,
+            _canonical(params)
+        ))
+        if re.search(r' at 0x[0-9a-fA-F]+', description):
+            raise ValueError(
+                f"Cannot fingerprint {type(mdp).__name__}: an attribute has no stable representation."
+            )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def as_matrices(self, mdp: TabularMarkovDecisionProcess, sparse=False):
+        """
+        Loads the MDP's matrices from the cache, computing and storing any
+        that are missing, and returns `mdp.as_matrices(sparse=sparse)`.
+        The loaded arrays are also set as the MDP's cached
+        matrix properties, so algorithms run on `mdp` use them directly.
+        """
+        key = self.fingerprint(mdp)
+        entry = os.path.join(self.directory, key)
+        if not self._load_state_action_lists(mdp, entry):
+            shutil.rmtree(entry, ignore_errors=True)
+            os.makedirs(entry, exist_ok=True)
+            self._atomic_write(
+                os.path.join(entry, 'lists.pkl'),
+                lambda f: pickle.dump((list(mdp.state_list), list(mdp.action_list)), f)
+            )
+        names = self.SPARSE_MATRICES if sparse else self.DENSE_MATRICES
+        for name in names + self.VECTORS:
+            self._load_or_store(mdp, entry, name, is_sparse=name in self.SPARSE_MATRICES)
+        os.utime(entry)
+        self._evict(keep=key)
+        return mdp.as_matrices(sparse=sparse)
+
+    def invalidate(self, mdp: TabularMarkovDecisionProcess):
+        """Removes the cache entry for an MDP."""
+        shutil.rmtree(os.path.join(self.directory, self.fingerprint(mdp)), ignore_errors=True)
+
+    def clear(self):
+        """Removes all cache entries."""
+        for key in self.keys():
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+    def keys(self):
+        return [
+            k for k in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, k))
+        ]
+
+    def entry_size(self, key):
+        entry = os.path.join(self.directory, key)
+        return sum(
+            os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+        )
+
+    def total_size(self):
+        return sum(self.entry_size(k) for k in self.keys())
+
+    def _load_state_action_lists(self, mdp, entry):
+        """
+        Installs the cached state and action orderings on the MDP
+        when it has not computed its own. Returns False if there
+        is no usable entry.
+        """
+        path = os.path.join(entry, 'lists.pkl')
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            state_list, action_list = pickle.load(f)
+        for name, cached in [('state_list', state_list), ('action_list', action_list)]:
+            if not hasattr(mdp, '_cached_'+name):
+                setattr(mdp, '_cached_'+name, cached)
+        if list(mdp.state_list) != state_list or list(mdp.action_list) != action_list:
+            logger.info(f"Cached state/action ordering does not match {type(mdp).__name__}; rebuilding entry.")
+            return False
+        return True
+
+    def _load_or_store(self, mdp, entry, name, is_sparse):
+        attr = '_cached_'+name
+        if is_sparse:
+            parts = ['data', 'indices', 'indptr']
+            paths = [os.path.join(entry, f'{name}.{part}.npy') for part in parts]
+        else:
+            paths = [os.path.join(entry, f'{name}.npy')]
+        if all(os.path.exists(p) for p in paths):
+            if not hasattr(mdp, attr):
+                arrays = [np.load(p, mmap_mode='r') for p in paths]
+                if is_sparse:
+                    shape = (len(mdp.state_list)*len(mdp.action_list), len(mdp.state_list))
+                    matrix = scipy.sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+                else:
+                    matrix = arrays[0]
+                setattr(mdp, attr, matrix)
+            return
+        matrix = getattr(mdp, name)
+        arrays = [matrix.data, matrix.indices, matrix.indptr] if is_sparse else [matrix]
+        for path, array in zip(paths, arrays):
+            self._atomic_write(path, lambda f: np.save(f, np.asarray(array)))
+
+    def _atomic_write(self, path, write):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        sizes = {k: self.entry_size(k) for k in self.keys()}
+        total = sum(sizes.values())
+        last_used = sorted(sizes, key=lambda k: os.path.getmtime(os.path.join(self.directory, k)))
+        for key in last_used:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= sizes[key]
+
+def _canonical(obj):
+    """
+    A representation of an object that does not depend on
+    hash-based iteration order.
+    """
+    if isinstance(obj, dict):
+        return ('dict', sorted((repr(_canonical(k)), _canonical(v)) for k, v in obj.items()))
+    if isinstance(obj, (set, frozenset)):
+        return ('set', sorted(repr(_canonical(e)) for e in obj))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, [_canonical(e) for e in obj])
+    if isinstance(obj, np.ndarray):
+        return ('ndarray', obj.dtype.str, obj.shape, hashlib.sha256(obj.tobytes()).hexdigest())
+    return repr(obj)
@@ -1,2 +1,2 @@
-from msdm.core.problemclasses.mdp.policy.tabularpolicy import TabularPolicy
+from msdm.core.problemclasses.mdp.policy.tabularpolicy import TabularPolicy, ArrayPolicy
 from msdm.core.problemclasses.mdp.policy.policy import Policy
@@ -1,10 +1,15 @@
-from typing import Mapping, Hashable, Sequence
+from typing import Hashable, Sequence
+from collections.abc import Mapping
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
 import math
 
 from msdm.core.problemclasses.mdp.policy.policy import Policy
 from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.algorithmclasses import Result
+from msdm.core.utils.arrayviews import ArrayMapping
+from msdm.core.utils.funcutils import cached_property
 
 from msdm.core.distributions import DictDistribution, \
     DeterministicDistribution, UniformDistribution, SoftmaxDistribution
@@ -67,30 +72,185 @@ class TabularPolicy(dict, Policy):
                 matrix[si, ai] = adist.prob(a)
         return matrix
 
-    def evaluate_on(self, mdp: TabularMarkovDecisionProcess) -> Result:
-        mats = mdp.as_matrices()
-        ss, aa, s0, tf, rf, rs, nt = \
-            [mats[k] for k in ['ss', 'aa', 's0', 'tf', 'rf', 'rs', 'nt']]
-        pi = self.as_matrix(ss, aa)
+    def evaluate_on(self, mdp: TabularMarkovDecisionProcess, sparse=False) -> Result:
+        """
+        Exact policy evaluation. If `sparse` is True, this solves
+        sparse linear systems built from the sparse form of the
+        MDP's transition matrix.
+        """
+        return _evaluate_policy_matrix(
+            self, self.as_matrix(mdp.state_list, mdp.action_list), mdp, sparse
+        )
+
+class ArrayPolicy(Mapping, Policy):
+    """
+    A tabular policy stored as an (S, A) matrix of action probabilities.
+    Action distributions are only built when a state's distribution
+    is requested, so making one from planner output does not loop
+    over states.
+    """
+    def __init__(
+        self,
+        states: Sequence,
+        actions: Sequence,
+        policy_matrix: np.array,
+        state_index: Mapping = None,
+        action_index: Mapping = None,
+    ):
+        assert policy_matrix.shape == (len(states), len(actions))
+        if state_index is None:
+            state_index = {s: i for i, s in enumerate(states)}
+        if action_index is None:
+            action_index = {a: i for i, a in enumerate(actions)}
+        self.states = states
+        self.actions = actions
+        self.policy_matrix = policy_matrix
+        self.state_index = state_index
+        self.action_index = action_index
+        self._action_dists = {}
+
+    @classmethod
+    def from_matrix(cls, states, actions, policy_matrix: np.array, state_index=None, action_index=None):
+        assert policy_matrix.shape == (len(states), len(actions))
+        row_sums = policy_matrix.sum(axis=-1)
+        assert np.allclose(row_sums, 1), f"Sums to {row_sums[~np.isclose(row_sums, 1)]}"
+        return cls(states, actions, policy_matrix, state_index, action_index)
+
+    @classmethod
+    def from_tabular_policy(cls, policy: TabularPolicy, states, actions):
+        return cls(states, actions, policy.as_matrix(states, actions))
+
+    def to_tabular_policy(self) -> TabularPolicy:
+        return TabularPolicy.from_matrix(self.states, self.actions, self.policy_matrix)
+
+    @classmethod
+    def from_q_matrix(
+        cls, states, actions, q: np.array,
+        inverse_temperature=float('inf'), state_index=None, action_index=None
+    ):
+        assert q.shape == (len(states), len(actions))
+        if inverse_temperature == float('inf'):
+            atol = np.nanmax(np.abs(np.spacing(q)))
+            policy_ismax = \
+                np.isclose(q, np.max(q, axis=-1, keepdims=True), rtol=0.0, atol=atol)
+            policy_matrix = policy_ismax/policy_ismax.sum(axis=-1, keepdims=True)
+        else:
+            logits = inverse_temperature*(q - np.max(q, axis=-1, keepdims=True))
+            policy_matrix = np.exp(logits)
+            policy_matrix /= policy_matrix.sum(axis=-1, keepdims=True)
+        return cls(states, actions, policy_matrix, state_index, action_index)
+
+    def action_dist(self, s):
+        if s in self._action_dists:
+            return self._action_dists[s]
+        probs = self.policy_matrix[self.state_index[s]]
+        support = np.flatnonzero(probs)
+        if len(support) == 1:
+            adist = DeterministicDistribution(self.actions[support[0]])
+        elif (probs[support] == probs[support[0]]).all():
+            adist = UniformDistribution([self.actions[ai] for ai in support])
+        else:
+            adist = DictDistribution({self.actions[ai]: probs[ai] for ai in support})
+        self._action_dists[s] = adist
+        return adist
+
+    def __getitem__(self, s):
+        return self.action_dist(s)
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, s):
+        return s in self.state_index
+
+    @cached_property
+    def cumulative_policy_matrix(self):
+        return np.cumsum(self.policy_matrix, axis=-1)
+
+    def sample_action_indices(self, state_indices, rng: np.random.Generator = None):
+        """
+        Samples an action index for each state index by
+        looking up uniform draws in the cumulative action
+        probabilities of each state.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+        cumulative = self.cumulative_policy_matrix[state_indices]
+        draws = rng.random(cumulative.shape[:-1])*cumulative[..., -1]
+        action_indices = (cumulative <= draws[..., None]).sum(axis=-1)
+        return np.minimum(action_indices, len(self.actions) - 1)
+
+    def sample_actions(self, states, rng: np.random.Generator = None):
+        """Samples an action for each of a sequence of states."""
+        state_indices = np.array([self.state_index[s] for s in states], dtype=int)
+        return [self.actions[ai] for ai in self.sample_action_indices(state_indices, rng)]
+
+    def as_matrix(self, states, actions, matrix=None):
+        if matrix is None:
+            matrix = np.zeros((len(states), len(actions)))
+        matrix[:, :] = self._reindexed_matrix(states, actions)
+        return matrix
+
+    def _reindexed_matrix(self, states, actions):
+        """
+        The policy matrix for another ordering of states and actions.
+        This is the stored matrix itself when the orderings are the same.
+        """
+        same_states = states is self.states or list(states) == list(self.states)
+        same_actions = actions is self.actions or list(actions) == list(self.actions)
+        if same_states and same_actions:
+            return self.policy_matrix
+        if same_states:
+            rows = slice(None)
+        else:
+            rows = np.array([self.state_index[s] for s in states], dtype=int)
+        cols = np.array([self.action_index.get(a, -1) for a in actions], dtype=int)
+        return self.policy_matrix[rows][:, cols]*(cols >= 0)
+
+    def evaluate_on(self, mdp: TabularMarkovDecisionProcess, sparse=False) -> Result:
+        """
+        Exact policy evaluation. If `sparse` is True, this solves
+        sparse linear systems built from the sparse form of the
+        MDP's transition matrix.
+        """
+        return _evaluate_policy_matrix(
+            self, self._reindexed_matrix(mdp.state_list, mdp.action_list), mdp, sparse
+        )
+
+def _evaluate_policy_matrix(policy, pi, mdp, sparse):
+    """Evaluates `policy`, given as the (S, A) matrix `pi` in the MDP's state and action order."""
+    mats = mdp.as_matrices(sparse=sparse)
+    ss, aa, s0, tf, rf, rs, nt = \
+        [mats[k] for k in ['ss', 'aa', 's0', 'tf', 'rf', 'rs', 'nt']]
+    if sparse:
+        sarf = mats['sarf']
+        pi_op = scipy.sparse.csr_matrix(
+            (pi.ravel(), (np.repeat(np.arange(len(ss)), len(aa)), np.arange(len(ss)*len(aa)))),
+            shape=(len(ss), len(ss)*len(aa))
+        )
+        mp = scipy.sparse.diags(rs) @ (pi_op @ tf) @ scipy.sparse.diags(nt)
+        s_rf = (pi * sarf).sum(axis=1)
+        mp_eye = (scipy.sparse.identity(len(s0)) - mdp.discount_rate * mp).tocsc()
+        occ = scipy.sparse.linalg.spsolve(mp_eye.T.tocsc(), s0)
+        v = scipy.sparse.linalg.spsolve(mp_eye, s_rf)
+        q = sarf + mdp.discount_rate * (tf @ v).reshape(sarf.shape)
+    else:
         mp = (rs[:, None] * (tf[:, :, :] * pi[:, :, None]).sum(1)) * nt[None, :]
         s_rf = (pi[:, :, None] * tf[:, :, :] * rf[:, :, :]).sum(axis=(1, 2))
         occ = s0@np.linalg.inv(np.eye(len(s0)) - mdp.discount_rate * mp)
         v = np.linalg.solve(np.eye(len(s0)) - mdp.discount_rate * mp, s_rf)
-        q = (tf[:, :, :] * (rf[:, :, :] + v[None, None, :])).sum(axis=2)
-
-        res = Result()
-        res.mdp = mdp
-        res.policy = self
-        res._valuevec = v
-        res.value = res.V = dict(zip(ss, v))
-        occ = dict(zip(ss, occ))
-        res.occupancy = res.successor_representation = occ
-        res._qvaluemat = q
-        qf = dict()
-        for si, s in enumerate(ss):
-            qf[s] = dict()
-            for ai, a in enumerate(aa):
-                qf[s][a] = q[si, ai]
-        res.action_value = res.Q = qf
-        res.initial_value = s0 @ v
-        return res
+        q = (tf[:, :, :] * (rf[:, :, :] + mdp.discount_rate * v[None, None, :])).sum(axis=2)
+
+    res = Result()
+    res.mdp = mdp
+    res.policy = policy
+    res._valuevec = v
+    res.value = res.V = ArrayMapping(v, (ss,), (mdp.state_index,))
+    res.occupancy = res.successor_representation = ArrayMapping(occ, (ss,), (mdp.state_index,))
+    res._qvaluemat = q
+    res.action_value = res.Q = ArrayMapping(q, (ss, aa), (mdp.state_index, mdp.action_index))
+    res.initial_value = s0 @ v
+    return res
@@ -1,9 +1,11 @@
 import logging
+from types import SimpleNamespace
 import numpy as np
+import scipy.sparse
 from abc import abstractmethod
 from typing import Set, Sequence, Hashable, Mapping, TypeVar
 from msdm.core.problemclasses.mdp import MarkovDecisionProcess
-from msdm.core.utils.funcutils import method_cache, cached_property
+from msdm.core.utils.funcutils import method_cache, cached_property, set_cached_property
 from msdm.core.distributions import FiniteDistribution, DictDistribution
 
 logger = logging.getLogger(__name__)
@@ -94,12 +96,19 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
     def _cached_actions(self, s : HashableState) -> Sequence[HashableAction]:
         return self.actions(s)
 
-    def as_matrices(self):
+    def as_matrices(self, sparse=False):
+        """
+        Returns a dictionary of the matrices representing the MDP.
+        If `sparse` is True, the transition and reward matrices
+        are returned in their sparse (S*A, S) form (see
+        `sparse_transition_matrix`) instead of as dense (S, A, S)
+        arrays.
+        """
         return {
             'ss': self.state_list,
             'aa': self.action_list,
-            'tf': self.transition_matrix,
-            'rf': self.reward_matrix,
+            'tf': self.sparse_transition_matrix if sparse else self.transition_matrix,
+            'rf': self.sparse_reward_matrix if sparse else self.reward_matrix,
             'sarf': self.state_action_reward_matrix,
             's0': self.initial_state_vec,
             'nt': self.nonterminal_state_vec,
@@ -107,6 +116,43 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
             'ast': self.absorbing_state_vec
         }
 
+    def set_compiled_matrices(
+        self,
+        state_list : Sequence[HashableState],
+        action_list : Sequence[HashableAction],
+        sparse_transition_matrix : scipy.sparse.csr_matrix,
+        sparse_reward_matrix : scipy.sparse.csr_matrix,
+        action_matrix : np.array,
+        initial_state_vec : np.array,
+        nonterminal_state_vec : np.array,
+    ):
+        """
+        Uses matrices compiled elsewhere (e.g., by another MDP in another
+        process) as this MDP's matrices instead of compiling them from
+        its model. The transition and reward matrices have the layout of
+        `sparse_transition_matrix` and share their sparsity pattern. Their
+        arrays are used without being copied, so they can be read-only or
+        in shared memory. Must be called before any matrix is computed.
+        """
+        n_states, n_actions = len(state_list), len(action_list)
+        tf, rf = sparse_transition_matrix, sparse_reward_matrix
+        assert tf.shape == rf.shape == (n_states*n_actions, n_states)
+        assert np.array_equal(tf.indptr, rf.indptr) and np.array_equal(tf.indices, rf.indices)
+        rows = np.repeat(np.arange(n_states*n_actions), np.diff(tf.indptr))
+        nt = np.asarray(nonterminal_state_vec)
+        set_cached_property(self, 'state_list', state_list)
+        set_cached_property(self, 'action_list', action_list)
+        set_cached_property(self, 'initial_state_vec', np.asarray(initial_state_vec))
+        set_cached_property(self, '_compiled_matrices', SimpleNamespace(
+            rows=rows,
+            cols=tf.indices,
+            probs=tf.data,
+            rewards=rf.data,
+            action_matrix=np.asarray(action_matrix),
+            nonterminal_state_vec=nt,
+            absorbing_state_vec=_absorbing_state_vec(rows, tf.indices, nt, n_states, n_actions)
+        ))
+
     @cached_property
     def state_list(self) -> Sequence[HashableState]:
         """
@@ -114,10 +160,10 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
         consistent for a particular TabularMarkovDecisionProcess instance.
         """
         logger.info("State space unspecified; performing reachability analysis.")
-        states = self.reachable_states()
+        states = self._reachability.states
         try:
             return sorted(states)
-        except TypeError: #unsortable
+        except TypeError: #unsortable, so use the order states were discovered
             pass
         return list(states)
 
@@ -146,58 +192,178 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
     def action_index(self) -> Mapping[HashableAction, int]:
         return {a: i for i, a in enumerate(self.action_list)}
 
+    def _transition_arrays(self):
+        """
+        Optional batched hook for compiling the MDP's matrices.
+
+        Domains that can enumerate their dynamics without calling
+        `next_state_dist` and `reward` once per state/action/next-state
+        can override this to return a tuple of equal-length arrays
+        `(state_indices, action_indices, next_state_indices, probs, rewards)`,
+        with indices into `state_list` and `action_list`. Repeated
+        (state, action, next state) entries are merged by summing
+        their probabilities and probability-weighting their rewards.
+        An action is marked available at a state in `action_matrix` only
+        if some entry for it has non-zero probability.
+        Returning None (the default) compiles the matrices by walking the model.
+        """
+        return None
+
     @cached_property
-    def transition_matrix(self) -> np.array:
+    def _compiled_matrices(self):
+        """
+        Compiles the transitions, rewards, and action availability of the
+        MDP in a single pass. All matrix properties are derived from this.
+        Transitions are stored as coordinates of non-zero entries, where
+        row is `si*len(action_list) + ai` and col is the next state index.
+        """
         ss = self.state_list
         ssi = self.state_index
-        aa = self.action_list
         aai = self.action_index
-        tf = np.zeros((len(ss), len(aa), len(ss)))
-        for s, si in ssi.items():
-            # by definition, terminal states lead only to themselves
-            # if self.is_terminal(s):
-            #     tf[si, :, si] = 1
-            #     continue
-            for a in self._cached_actions(s):
-                for ns, nsp in self._cached_next_state_dist(s, a).items():
-                    tf[si, aai[a], ssi[ns]] = nsp
+        n_states, n_actions = len(ss), len(self.action_list)
+        nt = np.array([0 if self.is_terminal(s) else 1 for s in ss])
+
+        arrays = self._transition_arrays()
+        if arrays is None:
+            # Transitions out of states found during reachability analysis
+            # were recorded then, so only states in the state list that were
+            # not discovered (if any) need to be walked.
+            explored = self._reachability
+            state_ids = np.array([ssi.get(s, -1) for s in explored.states], dtype=int)
+            action_ids = np.array([aai[a] for a in explored.actions], dtype=int)
+            in_state_list = state_ids[explored.edge_states] >= 0
+            edge_states = explored.edge_states[in_state_list]
+            edge_actions = explored.edge_actions[in_state_list]
+            edge_next_states = explored.edge_next_states[in_state_list]
+            outside = np.flatnonzero(state_ids[edge_next_states] < 0)
+            if len(outside) > 0:
+                e = outside[0]
+                raise KeyError(
+                    f"Next state {explored.states[edge_next_states[e]]!r} of state "
+                    f"{explored.states[edge_states[e]]!r} and action "
+                    f"{explored.actions[edge_actions[e]]!r} is not in state_list"
+                )
+            rows = [state_ids[edge_states]*n_actions + action_ids[edge_actions]]
+            cols = [state_ids[edge_next_states]]
+            probs = [explored.edge_probs[in_state_list]]
+            rewards = [np.array([
+                self.reward(explored.states[si], explored.actions[ai], explored.states[nsi])
+                for si, ai, nsi in zip(edge_states, edge_actions, edge_next_states)
+            ], dtype=float)]
+            am = np.zeros((n_states, n_actions))
+            available = state_ids[explored.available_states] >= 0
+            am[
+                state_ids[explored.available_states[available]],
+                action_ids[explored.available_actions[available]]
+            ] = 1
+
+            explored_states = set(explored.states)
+            unexplored_rows, unexplored_cols, unexplored_probs, unexplored_rewards = [], [], [], []
+            for s, si in ssi.items():
+                if s in explored_states:
+                    continue
+                for a in self._cached_actions(s):
+                    row = si*n_actions + aai[a]
+                    am[si, aai[a]] = 1
+                    for ns, p in self._cached_next_state_dist(s, a).items():
+                        if p == 0.:
+                            continue
+                        if ns not in ssi:
+                            raise KeyError(f"Next state {ns!r} of state {s!r} and action {a!r} is not in state_list")
+                        unexplored_rows.append(row)
+                        unexplored_cols.append(ssi[ns])
+                        unexplored_probs.append(p)
+                        unexplored_rewards.append(self.reward(s, a, ns))
+            rows = np.concatenate(rows + [np.array(unexplored_rows, dtype=int)])
+            cols = np.concatenate(cols + [np.array(unexplored_cols, dtype=int)])
+            probs = np.concatenate(probs + [np.array(unexplored_probs, dtype=float)])
+            rewards = np.concatenate(rewards + [np.array(unexplored_rewards, dtype=float)])
+        else:
+            s_idx, a_idx, ns_idx, probs, rewards = [np.asarray(x) for x in arrays]
+            nonzero = probs != 0.
+            rows = (s_idx*n_actions + a_idx)[nonzero]
+            cols = ns_idx[nonzero]
+            probs = probs[nonzero].astype(float)
+            rewards = rewards[nonzero].astype(float)
+            # merge repeated entries
+            entries, entry_idx = np.unique(rows*n_states + cols, return_inverse=True)
+            if len(entries) < len(rows):
+                weighted_rewards = np.bincount(entry_idx, weights=probs*rewards)
+                probs = np.bincount(entry_idx, weights=probs)
+                rewards = weighted_rewards/probs
+                rows, cols = entries // n_states, entries % n_states
+            am = np.zeros((n_states, n_actions))
+            am.reshape(-1)[rows] = 1
+
+        return SimpleNamespace(
+            rows=rows,
+            cols=cols,
+            probs=probs,
+            rewards=rewards,
+            action_matrix=am,
+            nonterminal_state_vec=nt,
+            absorbing_state_vec=_absorbing_state_vec(rows, cols, nt, n_states, n_actions)
+        )
+
+    @cached_property
+    def transition_matrix(self) -> np.array:
+        compiled = self._compiled_matrices
+        n_states, n_actions = len(self.state_list), len(self.action_list)
+        tf = np.zeros((n_states, n_actions, n_states))
+        tf.reshape(-1, n_states)[compiled.rows, compiled.cols] = compiled.probs
         return tf
 
     @cached_property
     def action_matrix(self):
-        ss = self.state_list
-        ssi = self.state_index
-        aa = self.action_list
-        aai = self.action_index
-        am = np.zeros((len(ss), len(aa)))
-        for s, si in ssi.items():
-            for a in self._cached_actions(s):
-                am[si, aai[a]] = 1
-        return am
+        return self._compiled_matrices.action_matrix
 
     @cached_property
     def reward_matrix(self):
-        ss = self.state_list
-        ssi = self.state_index
-        aa = self.action_list
-        aai = self.action_index
-        rf = np.zeros((len(ss), len(aa), len(ss)))
-        for s, si in ssi.items():
-            # by definition, reward from a terminal state is 0
-            # if self.is_terminal(s):
-            #     continue
-            for a in self._cached_actions(s):
-                for ns, p in self._cached_next_state_dist(s, a).items():
-                    if p == 0.:
-                        continue
-                    rf[si, aai[a], ssi[ns]] = self.reward(s, a, ns)
+        compiled = self._compiled_matrices
+        n_states, n_actions = len(self.state_list), len(self.action_list)
+        rf = np.zeros((n_states, n_actions, n_states))
+        rf.reshape(-1, n_states)[compiled.rows, compiled.cols] = compiled.rewards
         return rf
 
+    @cached_property
+    def sparse_transition_matrix(self) -> scipy.sparse.csr_matrix:
+        """
+        Transition probabilities as a sparse matrix with shape
+        (len(state_list)*len(action_list), len(state_list)).
+        Row `si*len(action_list) + ai` is the next-state distribution
+        for state `si` and action `ai`, so `(tf @ v).reshape(S, A)`
+        computes expected next-state values.
+        """
+        compiled = self._compiled_matrices
+        n_states, n_actions = len(self.state_list), len(self.action_list)
+        return scipy.sparse.csr_matrix(
+            (compiled.probs, (compiled.rows, compiled.cols)),
+            shape=(n_states*n_actions, n_states)
+        )
+
+    @cached_property
+    def sparse_reward_matrix(self) -> scipy.sparse.csr_matrix:
+        """
+        Rewards with the same (S*A, S) layout and sparsity pattern
+        as `sparse_transition_matrix`.
+        """
+        compiled = self._compiled_matrices
+        n_states, n_actions = len(self.state_list), len(self.action_list)
+        return scipy.sparse.csr_matrix(
+            (compiled.rewards, (compiled.rows, compiled.cols)),
+            shape=(n_states*n_actions, n_states)
+        )
+
     @cached_property
     def state_action_reward_matrix(self):
-        rf = self.reward_matrix
-        tf = self.transition_matrix
-        return np.einsum("san,san->sa", rf, tf)
+        compiled = self._compiled_matrices
+        n_states, n_actions = len(self.state_list), len(self.action_list)
+        sarf = np.bincount(
+            compiled.rows,
+            weights=compiled.probs*compiled.rewards,
+            minlength=n_states*n_actions
+        )
+        return sarf.reshape(n_states, n_actions)
 
     @cached_property
     def initial_state_vec(self):
@@ -206,8 +372,7 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
 
     @cached_property
     def nonterminal_state_vec(self):
-        ss = self.state_list
-        return np.array([0 if self.is_terminal(s) else 1 for s in ss])
+        return self._compiled_matrices.nonterminal_state_vec
 
     @cached_property
     def reachable_state_vec(self):
@@ -216,26 +381,63 @@ class TabularMarkovDecisionProcess(MarkovDecisionProcess):
 
     @cached_property
     def absorbing_state_vec(self):
-        def is_absorbing(s):
-            actions = self.actions(s)
-            for a in actions:
-                nextstates = self._cached_next_state_dist(s, a).support
-                for ns in nextstates:
-                    if not self.is_terminal(ns):
-                        return False
-            return True
-        return np.array([is_absorbing(s) for s in self.state_list])
+        return self._compiled_matrices.absorbing_state_vec
 
     @method_cache
     def reachable_states(self) -> Set[HashableState]:
-        S0 = self.initial_state_dist().support
-        frontier = set(S0)
-        visited = set(S0)
-        while len(frontier) > 0:
-            s = frontier.pop()
-            for a in self._cached_actions(s):
-                for ns in self._cached_next_state_dist(s, a).support:
-                    if ns not in visited:
-                        frontier.add(ns)
-                    visited.add(ns)
-        return visited
+        return set(self._reachability.states)
+
+    @cached_property
+    def _reachability(self):
+        """
+        Breadth-first search from the initial states. States and actions
+        are interned to integer ids in the order they are discovered,
+        and the non-zero transitions found along the way are recorded
+        as edges (state id, action id, next state id, probability),
+        so that compiling the MDP's matrices does not need to query
+        `next_state_dist` again.
+        """
+        states = list(self.initial_state_dist().support)
+        state_ids = {s: i for i, s in enumerate(states)}
+        actions = []
+        action_ids = {}
+        available_states, available_actions = [], []
+        edge_states, edge_actions, edge_next_states, edge_probs = [], [], [], []
+        si = 0
+        while si < len(states):
+            s = states[si]
+            for a in self.actions(s):
+                ai = action_ids.get(a)
+                if ai is None:
+                    ai = action_ids[a] = len(actions)
+                    actions.append(a)
+                available_states.append(si)
+                available_actions.append(ai)
+                for ns, p in self.next_state_dist(s, a).items():
+                    nsi = state_ids.get(ns)
+                    if nsi is None:
+                        nsi = state_ids[ns] = len(states)
+                        states.append(ns)
+                    if p == 0.:
+                        continue
+                    edge_states.append(si)
+                    edge_actions.append(ai)
+                    edge_next_states.append(nsi)
+                    edge_probs.append(p)
+            si += 1
+        return SimpleNamespace(
+            states=states,
+            actions=actions,
+            available_states=np.array(available_states, dtype=int),
+            available_actions=np.array(available_actions, dtype=int),
+            edge_states=np.array(edge_states, dtype=int),
+            edge_actions=np.array(edge_actions, dtype=int),
+            edge_next_states=np.array(edge_next_states, dtype=int),
+            edge_probs=np.array(edge_probs, dtype=float),
+        )
+
+def _absorbing_state_vec(rows, cols, nonterminal_state_vec, n_states, n_actions):
+    # absorbing states only lead to terminal states
+    leads_to_nonterminal = np.zeros(n_states, dtype=bool)
+    leads_to_nonterminal[(rows // n_actions)[nonterminal_state_vec[cols] == 1]] = True
+    return ~leads_to_nonterminal
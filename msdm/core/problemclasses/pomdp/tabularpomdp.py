@@ -15,12 +15,12 @@ HashableObservation = TypeVar('HashableObservation', bound=Hashable)
 Belief = namedtuple("Belief", "states probs")
 
 class TabularPOMDP(TabularMarkovDecisionProcess, PartiallyObservableMDP):
-    def as_matrices(self):
+    def as_matrices(self, sparse=False):
         return {
             'ss': self.state_list,
             'aa': self.action_list,
-            'tf': self.transition_matrix,
-            'rf': self.reward_matrix,
+            'tf': self.sparse_transition_matrix if sparse else self.transition_matrix,
+            'rf': self.sparse_reward_matrix if sparse else self.reward_matrix,
             'sarf': self.state_action_reward_matrix,
             's0': self.initial_state_vec,
             'nt': self.nonterminal_state_vec,
@@ -0,0 +1,45 @@
+from collections import abc
+from typing import Hashable, Mapping, Sequence
+
+import numpy as np
+
+class ArrayMapping(abc.Mapping):
+    '''
+    ArrayMapping is a read-only mapping view of a numpy array,
+    where keys along each axis are resolved to array indices
+    on access. Indexing a view of a 2-dimensional array with a
+    row key returns a view of that row, so, for example,
+    `ArrayMapping(q, keys=(states, actions))[s][a] == q[si, ai]`.
+    Nothing is copied from the array when the view is made.
+    '''
+    def __init__(
+        self,
+        array: np.ndarray,
+        keys: Sequence[Sequence[Hashable]],
+        index: Sequence[Mapping[Hashable, int]] = None,
+    ):
+        assert len(keys) == array.ndim, 'Keys must be given for every axis.'
+        if index is None:
+            index = [{k: i for i, k in enumerate(axis_keys)} for axis_keys in keys]
+        self._array = array
+        self._keys = keys
+        self._index = index
+
+    def __getitem__(self, key):
+        i = self._index[0][key]
+        if self._array.ndim == 1:
+            return self._array[i]
+        return ArrayMapping(self._array[i], self._keys[1:], self._index[1:])
+
+    def __iter__(self):
+        return iter(self._keys[0])
+
+    def __len__(self):
+        return len(self._keys[0])
+
+    def __contains__(self, key):
+        return key in self._index[0]
+
+    def __repr__(self):
+        items = ', '.join(f'{repr(k)}: {repr(v)}' for k, v in self.items())
+        return f"{self.__class__.__name__}({{{items}}})"
@@ -1,4 +1,4 @@
-import inspect, functools
+import inspect, functools, collections
 
 def cached_property(fn):
     '''
@@ -18,7 +18,7 @@ def cached_property(fn):
     assert spec.varargs is None
     assert spec.varkw is None
 
-    key = '_cached_'+fn.__name__
+    key = _CACHED_PROPERTY_PREFIX+fn.__name__
     @property
     @functools.wraps(fn)
     def wrapped(self):
@@ -27,30 +27,90 @@ def cached_property(fn):
         return getattr(self, key)
     return wrapped
 
-def method_cache(fn):
+_CACHED_PROPERTY_PREFIX = '_cached_'
+
+def set_cached_property(obj, name, value):
+    '''
+    Stores `value` as the cached value of `obj`'s `cached_property`
+    `name`, as if it had already been computed.
+    '''
+    setattr(obj, _CACHED_PROPERTY_PREFIX+name, value)
+
+CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"])
+
+# separates positional from keyword arguments in cache keys
+_KWARGS_MARK = object()
+
+def method_cache(fn=None, *, maxsize=None):
     '''
     Avoiding functools.lru_cache since it holds onto object references
     when applied to methods of an object, creating a referenc cycle (not great for GC).
     Instead, preferring a strategy where cache storage lives on the object.
+
+    Can be used as `@method_cache` or `@method_cache(maxsize=...)`.
+    With a `maxsize`, each object keeps at most that many entries
+    and evicts the least recently used one when full; `maxsize=0`
+    disables caching for the method. Counts of hits, misses, and evictions
+    are kept in the object's `_cache_info_<name>` dict and returned
+    by `<method>.cache_info(obj)`.
     '''
+    if fn is None:
+        return functools.partial(method_cache, maxsize=maxsize)
+    assert maxsize is None or maxsize >= 0
     cache_attr = '_cache_'+fn.__name__
     cache_info_attr = '_cache_info_'+fn.__name__
     @functools.wraps(fn)
     def wrapped(self, *args, **kwargs):
         # Since the store is object-local, we always have to ensure
         # objects passed in have the cache initialized.
-        if not hasattr(self, cache_attr):
-            setattr(self, cache_attr, {})
-            setattr(self, cache_info_attr, dict(hits=0, misses=0))
-        cache = getattr(self, cache_attr)
-        cache_info = getattr(self, cache_info_attr)
+        try:
+            cache = getattr(self, cache_attr)
+            cache_info = getattr(self, cache_info_attr)
+        except AttributeError:
+            cache = {} if maxsize is None else collections.OrderedDict()
+            cache_info = dict(hits=0, misses=0, evictions=0)
+            setattr(self, cache_attr, cache)
+            setattr(self, cache_info_attr, cache_info)
+
+        # A single positional argument is its own key. Tuples are
+        # excluded so they cannot collide with keys of multiple arguments.
+        if kwargs:
+            key = (args, _KWARGS_MARK, frozenset(kwargs.items()))
+        elif len(args) == 1 and not isinstance(args[0], tuple):
+            key = args[0]
+        else:
+            key = args
 
         # Now we check for this function call, and
         # run the function if it hasn't been called before.
-        key = (args, frozenset(kwargs.items()) if kwargs else None)
-        if key not in cache:
-            cache[key] = fn(self, *args, **kwargs)
-            cache_info['misses'] += 1
-        cache_info['hits'] += 1
-        return cache[key]
+        try:
+            result = cache[key]
+        except KeyError:
+            pass
+        else:
+            cache_info['hits'] += 1
+            if maxsize is not None:
+                cache.move_to_end(key)
+            return result
+        cache_info['misses'] += 1
+        result = fn(self, *args, **kwargs)
+        if maxsize == 0:
+            return result
+        cache[key] = result
+        if maxsize is not None and len(cache) > maxsize:
+            cache.popitem(last=False)
+            cache_info['evictions'] += 1
+        return result
+
+    def cache_info(obj):
+        info = getattr(obj, cache_info_attr, dict(hits=0, misses=0, evictions=0))
+        return CacheInfo(maxsize=maxsize, currsize=len(getattr(obj, cache_attr, ())), **info)
+
+    def cache_clear(obj):
+        for attr in [cache_attr, cache_info_attr]:
+            if hasattr(obj, attr):
+                delattr(obj, attr)
+
+    wrapped.cache_info = cache_info
+    wrapped.cache_clear = cache_clear
     return wrapped
@@ -1,4 +1,5 @@
 from collections import defaultdict, namedtuple
+import numpy as np
 from msdm.core.problemclasses.mdp import TabularMarkovDecisionProcess
 from msdm.core.utils.funcutils import cached_property
 
@@ -66,6 +67,27 @@ class GridMDP(TabularMarkovDecisionProcess):
             GridAction(-1, 0)
         )
 
+    @cached_property
+    def _location_state_index(self):
+        """
+        Array with shape (width, height) mapping locations to
+        indices in `state_list` (-1 for locations not in `state_list`).
+        """
+        loc_idx = np.full((self.width, self.height), -1)
+        for s, si in self.state_index.items():
+            loc_idx[s.x, s.y] = si
+        return loc_idx
+
+    def _location_feature_mask(self, features):
+        """
+        Boolean array with shape (width, height) that is True
+        at locations whose feature is in `features`.
+        """
+        mask = np.zeros((self.width, self.height), dtype=bool)
+        for loc, f in self._loc_features.items():
+            mask[loc.x, loc.y] = f in features
+        return mask
+
     @cached_property
     def feature_list(self):
         return tuple(sorted(self._feature_locs.keys()))
@@ -1,4 +1,5 @@
 from collections import defaultdict
+import numpy as np
 import matplotlib.pyplot as plt
 
 from msdm.domains.gridmdp import GridMDP, Location, GridAction
@@ -84,6 +85,64 @@ class WindyGridWorld(GridMDP):
         nsr_dist = nsr_dist.then(lambda nsr: self._effect_of_features(*nsr))
         return nsr_dist
 
+    def _transition_arrays(self):
+        """
+        Vectorized version of `next_state_reward_dist` over all
+        states and actions. Subclasses that change the dynamics
+        fall back to walking the model.
+        """
+        for method in (
+            'next_state_dist', 'reward', 'actions', 'next_state_reward_dist',
+            '_effect_of_wind', '_effect_of_action', '_effect_of_walls', '_effect_of_features'
+        ):
+            if getattr(type(self), method) is not getattr(WindyGridWorld, method):
+                return None
+        ss = self.state_list
+        aa = self.action_list
+        loc_idx = self._location_state_index
+        walls = self._location_feature_mask(self.wall_features)
+        feature_reward = np.zeros((self.width, self.height))
+        for loc, f in self._loc_features.items():
+            feature_reward[loc.x, loc.y] = self.feature_rewards.get(f, 0.0)
+        wind_dx = np.zeros((self.width, self.height), dtype=int)
+        wind_dy = np.zeros((self.width, self.height), dtype=int)
+        for f, (dx, dy) in {'>': (1, 0), '<': (-1, 0), '^': (0, 1), 'v': (0, -1)}.items():
+            wind_dx[self._location_feature_mask(f)] = dx
+            wind_dy[self._location_feature_mask(f)] = dy
+
+        def in_grid(x, y):
+            return (0 <= x) & (x < self.width) & (0 <= y) & (y < self.height)
+
+        # axes are (state, action, wind outcome)
+        x = np.array([s.x for s in ss])[:, None, None]
+        y = np.array([s.y for s in ss])[:, None, None]
+        dx = np.array([a.dx for a in aa])[None, :, None]
+        dy = np.array([a.dy for a in aa])[None, :, None]
+        windy = (wind_dx[x, y] != 0) | (wind_dy[x, y] != 0)
+        probs = np.where(windy, [[[1 - self.wind_probability, self.wind_probability]]], [[[1., 0.]]])
+        blown = np.array([0, 1])[None, None, :]
+        wx, wy = x + blown*wind_dx[x, y], y + blown*wind_dy[x, y]
+        nx, ny = wx + dx, wy + dy
+        rewards = np.full(nx.shape, float(self.step_cost))
+        nx_in, ny_in = np.clip(nx, 0, self.width - 1), np.clip(ny, 0, self.height - 1)
+        hits_wall = in_grid(nx, ny) & walls[nx_in, ny_in]
+        rewards += np.where(hits_wall, self.wall_bump_cost, 0)
+        x_out = ~hits_wall & ((nx < 0) | (nx > self.width - 1))
+        y_out = ~hits_wall & ((ny < 0) | (ny > self.height - 1))
+        rewards += np.where(x_out, self.wall_bump_cost, 0) + np.where(y_out, self.wall_bump_cost, 0)
+        nx = np.where(hits_wall | x_out, x, nx)
+        ny = np.where(hits_wall | y_out, y, ny)
+        rewards += feature_reward[nx, ny]
+
+        shape = nx.shape
+        return (
+            np.broadcast_to(np.arange(len(ss))[:, None, None], shape).ravel(),
+            np.broadcast_to(np.array([self.action_index[a] for a in aa])[None, :, None], shape).ravel(),
+            loc_idx[nx, ny].ravel(),
+            np.broadcast_to(probs, shape).ravel(),
+            rewards.ravel(),
+        )
+
     def _effect_of_features(self, s : Location, r : float):
         f = self.feature_at(s)
         r += self.feature_rewards.get(f, 0.0)
@@ -1,4 +1,5 @@
 import matplotlib.pyplot as plt
+import numpy as np
 from typing import Sequence
 from msdm.core.utils.gridstringutils import  string_to_element_array
 from msdm.core.utils.funcutils import cached_property
@@ -159,6 +160,64 @@ class GridWorld(TabularMarkovDecisionProcess):
     def actions(self, s) -> Sequence:
         return [a for a in self._actions]
 
+    def _transition_arrays(self):
+        """
+        Vectorized enumeration of the transitions and rewards defined
+        by `next_state_dist` and `reward`. Subclasses that change the
+        dynamics fall back to walking the model.
+        """
+        for method in ('next_state_dist', 'reward', 'actions', 'is_terminal'):
+            if getattr(type(self), method) is not getattr(GridWorld, method):
+                return None
+        ssi = self.state_index
+        aai = self.action_index
+        n_states = len(self.state_list)
+        ts = ssi[TERMINALSTATE]
+
+        # location -> state index
+        loc_idx = np.full((self.width, self.height), -1)
+        blocked = np.zeros((self.width, self.height), dtype=bool)
+        loc_reward = np.zeros(n_states)
+        for s, si in ssi.items():
+            if self.is_terminal(s):
+                continue
+            loc_idx[s['x'], s['y']] = si
+            f = self._locFeatures.get(s, "")
+            loc_reward[si] = self._featureRewards.get(f, 0.0) + self.step_cost
+        for s in self._walls:
+            blocked[s['x'], s['y']] = True
+        absorbing = np.zeros(n_states, dtype=bool)
+        absorbing[[ssi[s] for s in self._absorbingStates]] = True
+        absorbing[ts] = True
+
+        x = np.array([s['x'] for s in self.state_list])
+        y = np.array([s['y'] for s in self.state_list])
+        a_idx = np.array([aai[a] for a in self._actions])
+        dx = np.array([a.get('dx', 0) for a in self._actions])
+        dy = np.array([a.get('dy', 0) for a in self._actions])
+        s_idx = np.broadcast_to(np.arange(n_states)[:, None], (n_states, len(a_idx)))
+        a_idx = np.broadcast_to(a_idx[None, :], (n_states, len(a_idx)))
+        nx, ny = x[:, None] + dx[None, :], y[:, None] + dy[None, :]
+        in_grid = (0 <= nx) & (nx < self.width) & (0 <= ny) & (ny < self.height)
+        nx, ny = np.where(in_grid, nx, 0), np.where(in_grid, ny, 0)
+        stays = ~in_grid | blocked[nx, ny] | ((dx == 0) & (dy == 0))[None, :]
+        ns_idx = np.where(stays, s_idx, loc_idx[nx, ny])
+
+        # moves out of terminal and absorbing states go to the terminal state
+        to_terminal = absorbing[s_idx]
+        ns_idx = np.where(to_terminal, ts, ns_idx)
+        stays = stays & ~to_terminal
+        move_prob = np.where(stays | to_terminal, 1.0, self.success_prob)
+        move_reward = np.where(to_terminal, 0.0, loc_reward[ns_idx])
+        stay = ~stays & ~to_terminal
+        return (
+            np.concatenate([s_idx.ravel(), s_idx[stay]]),
+            np.concatenate([a_idx.ravel(), a_idx[stay]]),
+            np.concatenate([ns_idx.ravel(), s_idx[stay]]),
+            np.concatenate([move_prob.ravel(), 1 - move_prob[stay]]),
+            np.concatenate([move_reward.ravel(), loc_reward[s_idx[stay]]]),
+        )
+
     def initial_state_dist(self) -> FiniteDistribution:
         return UniformDistribution(self.initial_states)
 
@@ -0,0 +1,52 @@
+import json
+import unittest
+import numpy as np
+from msdm.algorithms import ValueIteration
+from msdm.benchmarks import Garnet, BenchmarkCase, run_cases, run_suite, compare
+
+class BenchmarkTests(unittest.TestCase):
+    def test_garnet(self):
+        mdp = Garnet(n_states=20, n_actions=3, branching=2, seed=1)
+        mats = mdp.as_matrices()
+        assert mats['tf'].shape == (20, 3, 20)
+        assert np.isclose(mats['tf'].sum(-1), 1).all()
+        assert ((mats['tf'] > 0).sum(-1) == 2).all()
+        assert np.isclose(Garnet(n_states=20, n_actions=3, branching=2, seed=1).as_matrices()['tf'], mats['tf']).all()
+        assert ValueIteration().plan_on(mdp).converged
+
+    def test_run_suite(self):
+        report = run_suite(
+            "small",
+            domains=["gridworld", "loadunload"],
+            algorithms=["compile", "ValueIteration", "LRTDP", "QLearning", "PointBasedValueIteration"],
+            isolate=False
+        )
+        report = json.loads(json.dumps(report))
+        assert set(report['metadata']) >= {"git_commit", "python", "numpy", "timestamp"}
+        records = {(r['domain'], r['algorithm']): r for r in report['results']}
+        assert set(records) == {
+            ("gridworld", "compile"), ("gridworld", "ValueIteration"),
+            ("gridworld", "LRTDP"), ("gridworld", "QLearning"),
+            ("loadunload", "compile"), ("loadunload", "PointBasedValueIteration"),
+        }
+        for record in records.values():
+            assert record['status'] == "ok", record
+            assert record['wall_time'] > 0
+            assert record['peak_rss'] > 0
+        assert records[("gridworld", "ValueIteration")]['iterations'] > 0
+        assert records[("gridworld", "QLearning")]['iterations'] == 200
+        assert records[("gridworld", "LRTDP")]['iterations'] > 0
+
+        slower = json.loads(json.dumps(report))
+        for record in slower['results']:
+            record['wall_time'] *= 2
+        assert compare(report, report) == []
+        assert len(compare(report, slower)) == len(report['results'])
+
+    def test_isolated_case(self):
+        record, = run_cases([BenchmarkCase("garnet", 10, "compile")], isolate=True)
+        assert record['status'] == "ok"
+        assert record['n_states'] == 10
+
+if __name__ == '__main__':
+    unittest.main()
@@ -112,6 +112,40 @@ class CoreTestCase(unittest.TestCase):
             assert pi1.iterations == pi2.iterations
             assert pi1.converged == pi2.converged
 
+def test_sparse_matrices_match_dense():
+    from msdm.domains.gridmdp.windygridworld import WindyGridWorld
+    from msdm.tests.domains import make_russell_norvig_grid
+    wg = WindyGridWorld(
+        grid="""
+            ....$
+            x^x<<
+            .^x<<
+            x<<<<
+            @....
+        """,
+        discount_rate=.95,
+        feature_rewards={'x': -50, '$': 50}
+    )
+    for mdp in [wg, make_russell_norvig_grid(discount_rate=.9, slip_prob=.8)]:
+        n_states, n_actions = len(mdp.state_list), len(mdp.action_list)
+        mats = mdp.as_matrices(sparse=True)
+        assert mats['tf'].shape == mats['rf'].shape == (n_states*n_actions, n_states)
+        assert np.allclose(mats['tf'].toarray().reshape(mdp.transition_matrix.shape), mdp.transition_matrix)
+        assert np.allclose(mats['rf'].toarray().reshape(mdp.reward_matrix.shape), mdp.reward_matrix)
+
+        for Planner in [ValueIteration, PolicyIteration]:
+            dense_res = Planner().plan_on(mdp)
+            sparse_res = Planner(sparse=True).plan_on(mdp)
+            assert np.allclose(dense_res._valuevec, sparse_res._valuevec)
+            assert np.allclose(dense_res._qvaluemat, sparse_res._qvaluemat)
+
+        dense_eval = dense_res.policy.evaluate_on(mdp)
+        sparse_eval = dense_res.policy.evaluate_on(mdp, sparse=True)
+        assert np.isclose(dense_eval.initial_value, sparse_eval.initial_value)
+        assert np.allclose(dense_eval._qvaluemat, sparse_eval._qvaluemat)
+        for s in mdp.state_list:
+            assert np.isclose(dense_eval.occupancy[s], sparse_eval.occupancy[s])
+
 def test_tabularpolicy_softmax():
     mdp = QuickTabularMDP(
         next_state_dist=lambda s, a: DictDistribution({s + a: .9, s: .1}) if 0 <= s+a < 6 else DictDistribution({s: 1}),
@@ -126,5 +160,188 @@ def test_tabularpolicy_softmax():
     softhard_v0 = softhard_pi.evaluate_on(mdp).initial_value
     assert np.isclose(hard_v0, softhard_v0)
 
+def test_array_backed_planning_results():
+    from msdm.core.utils.arrayviews import ArrayMapping
+    from msdm.core.problemclasses.mdp import ArrayPolicy
+    gw = GridWorld(
+        tile_array=[
+            '..g',
+            '.#.',
+            's..',
+        ],
+        feature_rewards={'g': 0},
+        step_cost=-1,
+    )
+    for res in [ValueIteration().plan_on(gw), PolicyIteration().plan_on(gw)]:
+        assert isinstance(res.V, ArrayMapping)
+        assert isinstance(res.policy, ArrayPolicy)
+        assert list(res.V.keys()) == list(gw.state_list)
+        assert len(res.Q) == len(gw.state_list)
+        for si, s in enumerate(gw.state_list):
+            assert res.V[s] == res._valuevec[si]
+            for ai, a in enumerate(gw.action_list):
+                assert res.Q[s][a] == res._qvaluemat[si, ai]
+
+        dict_pi = TabularPolicy.from_q_matrix(gw.state_list, gw.action_list, res._qvaluemat + np.log(gw.action_matrix))
+        for s in gw.state_list:
+            assert res.policy.action_dist(s).isclose(dict_pi.action_dist(s))
+            assert type(res.policy[s]) == type(dict_pi[s])
+        reversed_states = gw.state_list[::-1]
+        assert (res.policy.as_matrix(reversed_states, gw.action_list) == dict_pi.as_matrix(reversed_states, gw.action_list)).all()
+        assert np.isclose(res.policy.evaluate_on(gw).initial_value, dict_pi.evaluate_on(gw).initial_value)
+        assert np.isclose(res.policy.evaluate_on(gw).initial_value, res.initial_value)
+
+def test_array_policy_round_trip_and_sampling():
+    from msdm.core.problemclasses.mdp import ArrayPolicy
+    states, actions = ['a', 'b', 'c'], [0, 1, 2]
+    matrix = np.array([
+        [.2, 0., .8],
+        [0., 1., 0.],
+        [1/3, 1/3, 1/3],
+    ])
+    pi = ArrayPolicy.from_matrix(states, actions, matrix)
+    dict_pi = pi.to_tabular_policy()
+    assert isinstance(dict_pi, TabularPolicy)
+    for s in states:
+        assert pi.action_dist(s).isclose(dict_pi.action_dist(s))
+    assert (ArrayPolicy.from_tabular_policy(dict_pi, states, actions).policy_matrix == matrix).all()
+    assert (pi.as_matrix(states[::-1], actions[::-1]) == matrix[::-1, ::-1]).all()
+
+    rng = np.random.default_rng(1234)
+    state_indices = np.repeat(np.arange(len(states)), 20000)
+    action_indices = pi.sample_action_indices(state_indices, rng=rng)
+    for si in range(len(states)):
+        freqs = np.bincount(action_indices[state_indices == si], minlength=len(actions))/20000
+        assert np.allclose(freqs, matrix[si], atol=.02)
+        assert (freqs[matrix[si] == 0] == 0).all()
+    assert pi.sample_actions(['b', 'b'], rng=rng) == [1, 1]
+
+def test_batch_simulator():
+    from msdm.core.problemclasses.mdp import BatchSimulator
+    gw = GridWorld(
+        tile_array=["..x.g", ".#.#.", "s...x"],
+        feature_rewards={'g': 5, 'x': -3},
+        success_prob=.8,
+        step_cost=-1,
+        discount_rate=.95
+    )
+    res = ValueIteration().plan_on(gw)
+    sim = BatchSimulator(gw)
+    out = sim.simulate(res.policy, n_episodes=20000, max_steps=100, rng=np.random.default_rng(42))
+    n_episodes, n_steps = out.state_indices.shape
+    assert n_episodes == 20000 and n_steps == out.lengths.max()
+    assert np.isclose(out.returns.mean(), res.initial_value, atol=.1)
+
+    ss, aa = gw.state_list, gw.action_list
+    for ep in range(50):
+        length = out.lengths[ep]
+        assert (out.state_indices[ep, length:] == -1).all()
+        assert (out.rewards[ep, length:] == 0).all()
+        assert not gw.is_terminal(ss[out.state_indices[ep, length - 1]])
+        assert gw.is_terminal(ss[out.next_state_indices[ep, length - 1]])
+        for t in range(length):
+            s, a, ns = ss[out.state_indices[ep, t]], aa[out.action_indices[ep, t]], ss[out.next_state_indices[ep, t]]
+            assert res.policy.action_dist(s).prob(a) > 0
+            assert gw.next_state_dist(s, a).prob(ns) > 0
+            assert out.rewards[ep, t] == gw.reward(s, a, ns)
+            if t > 0:
+                assert out.state_indices[ep, t] == out.next_state_indices[ep, t - 1]
+
+def test_batch_simulator_samples_within_rows():
+    from msdm.core.problemclasses.mdp.batchsimulator import row_cumulative_probabilities, search_rows
+    rng = np.random.default_rng(0)
+    row_sizes = rng.integers(0, 6, size=100000)
+    indptr = np.concatenate([[0], np.cumsum(row_sizes)])
+    probs = rng.random(indptr[-1])
+    cumulative = row_cumulative_probabilities(indptr, probs)
+    rows = np.flatnonzero(row_sizes)
+    for r in rows[:100]:
+        assert np.array_equal(cumulative[indptr[r]:indptr[r + 1]], np.cumsum(probs[indptr[r]:indptr[r + 1]]))
+    # draws at the very end of each row select its last entry
+    totals = cumulative[indptr[rows + 1] - 1]
+    assert np.array_equal(search_rows(cumulative, indptr[rows], indptr[rows + 1], totals), indptr[rows + 1] - 1)
+    u = rng.random(len(rows))*totals
+    expected = [indptr[r] + np.searchsorted(cumulative[indptr[r]:indptr[r + 1]], ui, side='right') for r, ui in zip(rows, u)]
+    assert np.array_equal(search_rows(cumulative, indptr[rows], indptr[rows + 1], u), expected)
+
+    from msdm.core.problemclasses.mdp import BatchSimulator
+    mdp = QuickTabularMDP(
+        next_state_dist=lambda s, a: DictDistribution({'b': 1.}),
+        reward=-1,
+        actions=lambda s: ('stay',) if s == 'a' else ('stay', 'go'),
+        initial_state_dist=DictDistribution({'a': 1.}),
+        is_terminal=lambda s: s == 'c',
+        discount_rate=1.
+    )
+    sim = BatchSimulator(mdp)
+    si, ai = mdp.state_index['a'], mdp.action_index['go']
+    try:
+        sim.step(np.array([si]), np.array([ai]), np.random.default_rng(0))
+        assert False
+    except ValueError:
+        pass
+
+def test_next_states_missing_from_state_list():
+    def make_mdp(state_list):
+        mdp = QuickTabularMDP(
+            next_state_dist=lambda s, a: DictDistribution({s if s == 3 else s + 1: 1.}),
+            reward=-1,
+            actions=(1,),
+            initial_state_dist=DictDistribution({0: 1.}),
+            is_terminal=lambda s: s == 3,
+            discount_rate=1.
+        )
+        mdp._cached_state_list = state_list
+        return mdp
+    # a reachable next state is missing, and a state
+    # that is never reached leads outside the state list
+    for state_list in [[0, 1, 3], [0, 1, 2, 3, 10]]:
+        try:
+            make_mdp(state_list).transition_matrix
+            assert False
+        except KeyError:
+            pass
+
+def test_matrices_compiled_from_reachability():
+    calls = []
+    def next_state_dist(s, a):
+        calls.append((s, a))
+        if s == 'far' or len(s) == 3:
+            return DictDistribution({s: 1})
+        return DictDistribution({s + a: .75, s: .25, 'far': 0.})
+    def make_mdp():
+        return QuickTabularMDP(
+            next_state_dist=next_state_dist,
+            reward=lambda s, a, ns: -len(ns),
+            actions=lambda s: ('a', 'b') if len(s) < 2 else ('a',),
+            initial_state='',
+            is_terminal=lambda s: len(s) == 3,
+        )
+    mdp = make_mdp()
+    mdp.transition_matrix
+    mdp.reachable_state_vec
+    # each (state, action) is queried once, during reachability analysis
+    assert len(calls) == len(set(calls)) == mdp.action_matrix.sum()
+    assert mdp.state_list == sorted(mdp.reachable_states())
+    assert 'far' in mdp.reachable_states()
+    assert 'bab' not in mdp.reachable_states()
+
+    class ExtraStateMDP(QuickTabularMDP):
+        state_list = ['bab'] + make_mdp().state_list
+    extra = ExtraStateMDP(**{
+        k: getattr(mdp, k) for k in ['next_state_dist', 'reward', 'actions', 'initial_state_dist', 'is_terminal']
+    })
+    for m in [mdp, extra]:
+        for si, s in enumerate(m.state_list):
+            for ai, a in enumerate(m.action_list):
+                available = a in m.actions(s)
+                assert m.action_matrix[si, ai] == available
+                if not available:
+                    continue
+                for nsi, ns in enumerate(m.state_list):
+                    assert m.transition_matrix[si, ai, nsi] == m.next_state_dist(s, a).prob(ns)
+                    if m.transition_matrix[si, ai, nsi] > 0:
+                        assert m.reward_matrix[si, ai, nsi] == m.reward(s, a, ns)
+
 if __name__ == '__main__':
     unittest.main()
@@ -42,20 +42,74 @@ class FuncUtilsTests(unittest.TestCase):
         instance = X()
         instance.expensive(3)
         instance.expensive(3)
-        assert instance._cache_expensive[((3,), None)] == 6
-        assert instance._cache_info_expensive == dict(hits=2, misses=1)
+        assert instance._cache_expensive[3] == 6
+        assert instance._cache_info_expensive == dict(hits=1, misses=1, evictions=0)
         assert instance._call_count == 1
 
         # Can handle other entries too
         instance.expensive(4)
-        assert instance._cache_expensive[((4,), None)] == 8
-        assert instance._cache_info_expensive == dict(hits=3, misses=2)
+        assert instance._cache_expensive[4] == 8
+        assert instance._cache_info_expensive == dict(hits=1, misses=2, evictions=0)
         assert instance._call_count == 2
 
         # And we still cache appropriately
         instance.expensive(4)
-        assert instance._cache_info_expensive == dict(hits=4, misses=2)
+        assert instance._cache_info_expensive == dict(hits=2, misses=2, evictions=0)
         assert instance._call_count == 2
+        assert X.expensive.cache_info(instance) == (2, 2, 0, None, 2)
+
+        # Tuples and keyword arguments get distinct keys
+        assert instance.expensive((1, 2)) == (1, 2, 1, 2)
+        assert instance.expensive(argument=(1, 2)) == (1, 2, 1, 2)
+        assert instance._call_count == 4
+
+        X.expensive.cache_clear(instance)
+        assert not hasattr(instance, '_cache_expensive')
+        assert X.expensive.cache_info(instance).currsize == 0
+
+    def test_bounded_method_cache(self):
+        class X(object):
+            def __init__(self):
+                self._call_count = 0
+            @method_cache(maxsize=2)
+            def expensive(self, argument):
+                self._call_count += 1
+                return argument * 2
+            @method_cache(maxsize=0)
+            def uncached(self, argument):
+                self._call_count += 1
+                return argument * 2
+
+        instance = X()
+        for argument in [1, 2, 1, 3]:
+            instance.expensive(argument)
+        # 2 was least recently used when 3 was added
+        assert list(instance._cache_expensive.keys()) == [1, 3]
+        assert X.expensive.cache_info(instance) == (1, 3, 1, 2, 2)
+        instance.expensive(2)
+        assert instance._call_count == 4
+
+        instance._call_count = 0
+        instance.uncached(1)
+        instance.uncached(1)
+        assert instance._call_count == 2
+        assert X.uncached.cache_info(instance) == (0, 2, 0, 0, 0)
+
+    def test_method_cache_has_no_reference_cycle(self):
+        import gc, weakref
+        class X(object):
+            @method_cache
+            def expensive(self, argument):
+                return argument * 2
+        instance = X()
+        instance.expensive(1)
+        ref = weakref.ref(instance)
+        gc.disable()
+        try:
+            del instance
+            assert ref() is None
+        finally:
+            gc.enable()
 
 if __name__ == '__main__':
     unittest.main()
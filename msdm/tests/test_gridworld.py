@@ -1,6 +1,19 @@
 import unittest
+import numpy as np
 
 from msdm.domains import GridWorld
+from msdm.domains.gridmdp.windygridworld import WindyGridWorld
+
+def _assert_compiled_matrices_match_model(make_mdp):
+    batched = make_mdp()
+    walked = make_mdp()
+    walked._transition_arrays = lambda: None
+    assert batched._transition_arrays() is not None
+    for name in [
+        'transition_matrix', 'reward_matrix', 'action_matrix',
+        'nonterminal_state_vec', 'absorbing_state_vec'
+    ]:
+        assert np.allclose(getattr(batched, name), getattr(walked, name)), name
 
 class GridWorldTestCase(unittest.TestCase):
     def test_feature_locations(self):
@@ -22,3 +35,26 @@ class GridWorldTestCase(unittest.TestCase):
             "s........",
         ])
         assert len(gw.reachable_states()) == 22 #includes terminal
+
+    def test_batched_transition_arrays(self):
+        for success_prob in [1.0, .7]:
+            _assert_compiled_matrices_match_model(lambda: GridWorld(
+                tile_array=["..x.g", ".#.#.", "s...x"],
+                feature_rewards={'g': 5, 'x': -3},
+                success_prob=success_prob,
+                step_cost=-2
+            ))
+        for wind_probability in [.3, 1.0]:
+            _assert_compiled_matrices_match_model(lambda: WindyGridWorld(
+                grid="""
+                    ....$
+                    x^x<<
+                    #^x<<
+                    x<<v<
+                    x>>>#
+                    @.#..
+                """,
+                wind_probability=wind_probability,
+                feature_rewards={'x': -50, '$': 50},
+                wall_bump_cost=-3
+            ))
@@ -0,0 +1,187 @@
+import unittest
+import pickle
+import numpy as np
+from msdm.core.algorithmclasses import Profiler, NULL_INSTRUMENTATION
+from msdm.algorithms import ValueIteration, PolicyIteration, QLearning, LRTDP, LAOStar
+from msdm.algorithms.valueiteration import ValueIterationStep
+from msdm.algorithms.policyiteration import PolicyIterationStep
+from msdm.algorithms.lrtdp import LRTDPTrial
+from msdm.algorithms.laostar import LAOStarIteration
+from msdm.algorithms import PointBasedValueIteration
+from msdm.algorithms.pointbasedvalueiteration import PBVIExpansion
+from msdm.algorithms.entregpolicyiteration import EntropyRegularizedPolicyIteration
+from msdm.domains.tiger import Tiger
+from msdm.core.problemclasses.mdp.matrixcache import MatrixCache
+from msdm.domains import GridWorld
+from msdm.tests.domains import make_russell_norvig_grid
+
+class InstrumentationTests(unittest.TestCase):
+    def test_default_instrumentation_is_noop(self):
+        vi = ValueIteration()
+        assert vi.instrumentation is NULL_INSTRUMENTATION
+        assert not vi.instrumentation.enabled
+        with vi.instrumentation.phase("solve"):
+            vi.instrumentation.count("bellman_backups")
+        res = vi.plan_on(make_russell_norvig_grid())
+        assert res.converged
+
+    def test_value_iteration_profile(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        payloads = []
+        vi = ValueIteration()
+        vi.instrumentation = profiler = Profiler(callback=payloads.append)
+        res = vi.plan_on(mdp)
+        assert set(profiler.phase_times) == {"compile", "solve", "result"}
+        assert profiler.counters["bellman_backups"] == (res.iterations + 1)*len(mdp.state_list)
+        assert profiler.counters["model_calls.next_state_dist"] > 0
+        assert len(profiler.iterations) == res.iterations + 1
+        assert payloads == profiler.iterations
+        assert all(isinstance(p, ValueIterationStep) for p in payloads)
+        assert payloads[-1].max_residual < vi.convergence_diff
+        assert payloads[0].max_residual > payloads[-1].max_residual
+        # the model itself is not modified
+        assert "next_state_dist" not in vars(mdp)
+        assert type(mdp).next_state_dist is type(make_russell_norvig_grid()).next_state_dist
+
+        # the model was compiled by the first call
+        profiler.reset()
+        vi.plan_on(mdp)
+        assert profiler.counters.get("model_calls.next_state_dist", 0) == 0
+
+    def test_policy_iteration_profile(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        pi = PolicyIteration()
+        pi.instrumentation = profiler = Profiler()
+        res = pi.plan_on(mdp)
+        assert profiler.phase_calls["policy_evaluation"] == res.iterations + 1
+        assert profiler.counters["policy_evaluations"] == res.iterations + 1
+        assert all(isinstance(p, PolicyIterationStep) for p in profiler.iterations)
+        assert profiler.iterations[0].policy_changes > 0
+        assert profiler.iterations[-1].policy_changes == 0
+        assert np.isclose(profiler.iterations[-1].max_residual, 0)
+
+    def test_learner_profile(self):
+        mdp = make_russell_norvig_grid()
+        q = QLearning(episodes=10, seed=0)
+        q.instrumentation = profiler = Profiler()
+        q.train_on(mdp)
+        summary = profiler.summary()
+        assert summary["counters"]["episodes"] == 10
+        assert summary["counters"]["model_calls.next_state_dist"] > 0
+
+    def test_phase_view_shares_the_problem(self):
+        mdp = make_russell_norvig_grid()
+        profiler = Profiler()
+        with profiler.phase("solve", mdp) as model:
+            assert model is not mdp
+            assert isinstance(model, type(mdp))
+            model.transition_matrix
+            with profiler.phase("inner", model) as inner:
+                assert inner is model
+                s = mdp.state_list[0]
+                inner.next_state_dist(s, mdp.actions(s)[0])
+        # caches computed through the view are kept by the problem
+        assert "_cached_transition_matrix" in vars(mdp)
+        calls = profiler.counters["model_calls.next_state_dist"]
+        assert calls > 1
+        # calls through a view after its phase are not counted
+        model.next_state_dist(s, mdp.actions(s)[0])
+        assert profiler.counters["model_calls.next_state_dist"] == calls
+
+    def test_problem_is_unchanged_during_phase(self):
+        mdp = GridWorld(tile_array=['s.g'])
+        fingerprint = MatrixCache.fingerprint(mdp)
+        with Profiler().phase("solve", mdp) as model:
+            assert "next_state_dist" not in vars(mdp)
+            assert type(mdp) is GridWorld
+            assert MatrixCache.fingerprint(mdp) == fingerprint
+            assert MatrixCache.fingerprint(model) == fingerprint
+            assert type(pickle.loads(pickle.dumps(mdp))) is GridWorld
+
+    def test_overlapping_phases_count_separately(self):
+        mdp = make_russell_norvig_grid()
+        s = mdp.state_list[0]
+        a = mdp.actions(s)[0]
+        first, second = Profiler(), Profiler()
+        first_phase = first.phase("solve", mdp)
+        second_phase = second.phase("solve", mdp)
+        first_model = first_phase.__enter__()
+        first_model.next_state_dist(s, a)
+        second_model = second_phase.__enter__()
+        second_model.next_state_dist(s, a)
+        first_model.next_state_dist(s, a)
+        # phases can end in any order
+        first_phase.__exit__(None, None, None)
+        first_model.next_state_dist(s, a)
+        second_model.next_state_dist(s, a)
+        second_phase.__exit__(None, None, None)
+        mdp.next_state_dist(s, a)
+        assert first.counters["model_calls.next_state_dist"] == 2
+        assert second.counters["model_calls.next_state_dist"] == 2
+        with first.phase("solve", mdp) as model:
+            model.next_state_dist(s, a)
+        assert first.counters["model_calls.next_state_dist"] == 3
+
+    def test_phase_on_problem_with_slots(self):
+        class SlotsProblem:
+            __slots__ = ("n", )
+            def reward(self, s, a, ns):
+                return self.n
+        problem = SlotsProblem()
+        problem.n = 1
+        profiler = Profiler()
+        with profiler.phase("solve", problem) as model:
+            assert model is problem
+            assert model.reward(None, None, None) == 1
+        assert profiler.phase_calls["solve"] == 1
+
+    def test_lrtdp_profile(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        for kwargs in [dict(), dict(indexed=True), dict(trials_per_batch=4)]:
+            lrtdp = LRTDP(heuristic=lambda s: 1, seed=0, **kwargs)
+            lrtdp.instrumentation = profiler = Profiler()
+            res = lrtdp.plan_on(mdp)
+            assert res.converged
+            assert set(profiler.phase_times) == {"solve", "result"}
+            assert all(isinstance(p, LRTDPTrial) for p in profiler.iterations)
+            assert len(profiler.iterations) == profiler.counters["trials"] > 0
+            assert sum(p.bellman_backups for p in profiler.iterations) == profiler.counters["bellman_backups"]
+            assert profiler.counters["model_calls.next_state_dist"] > 0
+            assert "next_state_dist" not in vars(mdp)
+
+    def test_laostar_profile(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        lao = LAOStar(heuristic=lambda s: 1, seed=0)
+        lao.instrumentation = profiler = Profiler()
+        res = lao.plan_on(mdp)
+        assert res.converged
+        assert res.explicit_graph.mdp is mdp
+        assert all(isinstance(p, LAOStarIteration) for p in profiler.iterations)
+        assert len(profiler.iterations) == res.iterations
+        assert sum(p.expanded_states for p in profiler.iterations) == profiler.counters["expansions"]
+        assert profiler.counters["expansions"] == res.explicit_graph.n_expanded
+        assert profiler.counters["model_calls.next_state_dist"] > 0
+
+    def test_pbvi_profile(self):
+        tiger = Tiger(coherence=.85, discount_rate=.85)
+        pbvi = PointBasedValueIteration(min_belief_expansions=2, max_belief_expansions=20)
+        pbvi.instrumentation = profiler = Profiler()
+        pbvi.plan_on(tiger)
+        assert set(profiler.phase_times) == {"solve", "result"}
+        assert all(isinstance(p, PBVIExpansion) for p in profiler.iterations)
+        assert len(profiler.iterations) > 0
+        assert sum(p.value_iterations for p in profiler.iterations) == profiler.counters["value_iterations"]
+        assert profiler.counters["belief_expansions"] > len(profiler.iterations)
+        assert profiler.counters["model_calls.next_state_dist"] > 0
+
+    def test_entreg_policy_iteration_profile(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        pi = EntropyRegularizedPolicyIteration(entropy_weight=.1)
+        pi.instrumentation = profiler = Profiler()
+        res = pi.plan_on(mdp)
+        assert set(profiler.phase_times) == {"compile", "solve", "result"}
+        assert profiler.counters["policy_evaluations"] == res.iterations + 1
+        assert profiler.counters["model_calls.next_state_dist"] > 0
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,8 @@
 import numpy as np
 import random
+import warnings
 
-from msdm.algorithms.laostar import LAOStar, ExplicitStateGraph
+from msdm.algorithms.laostar import LAOStar, ExplicitStateGraph, LAOStarEventListener
 from msdm.algorithms import PolicyIteration
 from msdm.core.problemclasses.mdp import QuickTabularMDP
 from msdm.core.distributions import DictDistribution
@@ -298,12 +299,116 @@ def test_trivial_solution():
     # Normal
     mdp = Counter(3, initial_state=0)
     res = lao.plan_on(mdp)
-    assert res.solution_graph.states_to_nodes[mdp.initial_state()]['value'] == -3
+    assert res.solution_graph.states_to_nodes[mdp.initial_state()].value == -3
     assert res.policy.run_on(mdp).action_traj == (+1, +1, +1)
 
     # No-op task. Now we start at 3, so value should be 0 there
     mdp = Counter(3, initial_state=3)
     res = lao.plan_on(mdp)
     print(res.solution_graph.states_to_nodes)
-    assert res.solution_graph.states_to_nodes[mdp.initial_state()]['value'] == 0
+    assert res.solution_graph.states_to_nodes[mdp.initial_state()].value == 0
     assert res.policy.run_on(mdp).action_traj == ()
+
+def test_laostar_value_iteration_revision():
+    mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+    vmax = mdp.reward_matrix.max()/(1 - mdp.discount_rate)
+    pi_res = PolicyIteration().plan_on(mdp)
+    lao_res = LAOStar(
+        heuristic=lambda s: vmax,
+        dynamic_programming_method="value_iteration",
+        seed=1238,
+    ).plan_on(mdp)
+    assert lao_res.converged
+    assert np.isclose(lao_res.initial_value, pi_res.initial_value, atol=1e-8)
+
+def test_laostar_value_iteration_not_converging():
+    # a positive-reward loop without discounting has unbounded values
+    mdp = GridWorld(["s..g"], feature_rewards={'g': 0}, step_cost=1, discount_rate=1.0)
+    lao = LAOStar(
+        heuristic=lambda s: 0,
+        dynamic_programming_method="value_iteration",
+        max_convergence_sweeps=1000,
+    )
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        res = lao.plan_on(mdp)
+    assert not res.converged
+    assert any("1000 sweeps" in str(w.message) for w in caught)
+
+def test_explicit_state_graph_dynamic_programming_uses_edge_store():
+    gw = GridWorld(
+        tile_array=[
+            "....g",
+            ".###.",
+            "s....",
+        ],
+        discount_rate=.99
+    )
+    explicit_graph = ExplicitStateGraph(
+        mdp=gw,
+        heuristic=lambda s: 0,
+        randomize_action_order=True,
+        randomize_nextstate_order=True,
+        rng=random.Random(12),
+    )
+    explicit_graph.expand_while(lambda s: True)
+    calls = []
+    next_state_dist = gw.next_state_dist
+    gw.next_state_dist = lambda s, a: calls.append((s, a)) or next_state_dist(s, a)
+    explicit_graph.dynamic_programming(list(explicit_graph.states_to_nodes.values()))
+    assert len(calls) == 0
+    pi_res = PolicyIteration().plan_on(gw)
+    for s, n in explicit_graph.states_to_nodes.items():
+        assert np.isclose(n.value, pi_res.V[s])
+
+def test_laostar_multiple_expansions_per_iteration():
+    mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+    vmax = mdp.reward_matrix.max()/(1 - mdp.discount_rate)
+    pi_res = PolicyIteration().plan_on(mdp)
+
+    class SolutionGraphChecker(LAOStarEventListener):
+        def main_lao_star_loop(self, localvars):
+            # the incrementally updated solution graph contains a rebuilt one
+            solution_graph = localvars['solution_graph']
+            rebuilt = localvars['explicit_graph'].solution_graph()
+            assert solution_graph.states_to_nodes.keys() >= rebuilt.states_to_nodes.keys()
+            assert set(solution_graph.nonterminal_tip_states) >= set(rebuilt.nonterminal_tip_states)
+            assert solution_graph.best_tip_states() == rebuilt.best_tip_states()
+
+    iterations = {}
+    for expansions_per_iteration in [1, 3, "all"]:
+        lao_res = LAOStar(
+            heuristic=lambda s: vmax,
+            expansions_per_iteration=expansions_per_iteration,
+            event_listener_class=SolutionGraphChecker,
+            seed=1201,
+        ).plan_on(mdp)
+        assert lao_res.converged
+        assert np.isclose(lao_res.initial_value, pi_res.initial_value, atol=1e-8)
+        iterations[expansions_per_iteration] = lao_res.iterations
+    assert iterations[1] > iterations[3] >= iterations["all"]
+
+def test_explicit_state_graph_parents_and_next_states():
+    mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+    explicit_graph = ExplicitStateGraph(
+        mdp=mdp,
+        heuristic=lambda s: 0,
+        randomize_action_order=True,
+        randomize_nextstate_order=True,
+        rng=random.Random(3),
+    )
+    explicit_graph.expand_while(lambda s: True)
+    for s, node in explicit_graph.states_to_nodes.items():
+        if not node.expanded:
+            continue
+        for a in node.action_order:
+            next_states = explicit_graph.next_states(s, a)
+            assert set(next_states) == set(mdp.next_state_dist(s, a).support)
+            for ns in next_states:
+                assert s in explicit_graph.parent_states(ns)
+    node = explicit_graph.states_to_nodes[explicit_graph.initial_states[0]]
+    try:
+        node.parent_states
+        assert False
+    except AttributeError:
+        pass
@@ -0,0 +1,84 @@
+import functools
+import os
+import tempfile
+import unittest
+import numpy as np
+from msdm.algorithms import ValueIteration, QLearning, SARSA
+from msdm.benchmarks import run_learning_curves
+from msdm.benchmarks.learningcurves import CompiledTabularMDP, compile_arrays
+from msdm.domains.cliffwalking import CliffWalking
+from msdm.tests.domains import make_russell_norvig_grid
+
+def _seeded_sarsa(seed):
+    # learners are only created to train with a seed
+    assert seed is not None
+    return SARSA(episodes=5, rand_choose=.1, indexed=True, seed=seed)
+
+def _failing_sarsa(directory, seed):
+    if seed == 0:
+        raise ValueError("learner failed")
+    open(os.path.join(directory, str(seed)), "w").close()
+    return SARSA(episodes=5, rand_choose=.1, indexed=True, seed=seed)
+
+class LearningCurveTests(unittest.TestCase):
+    def test_compiled_tabular_mdp(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        compiled = CompiledTabularMDP(mdp.state_list, mdp.action_list, compile_arrays(mdp), mdp.discount_rate)
+        assert np.isclose(compiled.transition_matrix, mdp.transition_matrix).all()
+        assert np.isclose(compiled.reward_matrix, mdp.reward_matrix).all()
+        assert (compiled.absorbing_state_vec == mdp.absorbing_state_vec).all()
+        s, a = mdp.initial_state_dist().support[0], mdp.action_list[0]
+        outside = [ns for ns in mdp.state_list if ns not in mdp.next_state_dist(s, a).support][0]
+        with self.assertRaises(KeyError):
+            compiled.reward(s, a, outside)
+        for s in mdp.state_list:
+            assert list(compiled.actions(s)) == list(mdp.actions(s))
+            assert compiled.is_terminal(s) == mdp.is_terminal(s)
+            for a in compiled.actions(s):
+                assert compiled.next_state_dist(s, a).isclose(mdp.next_state_dist(s, a))
+        assert np.isclose(
+            ValueIteration().plan_on(compiled).initial_value,
+            ValueIteration().plan_on(mdp).initial_value
+        )
+
+    def test_run_learning_curves(self):
+        domains = dict(grid=make_russell_norvig_grid(discount_rate=.95, slip_prob=.8))
+        learners = dict(
+            q=functools.partial(QLearning, episodes=10, rand_choose=.1),
+            sarsa=_seeded_sarsa,
+        )
+        progress = []
+        res = run_learning_curves(
+            domains, learners, seeds=[1, 2, 3], max_workers=2,
+            progress=lambda finished, total: progress.append((finished, total))
+        )
+        assert res.episode_rewards.shape == (1, 2, 3, 10)
+        assert progress[-1] == (6, 6)
+        assert not np.isnan(res.episode_rewards[:, 0]).any()
+        assert not np.isnan(res.episode_rewards[:, 1, :, :5]).any()
+        assert np.isnan(res.episode_rewards[:, 1, :, 5:]).all()
+        serial_res = run_learning_curves(domains, learners, seeds=[1, 2, 3], parallel=False)
+        assert np.array_equal(res.episode_rewards, serial_res.episode_rewards, equal_nan=True)
+
+    def test_learning_curves_match_direct_training(self):
+        domains = dict(
+            cliff=CliffWalking(),
+            grid=make_russell_norvig_grid(discount_rate=.95, slip_prob=.8),
+        )
+        learners = dict(q=functools.partial(QLearning, episodes=30, rand_choose=.1))
+        res = run_learning_curves(domains, learners, seeds=[3], max_workers=1)
+        for di, mdp in enumerate(domains.values()):
+            direct = QLearning(episodes=30, rand_choose=.1, seed=3).train_on(mdp)
+            assert np.array_equal(res.episode_rewards[di, 0, 0], direct.event_listener_results.episode_rewards)
+
+    def test_failing_task_cancels_queued_tasks(self):
+        domains = dict(grid=make_russell_norvig_grid(discount_rate=.95, slip_prob=.8))
+        seeds = list(range(20))
+        with tempfile.TemporaryDirectory() as directory:
+            learners = dict(sarsa=functools.partial(_failing_sarsa, directory))
+            with self.assertRaises(ValueError):
+                run_learning_curves(domains, learners, seeds=seeds, max_workers=1)
+            assert len(os.listdir(directory)) < len(seeds) - 1
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,14 @@
 import unittest
+import numpy as np
 import copy
 
 from msdm.algorithms import ValueIteration, LRTDP
 from msdm.tests.domains import GNTFig6_6, Counter
 from msdm.domains import GridWorld
 from msdm.domains.gridmdp.windygridworld import WindyGridWorld
-from msdm.algorithms.lrtdp import LRTDPEventListener
+from msdm.algorithms.lrtdp import LRTDPEventListener, IndexedSuccessors
+from msdm.core.problemclasses.mdp import QuickMDP
+from msdm.core.distributions import DictDistribution
 
 def ensure_uniform(dist):
     '''
@@ -65,7 +68,13 @@ class LRTDPTestCase(unittest.TestCase):
         self._test_lrtdp_heuristics_on_stochastic_domain(discount_rate=.99)
         self._test_lrtdp_heuristics_on_stochastic_domain(discount_rate=.9)
 
-    def _test_lrtdp_heuristics_on_stochastic_domain(self, discount_rate):
+    def test_indexed_lrtdp_heuristics_on_stochastic_domain(self):
+        self._test_lrtdp_heuristics_on_stochastic_domain(discount_rate=.99, indexed=True)
+
+    def test_batched_lrtdp_heuristics_on_stochastic_domain(self):
+        self._test_lrtdp_heuristics_on_stochastic_domain(discount_rate=.99, trials_per_batch=16)
+
+    def _test_lrtdp_heuristics_on_stochastic_domain(self, discount_rate, indexed=False, trials_per_batch=None):
         bellman_error_margin = 1e-5
         wg = WindyGridWorld(
             grid="""
@@ -90,17 +99,23 @@ class LRTDPTestCase(unittest.TestCase):
         lrtdp_res_admissible_shifted = LRTDP(
             heuristic=lambda s: vi_res.valuefunc[s] + 10,
             bellman_error_margin=bellman_error_margin,
-            seed=19299
+            seed=19299,
+            indexed=indexed,
+            trials_per_batch=trials_per_batch
         ).plan_on(wg)
         lrtdp_res_admissible_flat = LRTDP(
             heuristic=lambda s: 50,
             bellman_error_margin=bellman_error_margin,
-            seed=19299
+            seed=19299,
+            indexed=indexed,
+            trials_per_batch=trials_per_batch
         ).plan_on(wg)
         lrtdp_res_not_admissible = LRTDP(
             heuristic=lambda s: 0,
             bellman_error_margin=bellman_error_margin,
-            seed=19299
+            seed=19299,
+            indexed=indexed,
+            trials_per_batch=trials_per_batch
         ).plan_on(wg)
 
         _test_expected_error_bound(
@@ -160,16 +175,116 @@ class LRTDPTestCase(unittest.TestCase):
         m = LRTDP(heuristic=lambda s: 0, seed=12388)
         self.assert_equal_value_iteration(m, mdp)
 
+    def test_indexed_lrtdp(self):
+        mdp = GNTFig6_6()
+        self.assert_equal_value_iteration(LRTDP(heuristic=lambda s: 0, seed=12388, indexed=True), mdp)
+
+        mdp = GridWorld(
+            tile_array=[
+                '......g',
+                '...####',
+                '.###...',
+                '.....##',
+                '..####.',
+                '..s....',
+            ],
+            feature_rewards={'g': 0},
+            step_cost=-1,
+            discount_rate=1.0
+        )
+        res = LRTDP(heuristic=lambda s: 0, seed=1, indexed=True).plan_on(mdp)
+        vi_res = ValueIteration().plan_on(mdp)
+        assert res.converged
+        assert res.initial_value == vi_res.initial_value
+        assert all(res.solved[s] for s in mdp.initial_state_dist().support)
+        assert sum(res.policy.run_on(mdp).reward_traj) == vi_res.initial_value
+
+        algo = LRTDP(heuristic=lambda s: 0, seed=42, indexed=True)
+        mdp = Counter(3, initial_state=3)
+        assert algo.plan_on(mdp).V[mdp.initial_state()] == 0
+
+    def test_batched_lrtdp(self):
+        mdp = GNTFig6_6()
+        for trials_per_batch in [1, 4, 32]:
+            self.assert_equal_value_iteration(
+                LRTDP(heuristic=lambda s: 0, seed=12388, trials_per_batch=trials_per_batch),
+                mdp
+            )
+
+        # labels are consistent: every state reachable under the
+        # policy from a solved state is solved
+        mdp = WindyGridWorld(
+            grid="""
+                ...$
+                .^^.
+                .^^.
+                @...
+            """,
+            feature_rewards={'$': 0},
+            step_cost=-1,
+            wind_probability=.5,
+            discount_rate=.95,
+        )
+        res = LRTDP(heuristic=lambda s: 0, seed=3, trials_per_batch=8).plan_on(mdp)
+        assert res.converged
+        assert np.isclose(res.initial_value, ValueIteration().plan_on(mdp).initial_value, atol=1e-2)
+        for s, solved in res.solved.items():
+            if not solved or mdp.is_terminal(s):
+                continue
+            a = deterministic(res.policy.action_dist(s))
+            assert all(res.solved[ns] for ns in mdp.next_state_dist(s, a).support)
+
+        with self.assertWarns(UserWarning):
+            res = LRTDP(heuristic=lambda s: 0, seed=3, trials_per_batch=2, iterations=2).plan_on(mdp)
+        assert not res.converged
+
+    def test_actions_without_next_states(self):
+        # "stay" has an empty next-state distribution, and comes first
+        # at state 0 and last at state 1
+        def next_state_dist(s, a):
+            if a == "stay":
+                return DictDistribution({})
+            return DictDistribution({s + 1: 1.})
+        mdp = QuickMDP(
+            next_state_dist,
+            reward=lambda s, a, ns: 1,
+            actions=lambda s: {0: ("stay", "go"), 1: ("go", "stay"), 3: ()}.get(s, ("go", )),
+            initial_state=0,
+            is_terminal=lambda s: s == 2,
+        )
+        for kwargs in [dict(), dict(indexed=True), dict(trials_per_batch=4)]:
+            res = LRTDP(heuristic=lambda s: 0, seed=0, **kwargs).plan_on(mdp)
+            assert res.converged
+            assert res.V[0] == 2 and res.V[1] == 1
+            assert res.Q[0] == {"stay": 0, "go": 2}
+            assert res.Q[1] == {"go": 1, "stay": 0}
+
+        model = IndexedSuccessors(mdp, heuristic=lambda s: 0)
+        states = np.array([model.intern(0), model.intern(1)])
+        actions, values = model.greedy(states)
+        assert actions.tolist() == [1, 0]
+        assert values.tolist() == [1, 1]
+        assert model.q_values(states[1]).tolist() == [1, 0]
+
+        # non-terminal states without actions raise, as in the dict path
+        no_actions = np.array([model.intern(3)])
+        with self.assertRaises(ValueError):
+            model.greedy(no_actions)
+        with self.assertRaises(ValueError):
+            model.q_values(no_actions[0])
+
     def assert_equal_value_iteration(self, planner, mdp):
         lrtdp_res = planner.plan_on(mdp)
 
         vi = ValueIteration()
         vi_res = vi.plan_on(mdp)
 
-        # Ensure our VI Q values are a lower bound to the LRTDP ones.
+        # Ensure our VI Q values are a lower bound to the LRTDP ones
+        # (up to floating point error, since VI sums expected rewards
+        # and expected future values separately).
         for s in lrtdp_res.Q.keys():
             for a in mdp.actions(s):
-                assert vi_res.Q[s][a] <= lrtdp_res.Q[s][a]
+                assert vi_res.Q[s][a] <= lrtdp_res.Q[s][a] or np.isclose(vi_res.Q[s][a], lrtdp_res.Q[s][a])
 
         def policy(s):
             return deterministic(lrtdp_res.policy.action_dist(s))
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from msdm.domains import GridWorld
+from msdm.domains.gridmdp.windygridworld import WindyGridWorld
+from msdm.algorithms import ValueIteration
+from msdm.core.problemclasses.mdp import MatrixCache, QuickTabularMDP
+
+def make_gridworld(step_cost=-1):
+    return GridWorld(
+        tile_array=["..x.g", ".#.#.", "s...x"],
+        feature_rewards={'g': 5, 'x': -3},
+        success_prob=.8,
+        step_cost=step_cost
+    )
+
+class MatrixCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = self.tempdir.name
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_cache_round_trip(self):
+        cache = MatrixCache(self.directory)
+        for sparse in [False, True]:
+            stored = cache.as_matrices(make_gridworld(), sparse=sparse)
+            loaded_mdp = make_gridworld()
+            loaded = cache.as_matrices(loaded_mdp, sparse=sparse)
+            assert isinstance(loaded['s0'], np.memmap)
+            assert not loaded['nt'].flags.writeable
+            for k in ['tf', 'rf']:
+                if sparse:
+                    assert (stored[k] != loaded[k]).nnz == 0
+                else:
+                    assert (stored[k] == loaded[k]).all()
+            for k in ['sarf', 's0', 'nt', 'rs', 'ast']:
+                assert (stored[k] == loaded[k]).all()
+        assert len(cache.keys()) == 1
+        fresh_res = ValueIteration().plan_on(make_gridworld())
+        loaded_res = ValueIteration().plan_on(loaded_mdp)
+        assert fresh_res.initial_value == loaded_res.initial_value
+
+    def test_fingerprint(self):
+        assert MatrixCache.fingerprint(make_gridworld()) == MatrixCache.fingerprint(make_gridworld())
+        assert MatrixCache.fingerprint(make_gridworld()) != MatrixCache.fingerprint(make_gridworld(step_cost=-2))
+        wg = WindyGridWorld(grid="@.$", feature_rewards={})
+        assert MatrixCache.fingerprint(wg) != MatrixCache.fingerprint(make_gridworld())
+        mdp = QuickTabularMDP(
+            next_state=lambda s, a: s + a,
+            reward=-1,
+            actions=(1,),
+            initial_state=0,
+            is_terminal=lambda s: s == 2
+        )
+        with self.assertRaises(ValueError):
+            MatrixCache.fingerprint(mdp)
+
+    def test_invalidation_and_eviction(self):
+        cache = MatrixCache(self.directory)
+        cache.as_matrices(make_gridworld())
+        cache.invalidate(make_gridworld())
+        assert cache.keys() == []
+
+        cache.as_matrices(make_gridworld(step_cost=-1))
+        entry_size = cache.total_size()
+        cache.max_bytes = int(entry_size*1.5)
+        cache.as_matrices(make_gridworld(step_cost=-2))
+        assert cache.keys() == [MatrixCache.fingerprint(make_gridworld(step_cost=-2))]
+        assert cache.total_size() <= cache.max_bytes
+
+        cache.clear()
+        assert cache.keys() == []
+        assert os.path.isdir(self.directory)
@@ -1,3 +1,6 @@
+import numpy as np
+from unittest import mock
+from msdm.algorithms import pointbasedvalueiteration
 from msdm.algorithms import LAOStar, PointBasedValueIteration, QMDP
 from msdm.domains.tiger import Tiger
 from msdm.domains.heavenorhell import HeavenOrHell
@@ -72,3 +75,23 @@ def test_pbvi_qmdp():
     qmdp_res = QMDP().plan_on(hh)
     assert list(qmdp_res.policy.action_dist(qmdp_res.policy.initial_agentstate()).probs) == [.25, .25, .25, .25]
     assert list(pbvi_res.policy.action_dist(pbvi_res.policy.initial_agentstate()).probs) == [1]
+
+def test_pbvi_sparse_matches_dense():
+    hh = HeavenOrHell(
+        coherence=.9,
+        grid=
+            """
+            hsg
+            #c#
+            """,
+        discount_rate=.9
+    )
+    params = dict(min_belief_expansions=5, max_belief_expansions=100)
+    dense_res = PointBasedValueIteration(**params).plan_on(hh)
+    # the per-action transition matrices are split once per plan
+    split = pointbasedvalueiteration.action_transition_matrices
+    with mock.patch.object(pointbasedvalueiteration, "action_transition_matrices", wraps=split) as split_calls:
+        sparse_res = PointBasedValueIteration(**params, sparse=True).plan_on(hh)
+    assert split_calls.call_count == 1
+    assert np.allclose(dense_res.alpha_vectors, sparse_res.alpha_vectors)
+    assert dense_res.alpha_actions == sparse_res.alpha_actions
@@ -1,4 +1,5 @@
 import unittest
+from unittest import mock
 import numpy as np
 from frozendict import frozendict
 from msdm.core.distributions import DictDistribution
@@ -129,5 +130,36 @@ class MyTestCase(unittest.TestCase):
                 assert all([np.isclose(pi.valuefunc[s], vi.valuefunc[s])
                             for s in reachable])
 
+    def test_approximate_policy_evaluation(self):
+        mdps = [
+            Geometric(p=1/13),
+            GNTFig6_6(),
+            make_russell_norvig_grid(discount_rate=.95, slip_prob=.8),
+            GridWorld((
+                '..g..',
+                '.###.',
+                '..#..',
+                '..s..'
+            ), discount_rate=.99),
+        ]
+        for mdp in mdps:
+            exact = PolicyIteration().plan_on(mdp)
+            for policy_evaluation in ["modified", "gmres", "bicgstab"]:
+                res = PolicyIteration(policy_evaluation=policy_evaluation).plan_on(mdp)
+                assert res.converged
+                assert np.isclose(res._valuevec, exact._valuevec, atol=1e-5).all(), policy_evaluation
+                assert np.isclose(res.initial_value, exact.initial_value, atol=1e-5)
+
+    def test_unconverged_krylov_evaluation_falls_back_to_direct_solve(self):
+        mdp = make_russell_norvig_grid(discount_rate=.95, slip_prob=.8)
+        exact = PolicyIteration().plan_on(mdp)
+        def unconverged(A, b, **kwargs):
+            return np.zeros_like(b), 1
+        with mock.patch("scipy.sparse.linalg.gmres", unconverged):
+            with self.assertWarns(UserWarning):
+                res = PolicyIteration(policy_evaluation="gmres").plan_on(mdp)
+        assert res.converged
+        assert np.isclose(res._valuevec, exact._valuevec, atol=1e-5).all()
+
 if __name__ == '__main__':
     unittest.main()
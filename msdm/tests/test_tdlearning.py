@@ -1,10 +1,13 @@
+import unittest
 import numpy as np
-from msdm.algorithms import QLearning, DoubleQLearning, SARSA, ExpectedSARSA
+from functools import partial
+from msdm.algorithms.tdlearning import TemporalDifferenceLearning, epsilon_softmax_sample
+from msdm.algorithms import QLearning, DoubleQLearning, SARSA, ExpectedSARSA, SARSALambda, WatkinsQLambda, DynaQ
 from msdm.tests.domains import make_russell_norvig_grid
 from msdm.domains.cliffwalking import CliffWalking
 from msdm.domains import GridWorld
 
-def _test_tdlearner(Learner):
+def _test_tdlearner(Learner, indexed=False):
     gw = make_russell_norvig_grid(discount_rate=.95, slip_prob=0.8)
 
     # test reproducibility
@@ -13,7 +16,8 @@ def _test_tdlearner(Learner):
         episodes=10,
         rand_choose=.0,
         step_size=.5,
-        softmax_temp=0.01
+        softmax_temp=0.01,
+        indexed=indexed,
     )
     ql1 = Learner(**params).train_on(gw)
     ql2 = Learner(**params).train_on(gw)
@@ -37,6 +41,49 @@ def test_tdlearners():
     for Learner in [QLearning, DoubleQLearning, SARSA, ExpectedSARSA]:
         _test_tdlearner(Learner)
 
+def test_indexed_tdlearners():
+    for Learner in [QLearning, DoubleQLearning, SARSA, ExpectedSARSA]:
+        _test_tdlearner(Learner, indexed=True)
+        _test_tdlearner_initialization(Learner, indexed=True)
+
+def test_learner_without_indexed_mode():
+    # learners only need to define `_training`; `indexed` mode is opt-in
+    class DictOnlyQLearning(TemporalDifferenceLearning):
+        def _training(self, mdp, rng, event_listener):
+            q = self._initial_q_table(mdp)
+            for ep in range(self.episodes):
+                s = mdp.initial_state_dist().sample(rng=rng)
+                while not mdp.is_terminal(s):
+                    a = epsilon_softmax_sample(q[s], self.rand_choose, self.softmax_temp, rng)
+                    ns = mdp.next_state_dist(s, a).sample(rng=rng)
+                    r = mdp.reward(s, a, ns)
+                    q[s][a] += self.step_size*(r + mdp.discount_rate*max(q[ns].values()) - q[s][a])
+                    event_listener.end_of_timestep(locals())
+                    s = ns
+                event_listener.end_of_episode(locals())
+            return q
+
+    assert not DictOnlyQLearning.supports_indexed
+    gw = GridWorld(tile_array=["s.g"], discount_rate=.99)
+    res = DictOnlyQLearning(episodes=20, seed=1).train_on(gw)
+    assert len(res.event_listener_results.episode_rewards) == 20
+    assert set(res.q_values.keys()) == set(gw.state_list)
+    try:
+        DictOnlyQLearning(indexed=True)
+        assert False
+    except ValueError as e:
+        assert "DictOnlyQLearning" in str(e)
+
+def test_indexed_td_algs():
+    g = CliffWalking()
+    for Learner in [QLearning, DoubleQLearning, SARSA, ExpectedSARSA]:
+        res = Learner(rand_choose=.1, episodes=400, seed=1239123, indexed=True).train_on(g)
+        assert set(res.q_values.keys()) == set(g.state_list)
+        for s, avals in res.q_values.items():
+            assert set(avals.keys()) == set(g.actions(s))
+        # learners reliably reach the goal without falling off the cliff
+        assert np.mean(res.event_listener_results.episode_rewards[-100:]) > -100
+
 def test_td_algs():
     g = CliffWalking()
     ql = QLearning(rand_choose=.1, episodes=400, seed=1239123)
@@ -56,15 +103,15 @@ def test_td_algs():
     assert qqr < sr
     assert qqr < esr
 
-def _test_tdlearner_initialization(Learner):
+def _test_tdlearner_initialization(Learner, indexed=False):
     g = make_russell_norvig_grid(discount_rate=.95, slip_prob=0.8)
-    l_opt = Learner(rand_choose=.1, episodes=1, seed=1239123, initial_q=10)
+    l_opt = Learner(rand_choose=.1, episodes=1, seed=1239123, initial_q=10, indexed=indexed)
     res_opt = l_opt.train_on(g)
     for s, av in res_opt.q_values.items():
         for a, v in av.items():
             assert v >= 0
 
-    l_pess = Learner(rand_choose=.1, episodes=1, seed=123923, initial_q=lambda s, a : -1)
+    l_pess = Learner(rand_choose=.1, episodes=1, seed=123923, initial_q=lambda s, a : -1, indexed=indexed)
     res_pess = l_pess.train_on(g)
     for s, av in res_pess.q_values.items():
         for a, v in av.items():
@@ -73,3 +120,136 @@ def _test_tdlearner_initialization(Learner):
 def test_tdlearning_initialization():
     for Learner in [QLearning, DoubleQLearning, SARSA, ExpectedSARSA]:
         _test_tdlearner_initialization(Learner)
+
+def test_vectorized_td_learners():
+    g = CliffWalking()
+    n_envs = 8
+    for Learner in [QLearning, SARSA, ExpectedSARSA]:
+        learner = Learner(rand_choose=.1, episodes=100, seed=1239)
+        res = learner.train_vectorized_on(g, n_envs=n_envs)
+        assert res.q_table.shape == (n_envs, len(g.state_list), len(g.action_list))
+        assert res.episode_rewards.shape == (n_envs, 100)
+        assert (res.episode_rewards[:, -20:].mean(axis=1) > res.episode_rewards[:, :20].mean(axis=1)).all()
+        res2 = learner.train_vectorized_on(g, n_envs=n_envs)
+        assert (res.episode_rewards == res2.episode_rewards).all()
+
+        # environments can have their own parameters,
+        # and do not learn with a step size of 0
+        step_size = np.full(n_envs, .1)
+        step_size[0] = 0
+        res = Learner(rand_choose=.1, episodes=2, seed=1239).train_vectorized_on(
+            g, n_envs=n_envs, step_size=step_size, softmax_temp=np.linspace(0, 1, n_envs)
+        )
+        initial_q = np.where(g.action_matrix.astype(bool), 0, -np.inf)
+        assert (res.q_table[0] == initial_q).all()
+        assert not (res.q_table[1] == initial_q).all()
+
+        # a shared table is updated by all environments
+        shared_res = learner.train_vectorized_on(g, n_envs=n_envs, shared_q=True)
+        assert shared_res.q_table.shape == (len(g.state_list), len(g.action_list))
+        assert shared_res.episode_rewards[:, -20:].mean() > -100
+        assert set(shared_res.q_values.keys()) == set(g.state_list)
+
+class VectorizedTrainingTests(unittest.TestCase):
+    def test_shared_table_with_many_environments(self):
+        # environments all start in the same state, so they
+        # update the same entries of a shared table at once
+        g = CliffWalking()
+        res = QLearning(episodes=3, seed=1, rand_choose=.1, step_size=.5).train_vectorized_on(
+            g, n_envs=64, shared_q=True
+        )
+        assert np.isfinite(res.q_table[g.action_matrix.astype(bool)]).all()
+        assert np.isfinite(res.episode_rewards).all()
+        n_envs = 16
+        res = SARSA(episodes=100, seed=1, rand_choose=.1).train_vectorized_on(
+            g, n_envs=n_envs, shared_q=True, step_size=np.linspace(.05, .5, n_envs)
+        )
+        assert np.isfinite(res.q_table[g.action_matrix.astype(bool)]).all()
+        assert res.episode_rewards[:, -20:].mean() > -100
+
+    def test_unsupported_learners_are_rejected(self):
+        g = CliffWalking()
+        for Learner in [DoubleQLearning, SARSALambda, WatkinsQLambda, DynaQ]:
+            assert not Learner.supports_vectorized
+            with self.assertRaises(ValueError):
+                Learner(episodes=1).train_vectorized_on(g, n_envs=2)
+
+def test_lambda_tdlearners():
+    for Learner in [SARSALambda, WatkinsQLambda]:
+        for indexed in [False, True]:
+            _test_tdlearner(Learner, indexed=indexed)
+            _test_tdlearner_initialization(Learner, indexed=indexed)
+        for trace_type in ["replacing", "accumulating"]:
+            res = Learner(rand_choose=.1, episodes=200, seed=1239123, trace_type=trace_type).train_on(CliffWalking())
+            assert np.mean(res.event_listener_results.episode_rewards[-50:]) > -100
+
+    try:
+        SARSALambda(trace_type="dutch")
+        assert False
+    except ValueError:
+        pass
+
+def test_sarsa_lambda_without_traces():
+    # with a trace decay of 0, SARSA(λ) is SARSA
+    g = make_russell_norvig_grid(discount_rate=.95, slip_prob=0.8)
+    for indexed in [False, True]:
+        params = dict(rand_choose=.1, episodes=20, seed=123, indexed=indexed)
+        res = SARSALambda(trace_decay=0, **params).train_on(g)
+        one_step_res = SARSA(**params).train_on(g)
+        assert res.event_listener_results.episode_rewards == one_step_res.event_listener_results.episode_rewards
+        assert res.q_values == one_step_res.q_values
+
+def test_lambda_tdlearners_credit_assignment():
+    # with traces, one episode updates every state on the way to the goal
+    gw = GridWorld(
+        tile_array=["s.........g"],
+        feature_rewards={'g': 10},
+        step_cost=0,
+        discount_rate=1.0,
+    )
+    params = dict(rand_choose=0, episodes=1, seed=12345)
+    for Learner, OneStepLearner in [(SARSALambda, SARSA), (WatkinsQLambda, QLearning)]:
+        res = Learner(trace_decay=1, **params).train_on(gw)
+        one_step_res = OneStepLearner(**params).train_on(gw)
+        updated = [s for s, avals in res.q_values.items() if any(v > 0 for v in avals.values())]
+        one_step_updated = [s for s, avals in one_step_res.q_values.items() if any(v > 0 for v in avals.values())]
+        assert len(one_step_updated) == 1
+        assert len(updated) == 10
+
+def test_dynaq():
+    PrioritizedSweeping = partial(DynaQ, prioritized_sweeping=True)
+    gw = make_russell_norvig_grid(discount_rate=.95, slip_prob=0.8)
+    for Learner in [DynaQ, PrioritizedSweeping]:
+        for indexed in [False, True]:
+            # test reproducibility
+            params = dict(seed=12345, episodes=10, rand_choose=.1, indexed=indexed)
+            res1 = Learner(**params).train_on(gw)
+            res2 = Learner(**params).train_on(gw)
+            res3 = Learner(**{**params, 'seed': 54321}).train_on(gw)
+            assert res1.event_listener_results.episode_rewards == res2.event_listener_results.episode_rewards
+            assert res1.event_listener_results.episode_rewards != res3.event_listener_results.episode_rewards
+            _test_tdlearner_initialization(Learner, indexed=indexed)
+        res = Learner(rand_choose=.1, episodes=100, seed=1239123).train_on(CliffWalking())
+        assert np.mean(res.event_listener_results.episode_rewards[-50:]) > -100
+
+def test_dynaq_without_planning():
+    # without planning steps, Dyna-Q is Q-learning
+    g = make_russell_norvig_grid(discount_rate=.95, slip_prob=0.8)
+    for prioritized_sweeping in [False, True]:
+        for indexed in [False, True]:
+            params = dict(rand_choose=.1, episodes=20, seed=123, indexed=indexed)
+            res = DynaQ(planning_steps=0, prioritized_sweeping=prioritized_sweeping, **params).train_on(g)
+            q_res = QLearning(**params).train_on(g)
+            assert res.event_listener_results.episode_rewards == q_res.event_listener_results.episode_rewards
+            assert res.q_values == q_res.q_values
+
+def test_dynaq_sample_efficiency():
+    # planning reduces the number of real steps taken while learning
+    gw = GridWorld(tile_array=["s" + "."*20 + "g"]*3, step_cost=-1, discount_rate=.99)
+    def real_steps(Learner):
+        res = Learner(rand_choose=.1, episodes=20, seed=123).train_on(gw)
+        return -sum(res.event_listener_results.episode_rewards)
+    q_steps = real_steps(QLearning)
+    dyna_steps = real_steps(partial(DynaQ, planning_steps=10))
+    ps_steps = real_steps(partial(DynaQ, planning_steps=10, prioritized_sweeping=True))
+    assert ps_steps < dyna_steps < q_steps
@@ -4,6 +4,7 @@ import numpy as np
 from frozendict import frozendict
 from msdm.core.distributions import DictDistribution
 from msdm.algorithms import ValueIteration
+from msdm.core.algorithmclasses import Profiler
 from msdm.tests.domains import Counter, GNTFig6_6, Geometric, VaryingActionNumber
 from msdm.domains import GridWorld
 
@@ -56,3 +57,93 @@ class VITestCase(unittest.TestCase):
         assert res.policy.action_dist(frozendict(x=0, y=1)).isclose(DictDistribution({
                 frozendict({'dx': 1, 'dy': 0}): 1,
         }))
+
+    def test_asynchronous_backup_orders(self):
+        tile_array = [
+            '.........g',
+            '.#######..',
+            '..........',
+            's.........',
+        ]
+        for gw in [
+            GridWorld(tile_array=tile_array, success_prob=.8, discount_rate=.99),
+            GridWorld(tile_array=tile_array, feature_rewards={'g': 100}, step_cost=0, discount_rate=.999),
+        ]:
+            sync_res = ValueIteration().plan_on(gw)
+            for backup_order in ["gauss-seidel", "prioritized", "topological"]:
+                async_res = ValueIteration(backup_order=backup_order).plan_on(gw)
+                assert async_res.converged
+                assert np.allclose(sync_res._valuevec, async_res._valuevec, atol=1e-2)
+                assert np.isclose(sync_res.initial_value, async_res.initial_value, atol=1e-2)
+
+        # with a rewarding goal, values propagate outward from the goal in one sweep
+        for backup_order in ["gauss-seidel", "prioritized", "topological"]:
+            async_res = ValueIteration(backup_order=backup_order).plan_on(gw)
+            assert async_res.iterations <= 2 < sync_res.iterations
+
+    def test_float32_backups(self):
+        gw = GridWorld(
+            tile_array=[
+                '.........g',
+                '.#######..',
+                '..........',
+                's.........',
+            ],
+            success_prob=.8,
+            discount_rate=.99
+        )
+        res64 = ValueIteration().plan_on(gw)
+        res32 = ValueIteration(dtype=np.float32, convergence_diff=1e-4).plan_on(gw)
+        assert res32._valuevec.dtype == np.float32
+        assert res32.converged
+        assert np.allclose(res64._valuevec, res32._valuevec, atol=1e-2)
+        for s in gw.state_list:
+            assert res64.policy.action_dist(s).support == res32.policy.action_dist(s).support
+
+    def test_plan_on_batch(self):
+        tile_array = [
+            '...x.....g',
+            '.###x###..',
+            '.....x....',
+            's.........',
+        ]
+        gws = [
+            GridWorld(
+                tile_array=tile_array,
+                feature_rewards={'g': g_reward, 'x': x_reward},
+                step_cost=step_cost,
+                success_prob=.8,
+                discount_rate=discount_rate
+            )
+            for g_reward, x_reward, step_cost, discount_rate in [
+                (0, -10, -1, .99),
+                (100, -10, 0, .95),
+                (10, 0, -1, 1.0),
+                (10, -50, -1, .9),
+            ]
+        ]
+        for sparse in [False, True]:
+            vi = ValueIteration(sparse=sparse)
+            vi.instrumentation = profiler = Profiler()
+            batch_res = vi.plan_on_batch(gws)
+            assert len(batch_res) == len(gws)
+            # MDPs that converge early leave the batch with
+            # the values and residuals they converged with
+            assert len({res.iterations for res in batch_res}) > 1
+            n_states = len(gws[0].state_list)
+            assert profiler.counters["bellman_backups"] == sum(res.iterations + 1 for res in batch_res)*n_states
+            for gw, res in zip(gws, batch_res):
+                single_res = ValueIteration().plan_on(gw)
+                assert res.mdp is gw
+                assert res.converged
+                assert np.abs(res.max_bellman_error*gw.reachable_state_vec).max() < vi.convergence_diff
+                alone_res = vi.plan_on_batch([gw])[0]
+                assert res.iterations == alone_res.iterations
+                assert np.allclose(res._valuevec, alone_res._valuevec, rtol=0, atol=1e-10)
+                assert np.allclose(res.max_bellman_error, alone_res.max_bellman_error, rtol=0, atol=1e-10)
+                assert np.allclose(single_res._valuevec, res._valuevec, atol=1e-4)
+                assert np.allclose(single_res._qvaluemat, res._qvaluemat, atol=1e-4)
+                assert np.isclose(single_res.initial_value, res.initial_value, atol=1e-4)
+
+        with self.assertRaises(ValueError):
+            ValueIteration().plan_on_batch([gws[0], GridWorld(tile_array=tile_array, success_prob=.7)])